@@ -0,0 +1,157 @@
+import json
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import MetaData, Table, func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from userauth.common.jobs import JobStatus
+from userauth.common.roles import Role
+from userauth.database.backup import (
+    BackupIntegrityError,
+    export_database,
+    export_table,
+    restore_database,
+)
+from userauth.database.models import Base, JobEntry, LoginEntry, UserEntry
+
+################################################################################
+# UNIT TESTS
+################################################################################
+
+
+async def populated_engine(filepath, user_count):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{filepath}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        for idx in range(user_count):
+            user_uuid = uuid4()
+            await conn.execute(
+                UserEntry.__table__.insert(),
+                {
+                    "uuid": user_uuid,
+                    "role": Role.celebrity if idx % 2 else Role.normal,
+                    "username": f"user_{idx}",
+                    "email": f"user_{idx}@email.com",
+                    "name": "name",
+                    "surname": "surname",
+                    "hashed_password": "password",
+                },
+            )
+            await conn.execute(
+                LoginEntry.__table__.insert(),
+                [{"uuid": uuid4(), "user": user_uuid} for _ in range(3)],
+            )
+            if idx % 5 == 0:
+                await conn.execute(
+                    JobEntry.__table__.insert(),
+                    {
+                        "uuid": uuid4(),
+                        "user": user_uuid,
+                        "kind": "validate_photo",
+                        "status": JobStatus.pending,
+                        "payload": bytes([idx, 0, 255]),
+                        "result": {"role": "normal"} if idx else None,
+                    },
+                )
+    return engine
+
+
+async def count_rows(engine, table):
+    async with engine.connect() as conn:
+        return await conn.scalar(select(func.count()).select_from(table))
+
+
+@pytest.mark.asyncio
+async def test_export_restore(tmp_path):
+    """Test that a backup can be restored into a fresh database."""
+    source = await populated_engine(tmp_path / "source.db", 25)
+    manifest = await export_database(source, tmp_path / "backup", chunk_size=10)
+    assert manifest["tables"]["users"]["rows"] == 25
+    assert manifest["tables"]["users"]["chunks"] == 3
+    assert manifest["tables"]["logins"]["rows"] == 75
+    assert manifest["tables"]["jobs"]["rows"] == 5
+
+    target = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'target.db'}")
+    restored = await restore_database(target, tmp_path / "backup")
+    assert restored == {"users": 25, "logins": 75, "jobs": 5}
+
+    for table in (UserEntry.__table__, JobEntry.__table__):
+        async with source.connect() as conn:
+            original = (await conn.execute(select(table))).all()
+        async with target.connect() as conn:
+            copied = (await conn.execute(select(table))).all()
+        assert sorted(original, key=str) == sorted(copied, key=str)
+
+    await source.dispose()
+    await target.dispose()
+
+
+@pytest.mark.asyncio
+async def test_restore_corrupted(tmp_path):
+    """Test that corrupted backups are rejected without writing anything."""
+    source = await populated_engine(tmp_path / "source.db", 5)
+    await export_database(source, tmp_path / "backup")
+
+    logins_file = tmp_path / "backup" / "logins.ubk"
+    data = bytearray(logins_file.read_bytes())
+    data[-1] ^= 0xFF
+    logins_file.write_bytes(bytes(data))
+
+    target = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'target.db'}")
+    with pytest.raises(BackupIntegrityError):
+        await restore_database(target, tmp_path / "backup")
+
+    async with target.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    assert await count_rows(target, UserEntry.__table__) == 0
+
+    await source.dispose()
+    await target.dispose()
+
+
+@pytest.mark.asyncio
+async def test_restore_previous_format(tmp_path):
+    """Test that a backup from before the jobs and user versions is restored."""
+    source = await populated_engine(tmp_path / "source.db", 5)
+    # The users table as it was, without the version column
+    old_users = Table(
+        "users",
+        MetaData(),
+        *[
+            column._copy()
+            for column in UserEntry.__table__.columns
+            if column.name != "version"
+        ],
+    )
+    directory = tmp_path / "backup"
+    directory.mkdir()
+    manifest = {
+        "format": 1,
+        "created": "2023-11-01T00:00:00",
+        "tables": {
+            table.name: await export_table(
+                source, table, directory / f"{table.name}.ubk", 10
+            )
+            for table in (old_users, LoginEntry.__table__)
+        },
+    }
+    (directory / "manifest.json").write_text(json.dumps(manifest))
+
+    target = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'target.db'}")
+    restored = await restore_database(target, directory)
+    assert restored == {"users": 5, "logins": 15}
+    async with target.connect() as conn:
+        versions = (await conn.scalars(select(UserEntry.version))).all()
+    assert versions == [1] * 5
+
+    # The current format must include every table
+    await export_database(source, tmp_path / "current")
+    manifest = json.loads((tmp_path / "current" / "manifest.json").read_text())
+    del manifest["tables"]["jobs"]
+    (tmp_path / "current" / "manifest.json").write_text(json.dumps(manifest))
+    with pytest.raises(BackupIntegrityError):
+        await restore_database(target, tmp_path / "current")
+
+    await source.dispose()
+    await target.dispose()
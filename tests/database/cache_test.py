@@ -0,0 +1,282 @@
+import asyncio
+import time
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from userauth.common.roles import Role
+from userauth.database.cache import (
+    LocalCache,
+    RedisCache,
+    TieredCache,
+    UserCache,
+    build_user_cache,
+)
+from userauth.database.manager import DatabaseManager, hash_password
+from userauth.database.models import Base, UserEntry
+
+################################################################################
+# SETUP DB IN MEMORY AND REDIS STAND-IN
+################################################################################
+
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite://"
+
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+async def create_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+asyncio.run(create_db())
+
+executed_statements = []
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, *args):
+    executed_statements.append(statement)
+
+
+class RedisStandIn:
+    """Local server implementing the few Redis commands used by the cache (RESP2)."""
+
+    def __init__(self, delay=0.0):
+        self.data = {}
+        self.subscribers = {}
+        self.server = None
+        self.delay = delay
+        self.connections = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"redis://127.0.0.1:{port}/0"
+
+    async def stop(self):
+        for writers in self.subscribers.values():
+            for writer in writers:
+                writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def read_command(self, reader):
+        header = await reader.readline()
+        if not header:
+            return None
+        arguments = []
+        for _ in range(int(header[1:])):
+            length = int((await reader.readline())[1:])
+            arguments.append((await reader.readexactly(length + 2))[:-2])
+        return arguments
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while True:
+            command = await self.read_command(reader)
+            if command is None:
+                return
+            await asyncio.sleep(self.delay)
+            name = command[0].upper()
+            if name == b"GET":
+                value = self.data.get(command[1])
+                if value is None:
+                    writer.write(b"$-1\r\n")
+                else:
+                    writer.write(b"$%d\r\n%s\r\n" % (len(value), value))
+            elif name == b"SET":
+                self.data[command[1]] = command[2]
+                writer.write(b"+OK\r\n")
+            elif name == b"DEL":
+                removed = sum(
+                    self.data.pop(key, None) is not None for key in command[1:]
+                )
+                writer.write(b":%d\r\n" % removed)
+            elif name == b"PUBLISH":
+                writers = self.subscribers.get(command[1], [])
+                for subscriber in writers:
+                    subscriber.write(
+                        b"*3\r\n$7\r\nmessage\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n"
+                        % (len(command[1]), command[1], len(command[2]), command[2])
+                    )
+                writer.write(b":%d\r\n" % len(writers))
+            elif name == b"SUBSCRIBE":
+                self.subscribers.setdefault(command[1], []).append(writer)
+                writer.write(
+                    b"*3\r\n$9\r\nsubscribe\r\n$%d\r\n%s\r\n:1\r\n"
+                    % (len(command[1]), command[1])
+                )
+            else:
+                writer.write(b"-ERR unknown command\r\n")
+            await writer.drain()
+
+
+################################################################################
+# UNIT TESTS
+################################################################################
+
+
+@pytest.mark.asyncio
+async def test_local_cache():
+    """Test that the local cache evicts the least recently used entries."""
+    cache = LocalCache(max_entries=2)
+    await cache.set_many({"a": b"1", "b": b"2"}, ttl=60)
+    assert await cache.get("a") == b"1"
+
+    await cache.set_many({"c": b"3"}, ttl=60)
+    assert await cache.get("b") is None
+    assert await cache.get("a") == b"1"
+
+    await cache.set_many({"d": b"4"}, ttl=-1)
+    assert await cache.get("d") is None
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_invalidation():
+    """Test that invalidations reach the local cache of other replicas."""
+    pytest.importorskip("redis")
+    stand_in = RedisStandIn()
+    url = await stand_in.start()
+
+    replica_1 = TieredCache(LocalCache(), RedisCache(url), ttl=60)
+    replica_2 = TieredCache(LocalCache(), RedisCache(url), ttl=60)
+    await replica_2.start()
+
+    await replica_1.set_many({"key": b"value"})
+    assert await replica_2.get("key") == b"value"
+    assert await replica_2.local.get("key") == b"value"
+
+    for _ in range(100):
+        if stand_in.subscribers:
+            break
+        await asyncio.sleep(0.01)
+
+    await replica_1.invalidate(["key"])
+    for _ in range(100):
+        if await replica_2.local.get("key") is None:
+            break
+        await asyncio.sleep(0.01)
+    assert await replica_2.local.get("key") is None
+    assert await replica_2.get("key") is None
+
+    await replica_2.stop()
+    await replica_1.stop()
+    await stand_in.stop()
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_unavailable():
+    """Test that an unreachable shared cache only produces misses."""
+    pytest.importorskip("redis")
+    cache = TieredCache(LocalCache(), RedisCache("redis://127.0.0.1:1/0"), ttl=60)
+    await cache.set_many({"key": b"value"})
+    assert await cache.get("key") == b"value"
+    assert await cache.get("other") is None
+    await cache.invalidate(["key"])
+    assert await cache.get("key") is None
+
+
+@pytest.mark.asyncio
+async def test_tiered_cache_unresponsive():
+    """Test that a shared cache that doesn't reply times out into misses."""
+    pytest.importorskip("redis")
+
+    async def never_reply(reader, writer):
+        await reader.read()
+
+    server = await asyncio.start_server(never_reply, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    shared = RedisCache(f"redis://127.0.0.1:{port}/0", timeout=0.05)
+    cache = TieredCache(LocalCache(), shared, ttl=60)
+
+    start_time = time.perf_counter()
+    assert await cache.get("key") is None
+    assert time.perf_counter() - start_time < 1.0
+    assert not cache.shared_available
+
+    # Skipped until it's retried, so the following lookups don't wait
+    start_time = time.perf_counter()
+    for _ in range(10):
+        assert await cache.get("key") is None
+    assert time.perf_counter() - start_time < 0.05
+
+    await cache.stop()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_redis_cache_pool():
+    """Test that concurrent commands use the connections of the pool."""
+    pytest.importorskip("redis")
+    stand_in = RedisStandIn(delay=0.01)
+    url = await stand_in.start()
+    shared = RedisCache(url, pool_size=3, timeout=5)
+
+    await shared.set_many({"key": b"value"}, ttl=60)
+    values = await asyncio.gather(*[shared.get("key") for _ in range(12)])
+    assert values == [b"value"] * 12
+    assert stand_in.connections == 3
+
+    await shared.close()
+    await stand_in.stop()
+
+
+@pytest.mark.asyncio
+async def test_manager_with_cache():
+    """Test that the manager serves lookups from the cache and invalidates them."""
+    user_cache = build_user_cache("memory://", ttl=60, max_entries=100)
+    assert isinstance(user_cache, UserCache)
+
+    test_session = AsyncSession(engine)
+    manager = DatabaseManager(test_session, cache=user_cache)
+    cached_user = UserEntry(
+        uuid=uuid4(),
+        role=Role.normal,
+        username="cached_user",
+        email="cached_user@email.com",
+        name="name",
+        surname="surname",
+        hashed_password=hash_password("password"),
+    )
+    test_session.add(cached_user)
+    await test_session.commit()
+
+    await manager.get_user(username="cached_user")
+    await test_session.close()
+
+    executed_statements.clear()
+    test_session = AsyncSession(engine)
+    manager = DatabaseManager(test_session, cache=user_cache)
+    found_user = await manager.get_user(email="cached_user@email.com")
+    assert found_user.uuid == cached_user.uuid
+    assert found_user.role == Role.normal
+    assert executed_statements == []
+
+    # The password hash isn't cached, it's read when authenticating
+    local_entries = user_cache.cache.local._entries.values()
+    assert all(b"hashed_password" not in value for value, _ in local_entries)
+    assert await manager.authenticate_user("cached_user", "password") == found_user
+    assert await manager.authenticate_user("cached_user", "wrong") is None
+
+    updated_user = await manager.update_user(
+        uuid=cached_user.uuid,
+        new_username="renamed_cached_user",
+    )
+    assert updated_user.username == "renamed_cached_user"
+    await test_session.close()
+
+    test_session = AsyncSession(engine)
+    manager = DatabaseManager(test_session, cache=user_cache)
+    assert await manager.get_user(username="cached_user") is None
+    found_user = await manager.get_user(uuid=cached_user.uuid)
+    assert found_user.username == "renamed_cached_user"
+    await test_session.close()
@@ -0,0 +1,140 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from userauth.common.roles import Role
+from userauth.database.importer import import_users, load_checkpoint
+from userauth.database.manager import verify_password
+from userauth.database.models import Base, UserEntry
+
+################################################################################
+# SETUP DB IN MEMORY
+################################################################################
+
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite://"
+
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+async def create_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+asyncio.run(create_db())
+
+################################################################################
+# UNIT TESTS
+################################################################################
+
+
+def write_records(filepath, prefix, count):
+    with open(filepath, "w") as fileobj:
+        for idx in range(count):
+            record = {
+                "username": f"{prefix}_{idx}",
+                "email": f"{prefix}_{idx}@email.com",
+                "name": "name",
+                "surname": "surname",
+                "hashed_password": "prehashed",
+            }
+            if idx == 0:
+                record.pop("hashed_password")
+                record["password"] = "password"
+                record["role"] = "celebrity"
+            fileobj.write(json.dumps(record) + "\n")
+
+
+@pytest.mark.asyncio
+async def test_import_users(tmp_path):
+    """Test that users are imported and passwords hashed when needed."""
+    filepath = tmp_path / "users.jsonl"
+    write_records(filepath, "imported", 7)
+
+    reported = []
+    progress = await import_users(
+        engine,
+        filepath,
+        "jsonl",
+        batch_size=3,
+        workers=1,
+        progress_callback=reported.append,
+    )
+    assert progress.records_done == 7
+    assert [report.records_done for report in reported] == [3, 6, 7]
+
+    test_session = AsyncSession(engine)
+    querystr = select(UserEntry).filter(UserEntry.username.like("imported_%"))
+    results = (await test_session.execute(querystr)).scalars().all()
+    assert len(results) == 7
+
+    users = {user.username: user for user in results}
+    assert users["imported_0"].role == Role.celebrity
+    assert verify_password("password", users["imported_0"].hashed_password)
+    assert users["imported_1"].role == Role.normal
+    assert users["imported_1"].hashed_password == "prehashed"
+
+    await test_session.close()
+
+
+@pytest.mark.asyncio
+async def test_import_users_resume(tmp_path):
+    """Test that an import resumes from its checkpoint."""
+    filepath = tmp_path / "users.jsonl"
+    checkpoint_path = tmp_path / "users.checkpoint"
+    write_records(filepath, "resumed", 5)
+    checkpoint_path.write_text(json.dumps({"records_done": 3}))
+
+    progress = await import_users(
+        engine,
+        filepath,
+        "jsonl",
+        batch_size=10,
+        workers=1,
+        checkpoint_path=checkpoint_path,
+    )
+    assert progress.records_skipped == 3
+    assert progress.records_done == 5
+    assert load_checkpoint(checkpoint_path) == 5
+
+    test_session = AsyncSession(engine)
+    querystr = select(UserEntry.username).filter(UserEntry.username.like("resumed_%"))
+    usernames = set((await test_session.execute(querystr)).scalars().all())
+    assert usernames == {"resumed_3", "resumed_4"}
+
+    await test_session.close()
+
+
+@pytest.mark.asyncio
+async def test_import_users_invalid_role(tmp_path):
+    """Test that an unknown role is reported with the number of the record."""
+    filepath = tmp_path / "users.jsonl"
+    write_records(filepath, "badrole", 3)
+    lines = filepath.read_text().splitlines()
+    record = json.loads(lines[1])
+    record["role"] = "emperor"
+    lines[1] = json.dumps(record)
+    filepath.write_text("\n".join(lines) + "\n")
+
+    with pytest.raises(ValueError, match="record 2 has an invalid role `emperor`"):
+        await import_users(engine, filepath, "jsonl", batch_size=10, workers=1)
+
+
+@pytest.mark.asyncio
+async def test_import_users_insert_failure(tmp_path):
+    """Test that a failed insert doesn't leave the next batch being prepared."""
+    filepath = tmp_path / "users.jsonl"
+    write_records(filepath, "duplicated", 4)
+    filepath.write_text(3 * filepath.read_text())
+
+    with pytest.raises(Exception):
+        await import_users(engine, filepath, "jsonl", batch_size=4, workers=1)
+    assert asyncio.all_tasks() == {asyncio.current_task()}
@@ -0,0 +1,121 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from userauth.common.roles import Role
+from userauth.database.manager import DatabaseManager
+from userauth.database.models import Base, UserEntry
+
+################################################################################
+# SETUP DB IN MEMORY
+################################################################################
+
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite://"
+
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+async def create_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+asyncio.run(create_db())
+
+executed_statements = []
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, *args):
+    executed_statements.append(statement)
+
+
+def selected_statements():
+    return [statement for statement in executed_statements if "SELECT" in statement]
+
+
+async def add_users(session, prefix, count):
+    users = [
+        UserEntry(
+            uuid=uuid4(),
+            role=Role.normal,
+            username=f"{prefix}_{idx}",
+            email=f"{prefix}_{idx}@email.com",
+            name="name",
+            surname="surname",
+            hashed_password="password",
+        )
+        for idx in range(count)
+    ]
+    session.add_all(users)
+    await session.commit()
+    return users
+
+
+################################################################################
+# UNIT TESTS
+################################################################################
+
+
+@pytest.mark.asyncio
+async def test_memoized_lookups():
+    """Test that repeated lookups by any key only query the database once."""
+    async with AsyncSession(engine, expire_on_commit=False) as setup_session:
+        (loaded_user,) = await add_users(setup_session, "memo_user", 1)
+
+    test_session = AsyncSession(engine, expire_on_commit=False)
+    manager = DatabaseManager(test_session)
+    executed_statements.clear()
+
+    found_user = await manager.get_user(username="memo_user_0")
+    assert found_user.uuid == loaded_user.uuid
+    assert await manager.get_user(uuid=loaded_user.uuid) is found_user
+    assert await manager.get_user(email="memo_user_0@email.com") is found_user
+    assert await manager.get_user(username="missing_user") is None
+    assert await manager.get_user(username="missing_user") is None
+    assert len(selected_statements()) == 2
+
+    # Writes update the memoized keys without reloading the user
+    executed_statements.clear()
+    updated_user = await manager.update_user(
+        uuid=loaded_user.uuid,
+        new_username="memo_user_renamed",
+    )
+    assert updated_user.username == "memo_user_renamed"
+    assert await manager.get_user(username="memo_user_renamed") is updated_user
+    assert selected_statements() == []
+    assert await manager.get_user(username="memo_user_0") is None
+
+    await manager.delete_user(uuid=loaded_user.uuid)
+    assert await manager.get_user(uuid=loaded_user.uuid) is None
+    await test_session.close()
+
+
+@pytest.mark.asyncio
+async def test_batched_lookups():
+    """Test that concurrent lookups are resolved with a single query."""
+    async with AsyncSession(engine, expire_on_commit=False) as setup_session:
+        batch_users = await add_users(setup_session, "batch_user", 3)
+
+    test_session = AsyncSession(engine, expire_on_commit=False)
+    manager = DatabaseManager(test_session)
+    executed_statements.clear()
+
+    lookups = [manager.get_user(uuid=user.uuid) for user in batch_users]
+    lookups.append(manager.get_user(uuid=uuid4()))
+    found_users = await asyncio.gather(*lookups)
+    assert [user.uuid for user in found_users[:3]] == [
+        user.uuid for user in batch_users
+    ]
+    assert found_users[3] is None
+    assert len(selected_statements()) == 1
+
+    await test_session.close()
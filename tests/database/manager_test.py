@@ -1,4 +1,5 @@
 import asyncio
+from datetime import datetime, timedelta
 from uuid import uuid4
 
 import pytest
@@ -55,6 +56,45 @@ async def test_create_user():
     await test_session.close()
 
 
+@pytest.mark.asyncio
+async def test_create_user_conflict():
+    """Test that a registration racing another one is rejected."""
+    test_session = AsyncSession(engine, expire_on_commit=False)
+    manager = DatabaseManager(test_session)
+    created_user = await manager.create_user(
+        "racing_user", "password", "racing_user@email.com"
+    )
+    assert created_user is not None
+    created_user = await manager.create_user(
+        "racing_user", "password", "other_racing_user@email.com"
+    )
+    assert created_user is None
+    await test_session.close()
+
+
+@pytest.mark.asyncio
+async def test_is_registered():
+    """Test the availability checks of usernames and emails."""
+    test_session = AsyncSession(engine, expire_on_commit=False)
+    manager = DatabaseManager(test_session)
+    created_user = await manager.create_user(
+        "registered_user", "password", "registered_user@email.com"
+    )
+
+    assert await manager.is_registered("username", "registered_user")
+    assert await manager.is_registered("email", "registered_user@email.com")
+    assert not await manager.is_registered("username", "free_user")
+    assert not await manager.is_registered("email", "free_user@email.com")
+
+    await manager.update_user(uuid=created_user.uuid, new_username="renamed_user")
+    assert await manager.is_registered("username", "renamed_user")
+    assert not await manager.is_registered("username", "registered_user")
+
+    with pytest.raises(ValueError):
+        await manager.is_registered("uuid", str(created_user.uuid))
+    await test_session.close()
+
+
 @pytest.mark.asyncio
 async def test_get_users():
     """Test that users can fetched from the database."""
@@ -91,6 +131,9 @@ async def test_get_users():
     assert user_1 in all_users
     assert user_2 in all_users
 
+    some_users = await manager.get_users(uuids=[user_2.uuid, uuid4()])
+    assert some_users == [user_2]
+
     one_user = await manager.get_user(uuid=user_1.uuid)
     assert one_user.uuid == user_1.uuid
 
@@ -103,6 +146,97 @@ async def test_get_users():
     await test_session.close()
 
 
+@pytest.mark.asyncio
+async def test_search_users():
+    """Test that users can be searched by prefix and by similarity."""
+    test_session = AsyncSession(engine, autocommit=False, autoflush=False)
+    manager = DatabaseManager(test_session)
+
+    for username, name, surname in [
+        ("searchable_walker", "Alice", "Zebulon"),
+        ("searchable_zed", "Zebulon", "Walker"),
+        ("zebra_searchable", "Walker", "Smith"),
+    ]:
+        test_session.add(
+            UserEntry(
+                uuid=uuid4(),
+                role=Role.normal,
+                username=username,
+                email=f"{username}@email.com",
+                name=name,
+                surname=surname,
+                hashed_password="password",
+            )
+        )
+    await test_session.commit()
+
+    results = await manager.search_users("SEARCHABLE")
+    assert [user.username for user in results] == [
+        "searchable_walker",
+        "searchable_zed",
+    ]
+
+    results = await manager.search_users("zeb")
+    assert [user.username for user in results] == [
+        "zebra_searchable",
+        "searchable_zed",
+        "searchable_walker",
+    ]
+
+    results = await manager.search_users("zeb", limit=1, offset=1)
+    assert [user.username for user in results] == ["searchable_zed"]
+
+    results = await manager.search_users("zebulom", fuzzy=True)
+    assert {user.username for user in results} == {
+        "searchable_walker",
+        "searchable_zed",
+    }
+
+    created_user = await manager.create_user(
+        username="zebulom",
+        password="password",
+        email="zebulom@email.com",
+    )
+    results = await manager.search_users("zebulom", fuzzy=True)
+    assert results[0].uuid == created_user.uuid
+
+    await test_session.close()
+
+
+@pytest.mark.asyncio
+async def test_search_users_shared_database(monkeypatch):
+    """Test that postgres without pg_trgm doesn't use the in-process index."""
+    monkeypatch.setattr(DatabaseManager, "dialect_name", "postgresql")
+    test_session = AsyncSession(engine, autocommit=False, autoflush=False)
+    manager = DatabaseManager(test_session)
+
+    for username, name, surname in [
+        ("contained_walker", "Alice", "Quixotica"),
+        ("contained_zed", "Quixotica", "Walker"),
+    ]:
+        test_session.add(
+            UserEntry(
+                uuid=uuid4(),
+                role=Role.normal,
+                username=username,
+                email=f"{username}@email.com",
+                name=name,
+                surname=surname,
+                hashed_password="password",
+            )
+        )
+    await test_session.commit()
+
+    results = await manager.search_users("XOTIC", fuzzy=True)
+    assert [user.username for user in results] == [
+        "contained_zed",
+        "contained_walker",
+    ]
+    assert await manager.search_users("quixotika", fuzzy=True) == []
+
+    await test_session.close()
+
+
 @pytest.mark.asyncio
 async def test_update_user():
     """Test that users can be updated."""
@@ -147,6 +281,42 @@ async def test_update_user():
     await test_session.close()
 
 
+@pytest.mark.asyncio
+async def test_update_user_stale():
+    """Test that updates of stale copies of a user fail without a write."""
+    test_session = AsyncSession(engine, autocommit=False, autoflush=False)
+    manager = DatabaseManager(test_session)
+    stale_user = UserEntry(
+        uuid=uuid4(),
+        role=Role.normal,
+        username="stale_user",
+        email="stale_user@email.com",
+        name="name",
+        surname="surname",
+        hashed_password="password",
+    )
+    user_uuid = stale_user.uuid
+    test_session.add(stale_user)
+    await test_session.commit()
+    assert (await manager.get_user(uuid=user_uuid)).version == 1
+
+    # Updated elsewhere while this manager holds the first version
+    other_session = AsyncSession(engine, autocommit=False, autoflush=False)
+    other_manager = DatabaseManager(other_session)
+    await other_manager.update_user(uuid=user_uuid, new_username="renamed")
+    await other_session.close()
+
+    assert await manager.update_user(uuid=user_uuid, new_role=Role.admin) is None
+
+    # The stale copy is dropped, so retrying reads the current version
+    output_user = await manager.update_user(uuid=user_uuid, new_role=Role.admin)
+    assert output_user.role == Role.admin
+    assert output_user.username == "renamed"
+    assert output_user.version == 3
+
+    await test_session.close()
+
+
 @pytest.mark.asyncio
 async def test_delete_user():
     """Test that users can be deleted."""
@@ -310,4 +480,201 @@ async def test_get_logins():
     assert login_02 in login_records
     assert login_alt in login_records
 
+    login_records = await manager.get_logins(uuids=[login_02.uuid, login_alt.uuid])
+    assert set(login_records) == {login_02, login_alt}
+
+    await test_session.close()
+
+
+@pytest.mark.asyncio
+async def test_get_logins_filtered():
+    """Test logins can be filtered by time and sorted."""
+    test_session = AsyncSession(
+        engine,
+        autocommit=False,
+        autoflush=False,
+        expire_on_commit=False,
+    )
+    manager = DatabaseManager(test_session)
+
+    filtered_user = UserEntry(
+        uuid=uuid4(),
+        role=Role.celebrity,
+        username="filtered_user",
+        email="filtered_user@email.com",
+        name="name",
+        surname="surname",
+        hashed_password="password",
+    )
+    test_session.add(filtered_user)
+    await test_session.commit()
+
+    reference_time = datetime(2001, 1, 1)
+    logins = [
+        LoginEntry(
+            uuid=uuid4(),
+            user=filtered_user.uuid,
+            ctime=reference_time + timedelta(hours=hours),
+        )
+        for hours in (2, 0, 1)
+    ]
+    test_session.add_all(logins)
+    await test_session.commit()
+
+    login_records = await manager.get_logins(
+        user_uuid=filtered_user.uuid,
+        ctime_from=reference_time,
+        ctime_to=reference_time + timedelta(hours=2),
+        sort="-ctime",
+    )
+    assert [login.uuid for login in login_records] == [
+        logins[2].uuid,
+        logins[1].uuid,
+    ]
+
+    login_records = await manager.get_logins(
+        ctime_to=reference_time + timedelta(hours=3),
+        sort="ctime",
+    )
+    assert [login.uuid for login in login_records] == [
+        logins[1].uuid,
+        logins[2].uuid,
+        logins[0].uuid,
+    ]
+
+    celebrities = await manager.get_users(role=Role.celebrity, sort="-username")
+    assert filtered_user in celebrities
+    assert all(user.role == Role.celebrity for user in celebrities)
+
+    with pytest.raises(ValueError):
+        await manager.get_users(sort="password")
+
+    await test_session.close()
+
+
+@pytest.mark.asyncio
+async def test_scoped_queries():
+    """Test that scope predicates hide the rows of other users."""
+    test_session = AsyncSession(
+        engine,
+        autocommit=False,
+        autoflush=False,
+        expire_on_commit=False,
+    )
+    manager = DatabaseManager(test_session)
+
+    scoped_users = [
+        UserEntry(
+            uuid=uuid4(),
+            role=Role.normal,
+            username=f"scoped_user_{idx}",
+            email=f"scoped_user_{idx}@email.com",
+            name="name",
+            surname="surname",
+            hashed_password="password",
+        )
+        for idx in range(2)
+    ]
+    test_session.add_all(scoped_users)
+    await test_session.commit()
+    first_login = await manager.record_login(scoped_users[0])
+
+    first_scope = UserEntry.uuid == scoped_users[0].uuid
+    user_logins = await manager.get_user_logins(
+        scoped_users[0].uuid,
+        scope=first_scope,
+    )
+    assert [login.uuid for login in user_logins] == [first_login.uuid]
+
+    user_logins = await manager.get_user_logins(scoped_users[1].uuid)
+    assert user_logins == []
+
+    user_logins = await manager.get_user_logins(
+        scoped_users[1].uuid,
+        scope=first_scope,
+    )
+    assert user_logins is None
+    assert await manager.get_user_logins(uuid4()) is None
+
+    found_login = await manager.get_login(
+        first_login.uuid,
+        scope=LoginEntry.user == scoped_users[1].uuid,
+    )
+    assert found_login is None
+    found_login = await manager.get_login(
+        first_login.uuid,
+        user_uuid=scoped_users[1].uuid,
+    )
+    assert found_login is None
+
+    found_users = await manager.get_users(
+        uuids=[user.uuid for user in scoped_users],
+        scope=UserEntry.uuid == scoped_users[1].uuid,
+    )
+    assert [user.uuid for user in found_users] == [scoped_users[1].uuid]
+
+    await test_session.close()
+
+
+################################################################################
+# UNIT TESTS - JOBS
+################################################################################
+
+
+@pytest.mark.asyncio
+async def test_jobs():
+    """Test that jobs are stored, updated and deleted with their user."""
+    from userauth.common.jobs import JobStatus
+    from userauth.database.models import JobEntry
+
+    test_session = AsyncSession(engine, expire_on_commit=False)
+    manager = DatabaseManager(test_session)
+
+    job_user = UserEntry(
+        uuid=uuid4(),
+        role=Role.normal,
+        username="job_user",
+        email="job_user@email.com",
+        name="name",
+        surname="surname",
+        hashed_password="password",
+    )
+    test_session.add(job_user)
+    await test_session.commit()
+
+    first_job = await manager.create_job(job_user.uuid, "test", b"first input")
+    second_job = await manager.create_job(job_user.uuid, "test", bytearray(b"two"))
+    assert first_job.status == JobStatus.pending
+    claimable_jobs = await manager.get_claimable_jobs()
+    assert {first_job.uuid, second_job.uuid} <= set(claimable_jobs)
+
+    loaded_job = await manager.get_job(second_job.uuid, with_payload=True)
+    assert loaded_job.payload == b"two"
+    scope = JobEntry.user == uuid4()
+    assert await manager.get_job(second_job.uuid, scope=scope) is None
+
+    # Only one process claims a job, until its lease expires
+    claimed_job = await manager.claim_job(first_job.uuid, "first", 60)
+    assert claimed_job.status == JobStatus.running
+    assert claimed_job.owner == "first"
+    assert claimed_job.payload == b"first input"
+    assert await manager.claim_job(first_job.uuid, "second", 60) is None
+    assert first_job.uuid not in await manager.get_claimable_jobs()
+
+    await manager.release_jobs("first")
+    assert (await manager.get_job(first_job.uuid)).status == JobStatus.pending
+    await manager.claim_job(first_job.uuid, "first", -1)
+    assert first_job.uuid in await manager.get_claimable_jobs()
+    claimed_job = await manager.claim_job(first_job.uuid, "second", 60)
+    assert claimed_job.owner == "second"
+
+    await manager.update_job(second_job, JobStatus.succeeded, result={"ok": True})
+    assert second_job.payload is None
+    assert second_job.result == {"ok": True}
+    assert await manager.claim_job(second_job.uuid, "first", 60) is None
+    assert second_job.uuid not in await manager.get_claimable_jobs()
+
+    await manager.delete_user(uuid=job_user.uuid)
+    assert await manager.get_job(first_job.uuid) is None
+
     await test_session.close()
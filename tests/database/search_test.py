@@ -0,0 +1,104 @@
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import delete, text, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from userauth.common.roles import Role
+from userauth.database.models import Base, UserEntry
+from userauth.database.search import TrigramIndex, similarity, trigrams
+
+################################################################################
+# UNIT TESTS
+################################################################################
+
+
+def test_trigrams():
+    """Test that trigrams follow the pg_trgm conventions."""
+    assert trigrams("Cat") == {"  c", " ca", "cat", "at "}
+    assert trigrams("a b") == {"  a", " a ", "  b", " b "}
+    assert similarity(trigrams("cat"), trigrams("cat")) == 1.0
+    assert similarity(trigrams("cat"), trigrams("dog")) == 0.0
+
+
+def test_trigram_index():
+    """Test that the index ranks by similarity and follows updates."""
+    index = TrigramIndex()
+    tom, tim, ann = uuid4(), uuid4(), uuid4()
+    index.add(tom, "tcruise", "Tom", "Cruise")
+    index.add(tim, "tcook", "Tim", "Cook")
+    index.add(ann, "amorgan", "Ann", "Morgan")
+
+    matches = index.search("cruse", limit=10)
+    assert [uuid for uuid, _ in matches] == [tom]
+
+    matches = index.search("tcoo", limit=10)
+    assert matches[0][0] == tim
+
+    index.add(tom, "tmapother", "Tom", "Mapother")
+    assert index.search("cruise", limit=10) == []
+    assert [uuid for uuid, _ in index.search("mapother", limit=10)] == [tom]
+
+    index.remove(tom)
+    assert len(index) == 2
+    assert index.search("mapother", limit=10) == []
+
+
+@pytest.mark.asyncio
+async def test_trigram_index_other_process(tmp_path):
+    """Test that the index catches up with the writes of other processes."""
+    database_url = f"sqlite+aiosqlite:///{tmp_path / 'users.db'}"
+    # One engine per "worker process", sharing the database file
+    engine = create_async_engine(database_url)
+    other_engine = create_async_engine(database_url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async def write(statement):
+        async with other_engine.begin() as conn:
+            await conn.execute(statement)
+
+    tom, tim = uuid4(), uuid4()
+    for uuid, username, name, surname in [
+        (tom, "tcruise", "Tom", "Cruise"),
+        (tim, "tcook", "Tim", "Cook"),
+    ]:
+        await write(
+            UserEntry.__table__.insert().values(
+                uuid=uuid,
+                role=Role.normal,
+                username=username,
+                email=f"{username}@email.com",
+                name=name,
+                surname=surname,
+                hashed_password="password",
+            )
+        )
+
+    index = TrigramIndex()
+    async with AsyncSession(engine) as session:
+        await index.sync(session)
+    assert [uuid for uuid, _ in index.search("cruse", limit=10)] == [tom]
+
+    await write(
+        update(UserEntry)
+        .where(UserEntry.uuid == tom)
+        .values(username="tmapother", surname="Mapother")
+    )
+    await write(delete(UserEntry).where(UserEntry.uuid == tim))
+    async with AsyncSession(engine) as session:
+        await index.sync(session)
+    assert index.search("cruise", limit=10) == []
+    assert [uuid for uuid, _ in index.search("mapother", limit=10)] == [tom]
+    assert len(index) == 1
+
+    # Changes pruned before the index saw them: it is built again
+    await write(update(UserEntry).where(UserEntry.uuid == tom).values(surname="Cruise"))
+    await write(text("DELETE FROM user_search_changes"))
+    await write(update(UserEntry).where(UserEntry.uuid == tom).values(name="Thomas"))
+    async with AsyncSession(engine) as session:
+        await index.sync(session)
+    assert [uuid for uuid, _ in index.search("cruise", limit=10)] == [tom]
+
+    await engine.dispose()
+    await other_engine.dispose()
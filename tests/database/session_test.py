@@ -0,0 +1,111 @@
+import pytest
+from sqlalchemy import inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from userauth.database import session
+from userauth.database.migrations import SchemaMigrationError, schema_differences
+from userauth.database.models import UserEntry, schema_fingerprint
+from userauth.database.session import ensure_schema, stored_schema_version
+
+
+@pytest.mark.asyncio
+async def test_ensure_schema():
+    """Test that the schema is only created when its version changes."""
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    assert await ensure_schema(engine)
+    async with engine.connect() as conn:
+        table_names = await conn.run_sync(
+            lambda connection: inspect(connection).get_table_names()
+        )
+        assert {"users", "logins", "jobs"} <= set(table_names)
+        assert await conn.run_sync(stored_schema_version) == schema_fingerprint()
+
+    # Up to date: nothing to create
+    assert not await ensure_schema(engine)
+
+    # A different version (for example, after an upgrade) migrates it again
+    async with engine.begin() as conn:
+        await conn.execute(text("UPDATE schema_version SET version = 'old'"))
+    assert await ensure_schema(engine)
+    async with engine.connect() as conn:
+        assert await conn.run_sync(stored_schema_version) == schema_fingerprint()
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_ensure_schema_adds_columns():
+    """Test that the columns added to existing tables are migrated."""
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    # Users table of the first versions (without the row version)
+    async with engine.begin() as conn:
+        await conn.execute(
+            text(
+                "CREATE TABLE users (uuid CHAR(32) NOT NULL PRIMARY KEY, "
+                "role VARCHAR(9), username VARCHAR, email VARCHAR, name VARCHAR, "
+                "surname VARCHAR, ctime TIMESTAMP DEFAULT (CURRENT_TIMESTAMP), "
+                "hashed_password VARCHAR)"
+            )
+        )
+        await conn.execute(
+            text(
+                "INSERT INTO users VALUES ('0123456789abcdef0123456789abcdef', "
+                "'normal', 'old_user', 'old_user@email.com', 'name', 'surname', "
+                "CURRENT_TIMESTAMP, 'password')"
+            )
+        )
+
+    assert await ensure_schema(engine)
+    async with AsyncSession(engine) as test_session:
+        users = (await test_session.execute(select(UserEntry))).scalars().all()
+        assert [(user.username, user.version) for user in users] == [("old_user", 1)]
+    # And the triggers recording the changes for the search index
+    async with engine.connect() as conn:
+        triggers = await conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        )
+        assert len(triggers.all()) == 4
+
+    # Indexes missing from existing tables are created (even on expressions)
+    async with engine.begin() as conn:
+        await conn.execute(text("DROP INDEX ix_users_username_lower"))
+        await conn.execute(text("DROP INDEX ix_jobs_status_ctime"))
+        await conn.execute(text("UPDATE schema_version SET version = 'old'"))
+    assert await ensure_schema(engine)
+    async with engine.connect() as conn:
+        assert await conn.run_sync(schema_differences) == []
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_ensure_schema_mismatch():
+    """Test that a schema that can't be migrated is not marked as current."""
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    # Logins without their user, which can't be filled in for existing rows
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE logins (uuid CHAR(32) PRIMARY KEY)"))
+
+    with pytest.raises(SchemaMigrationError, match="logins.user"):
+        await ensure_schema(engine)
+    async with engine.connect() as conn:
+        assert await conn.run_sync(stored_schema_version) is None
+    await engine.dispose()
+
+
+def test_lazy_engine():
+    """Test that the engine is created on first use, and then shared."""
+    engine = session.get_engine()
+    assert session.engine is engine
+    assert session.get_engine() is engine
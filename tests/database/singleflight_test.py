@@ -0,0 +1,132 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from userauth.common.metrics import sample_value
+from userauth.common.roles import Role
+from userauth.database.manager import DatabaseManager
+from userauth.database.models import Base, UserEntry
+from userauth.database.singleflight import SingleFlight, build_single_flight
+
+################################################################################
+# SETUP DB IN MEMORY
+################################################################################
+
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite://"
+
+engine = create_async_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+async def create_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+asyncio.run(create_db())
+
+executed_statements = []
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, *args):
+    executed_statements.append(statement)
+
+
+################################################################################
+# UNIT TESTS
+################################################################################
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    """Test that concurrent lookups of the same key share one call."""
+    single_flight = SingleFlight(["test"])
+    calls = []
+
+    async def slow_lookup(keys):
+        calls.append(keys)
+        await asyncio.sleep(0.01)
+        return {key: f"value of {key[1]}" for key in keys if key[1] != "missing"}
+
+    coalesced_before = sample_value(
+        "userauth_singleflight_lookups_total", scope="test", outcome="coalesced"
+    )
+    results = await asyncio.gather(
+        single_flight.do_many([("test", "a")], slow_lookup),
+        single_flight.do_many([("test", "a"), ("test", "b")], slow_lookup),
+        single_flight.do_many([("test", "missing")], slow_lookup),
+    )
+    assert calls == [[("test", "a")], [("test", "b")], [("test", "missing")]]
+    assert results[1] == {("test", "a"): "value of a", ("test", "b"): "value of b"}
+    assert results[2] == {("test", "missing"): None}
+    coalesced = sample_value(
+        "userauth_singleflight_lookups_total", scope="test", outcome="coalesced"
+    )
+    assert coalesced - coalesced_before == 1
+
+    # Flights are only shared while in progress
+    await single_flight.do_many([("test", "a")], slow_lookup)
+    assert len(calls) == 4
+
+    async def failing_lookup(keys):
+        await asyncio.sleep(0.01)
+        raise RuntimeError("lookup failed")
+
+    results = await asyncio.gather(
+        single_flight.do_many([("test", "c")], failing_lookup),
+        single_flight.do_many([("test", "c")], failing_lookup),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    assert build_single_flight("") is None
+    assert build_single_flight("uuid, username").covers("username")
+
+
+@pytest.mark.asyncio
+async def test_manager_single_flight():
+    """Test that concurrent requests share the query of the same user."""
+    async with AsyncSession(engine, expire_on_commit=False) as setup_session:
+        hot_user = UserEntry(
+            uuid=uuid4(),
+            role=Role.normal,
+            username="hot_user",
+            email="hot_user@email.com",
+            name="name",
+            surname="surname",
+            hashed_password="password",
+        )
+        setup_session.add(hot_user)
+        await setup_session.commit()
+
+    single_flight = SingleFlight(["username"])
+    sessions = [AsyncSession(engine) for _ in range(5)]
+    managers = [
+        DatabaseManager(session, single_flight=single_flight) for session in sessions
+    ]
+
+    executed_statements.clear()
+    found_users = await asyncio.gather(
+        *[manager.get_user(username="hot_user") for manager in managers]
+    )
+    assert len(executed_statements) == 1
+    assert all(user.uuid == hot_user.uuid for user in found_users)
+    assert len({id(user) for user in found_users}) == len(managers)
+
+    # Adopted entries belong to each session and can be modified
+    updated_user = await managers[1].update_user(
+        uuid=hot_user.uuid,
+        new_username="renamed_hot_user",
+    )
+    assert updated_user.username == "renamed_hot_user"
+
+    for session in sessions:
+        await session.close()
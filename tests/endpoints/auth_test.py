@@ -8,6 +8,7 @@ from userauth.database.models import UserEntry
 from userauth.endpoints.auth import (
     create_access_token,
     get_current_active_user,
+    get_users_availability,
     login_for_access_token,
     post_users,
 )
@@ -46,6 +47,9 @@ async def test_post_users():
         async def get_user(self, **kwargs):
             return None
 
+        async def is_registered(self, field, value):
+            return False
+
         async def create_user(self, *args, **kwargs):
             self.user_created = True
             return UserEntry(
@@ -92,6 +96,9 @@ async def test_post_users_existing():
         async def get_user(self, **kwargs):
             return self.reference_user
 
+        async def is_registered(self, field, value):
+            return True
+
         async def create_user(self, *args, **kwargs):
             self.user_created = True
             return self.reference_user
@@ -110,6 +117,34 @@ async def test_post_users_existing():
     assert excinfo.value.status_code == status.HTTP_409_CONFLICT
 
 
+@pytest.mark.asyncio
+async def test_get_users_availability():
+    """Test the availability of usernames and emails."""
+
+    class MockedManager:
+        async def is_registered(self, field, value):
+            return value in ("taken_username", "taken@email.com")
+
+    result = await get_users_availability(
+        username="taken_username",
+        email="free@email.com",
+        dbmanager=MockedManager(),
+    )
+    assert result.username is False
+    assert result.email is True
+
+    result = await get_users_availability(
+        username="free_username",
+        dbmanager=MockedManager(),
+    )
+    assert result.username is True
+    assert result.email is None
+
+    with pytest.raises(HTTPException) as excinfo:
+        await get_users_availability(dbmanager=MockedManager())
+    assert excinfo.value.status_code == status.HTTP_400_BAD_REQUEST
+
+
 @pytest.mark.asyncio
 async def test_login_for_access_token():
     """Test the login method."""
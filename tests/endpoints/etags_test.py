@@ -0,0 +1,35 @@
+from datetime import datetime
+from uuid import uuid4
+
+from userauth.endpoints.etags import etag_matches, logins_etag, user_etag
+
+
+def test_user_etag():
+    """Test that the user tag changes with the row version."""
+    user_uuid = uuid4()
+    assert user_etag(user_uuid, 1) == user_etag(user_uuid, 1)
+    assert user_etag(user_uuid, 1) != user_etag(user_uuid, 2)
+    assert user_etag(user_uuid, 1) != user_etag(uuid4(), 1)
+    assert user_etag(user_uuid, 1).startswith('W/"')
+
+
+def test_logins_etag():
+    """Test that the logins tag changes with new logins."""
+    user_uuid = uuid4()
+    first_login = datetime(2023, 1, 1)
+    second_login = datetime(2023, 1, 2)
+    assert logins_etag(user_uuid, 1, first_login) != logins_etag(
+        user_uuid, 2, second_login
+    )
+    assert logins_etag(user_uuid, 0, None) != logins_etag(user_uuid, 1, first_login)
+
+
+def test_etag_matches():
+    """Test the weak comparison of If-None-Match headers."""
+    etag = user_etag(uuid4(), 3)
+    assert etag_matches(etag, etag)
+    assert etag_matches(etag.removeprefix("W/"), etag)
+    assert etag_matches(f'"other", {etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"other"', etag)
+    assert not etag_matches(None, etag)
@@ -0,0 +1,208 @@
+import asyncio
+import importlib
+from contextlib import asynccontextmanager
+from io import BytesIO
+from uuid import UUID, uuid4
+
+import pytest
+from fastapi import HTTPException, UploadFile, status
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from userauth.common.jobs import JobStatus
+from userauth.common.roles import Role
+from userauth.database.manager import DatabaseManager
+from userauth.database.models import Base, UserEntry
+from userauth.endpoints.errors import UNRECOGNIZED_CELEBRITY_ERROR
+from userauth.endpoints.jobs import JobRunner
+from userauth.endpoints.resources import (
+    VALIDATE_PHOTO_JOB,
+    get_jobs_id,
+    post_users_id_validate,
+    run_validate_photo_job,
+)
+from userauth.picmodel import InferenceScheduler, PhotoResultCache
+from userauth.picmodel.preprocessing import synthetic_image
+
+pytest_plugins = ("pytest_asyncio",)
+
+# The package exports the router under the same name as the module
+resources_module = importlib.import_module("userauth.endpoints.resources")
+
+################################################################################
+# SETUP DB IN MEMORY
+################################################################################
+
+engine = create_async_engine(
+    "sqlite+aiosqlite://",
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+)
+
+
+async def create_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+asyncio.run(create_db())
+
+
+@asynccontextmanager
+async def open_manager():
+    session = AsyncSession(engine, expire_on_commit=False)
+    try:
+        yield DatabaseManager(session)
+    finally:
+        await session.close()
+
+
+async def create_test_user(role: Role = Role.normal) -> UserEntry:
+    user_uuid = uuid4()
+    user = UserEntry(
+        uuid=user_uuid,
+        role=role,
+        username=f"user_{user_uuid.hex}",
+        email=f"{user_uuid.hex}@email.com",
+        name="Tom",
+        surname="Cruise",
+        hashed_password="password",
+    )
+    async with open_manager() as dbmanager:
+        dbmanager._session.add(user)
+        await dbmanager._session.commit()
+    return user
+
+
+################################################################################
+# UNIT TESTS
+################################################################################
+
+
+@pytest.mark.asyncio
+async def test_job_runner():
+    """Test that jobs run in the background and are resumed on start."""
+    user = await create_test_user()
+    # A single worker, and nothing else running meanwhile: the sessions
+    # share the only connection of the pool
+    runner = JobRunner(workers=1, manager_factory=open_manager)
+
+    async def echo_job(job, dbmanager):
+        if job.payload == b"fail":
+            raise UNRECOGNIZED_CELEBRITY_ERROR
+        return {"echo": job.payload.decode()}
+
+    runner.register("echo", echo_job)
+
+    # Jobs stored while the runner was stopped are picked up when it starts
+    async with open_manager() as dbmanager:
+        stored_job = await dbmanager.create_job(user.uuid, "echo", b"stored")
+        failing_job = await dbmanager.create_job(user.uuid, "echo", b"fail")
+        unknown_job = await dbmanager.create_job(user.uuid, "unknown", b"")
+
+    try:
+        await runner.start()
+        await runner.join()
+
+        async with open_manager() as dbmanager:
+            submitted_job = await dbmanager.create_job(user.uuid, "echo", b"new")
+        await runner.submit(submitted_job.uuid)
+        await runner.join()
+    finally:
+        await runner.stop()
+
+    async with open_manager() as dbmanager:
+        job = await dbmanager.get_job(stored_job.uuid)
+        assert job.status == JobStatus.succeeded
+        assert job.result == {"echo": "stored"}
+        job = await dbmanager.get_job(submitted_job.uuid)
+        assert job.result == {"echo": "new"}
+        job = await dbmanager.get_job(failing_job.uuid)
+        assert job.status == JobStatus.failed
+        assert job.status_code == status.HTTP_403_FORBIDDEN
+        job = await dbmanager.get_job(unknown_job.uuid)
+        assert job.status == JobStatus.failed
+        assert await dbmanager.get_claimable_jobs() == []
+
+
+@pytest.mark.asyncio
+async def test_job_runner_claims():
+    """Test that runners only run the jobs they can claim."""
+    user = await create_test_user()
+    runs = []
+
+    async def record_job(job, dbmanager):
+        runs.append(job.uuid)
+        return {}
+
+    async with open_manager() as dbmanager:
+        job = await dbmanager.create_job(user.uuid, "record", b"")
+        # Running elsewhere, under a valid lease and an expired one
+        running_job = await dbmanager.create_job(user.uuid, "record", b"")
+        await dbmanager.claim_job(running_job.uuid, "elsewhere", 60)
+        expired_job = await dbmanager.create_job(user.uuid, "record", b"")
+        await dbmanager.claim_job(expired_job.uuid, "crashed", -1)
+
+    # The runners share the only connection of the pool, so they run in turn
+    for owner in ("first", "second"):
+        runner = JobRunner(workers=1, manager_factory=open_manager, owner=owner)
+        runner.register("record", record_job)
+        try:
+            await runner.start()
+            await runner.submit(job.uuid)
+            await runner.submit(running_job.uuid)
+            await runner.join()
+        finally:
+            await runner.stop()
+
+    assert sorted(runs) == sorted([job.uuid, expired_job.uuid])
+    async with open_manager() as dbmanager:
+        assert (await dbmanager.get_job(job.uuid)).owner == "first"
+        assert (await dbmanager.get_job(expired_job.uuid)).owner == "first"
+        running_job = await dbmanager.get_job(running_job.uuid)
+        assert running_job.status == JobStatus.running
+        assert running_job.owner == "elsewhere"
+
+
+@pytest.mark.asyncio
+async def test_validate_photo_job(monkeypatch):
+    """Test the asynchronous photo validation and its status endpoint."""
+    user = await create_test_user()
+    other_user = await create_test_user()
+    admin_user = await create_test_user(Role.admin)
+
+    runner = JobRunner(workers=1, manager_factory=open_manager)
+    runner.register(VALIDATE_PHOTO_JOB, run_validate_photo_job)
+    scheduler = InferenceScheduler(workers=0)
+    monkeypatch.setattr(resources_module, "JOB_RUNNER", runner)
+    monkeypatch.setattr(resources_module, "INFERENCE_SCHEDULER", scheduler)
+
+    try:
+        async with open_manager() as dbmanager:
+            response = await post_users_id_validate(
+                file=UploadFile(BytesIO(synthetic_image(64, 48))),
+                active_user=user,
+                dbmanager=dbmanager,
+                inference_scheduler=scheduler,
+                photo_cache=PhotoResultCache(),
+                prefer="respond-async",
+            )
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        job_uuid = UUID(response.headers["Location"].rsplit("/", 1)[-1])
+        await runner.join()
+    finally:
+        await runner.stop()
+        await scheduler.stop()
+
+    async with open_manager() as dbmanager:
+        job = await get_jobs_id(job_uuid, active_user=user, dbmanager=dbmanager)
+        assert job.status == JobStatus.succeeded
+        assert job.result["role"] == Role.celebrity.value
+        assert (await dbmanager.get_user(uuid=user.uuid)).role == Role.celebrity
+
+        job = await get_jobs_id(job_uuid, active_user=admin_user, dbmanager=dbmanager)
+        assert job.status == JobStatus.succeeded
+
+        with pytest.raises(HTTPException) as excinfo:
+            await get_jobs_id(job_uuid, active_user=other_user, dbmanager=dbmanager)
+        assert excinfo.value.status_code == status.HTTP_404_NOT_FOUND
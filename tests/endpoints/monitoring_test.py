@@ -0,0 +1,134 @@
+import asyncio
+import os
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Histogram
+
+from userauth.common.metrics import render_prometheus, sample_value, time_coroutines
+from userauth.endpoints.monitoring import RequestMetricsMiddleware, start_metrics_server
+
+app = FastAPI()
+app.add_middleware(RequestMetricsMiddleware)
+
+
+@app.get("/items/{item_id}")
+async def get_item(item_id: int):
+    if item_id < 0:
+        raise HTTPException(status_code=404)
+    return {"item_id": item_id}
+
+
+test_client = TestClient(app)
+
+
+def test_request_metrics():
+    """Test that the requests are counted by route template and status."""
+    route = "/items/{item_id}"
+    requests = "userauth_http_requests_total"
+    ok_before = sample_value(requests, method="GET", route=route, status="200")
+    missing_before = sample_value(requests, method="GET", route=route, status="404")
+    unmatched_before = sample_value(
+        requests, method="GET", route="unmatched", status="404"
+    )
+    timed = "userauth_http_request_seconds_count"
+    timed_before = sample_value(timed, method="GET", route=route)
+
+    for item_id in (1, 2, -1):
+        test_client.get(f"/items/{item_id}")
+    test_client.get("/nowhere")
+
+    assert sample_value(requests, method="GET", route=route, status="200") == (
+        ok_before + 2
+    )
+    assert sample_value(requests, method="GET", route=route, status="404") == (
+        missing_before + 1
+    )
+    assert sample_value(requests, method="GET", route="unmatched", status="404") == (
+        unmatched_before + 1
+    )
+    assert sample_value(timed, method="GET", route=route) == timed_before + 3
+    # Not served with the application
+    assert test_client.get("/metrics").status_code == 404
+
+
+def run_worker(directory, requests, startup_seconds, exits):
+    """Record some metrics in a (fake) worker process sharing a directory."""
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(directory)}
+    code = (
+        "from userauth.app import STARTUP_SECONDS\n"
+        "from userauth.common.metrics import mark_process_dead\n"
+        "from userauth.endpoints.monitoring import HTTP_REQUESTS\n"
+        "HTTP_REQUESTS.labels(method='GET', route='/items', status='200')"
+        f".inc({requests})\n"
+        f"STARTUP_SECONDS.set({startup_seconds})\n"
+        f"if {exits}:\n"
+        "    mark_process_dead()\n"
+    )
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)
+
+
+def test_multiprocess_metrics(tmp_path):
+    """Test that the metrics of the workers are added up."""
+    run_worker(tmp_path, 2, 1.5, exits=True)
+    run_worker(tmp_path, 5, 0.5, exits=False)
+
+    metrics = render_prometheus(str(tmp_path))
+    # Counters cover the workers that exited, gauges only the others
+    assert (
+        'userauth_http_requests_total{method="GET",route="/items",status="200"} 7.0'
+        in metrics
+    )
+    assert "userauth_startup_seconds 0.5" in metrics
+
+
+def test_metrics_server(tmp_path):
+    """Test that all the metrics are exported on their own port."""
+    run_worker(tmp_path, 1, 0.5, exits=False)
+
+    server = start_metrics_server("127.0.0.1", 0, str(tmp_path))
+    url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"] == CONTENT_TYPE_LATEST
+            text = response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert "# TYPE userauth_http_requests_total counter" in text
+    assert 'route="/items",status="200"} 1.0' in text
+
+
+def test_time_coroutines():
+    """Test that only the public coroutine methods are timed."""
+    registry = CollectorRegistry()
+    histogram = Histogram("test_seconds", "", ("method",), registry=registry)
+
+    @time_coroutines(histogram, "method")
+    class Manager:
+        async def query(self, value):
+            return value
+
+        async def _private(self):
+            return None
+
+        def sync(self):
+            return None
+
+    manager = Manager()
+    assert asyncio.run(manager.query(3)) == 3
+    asyncio.run(manager._private())
+    manager.sync()
+    assert Manager.query.__name__ == "query"
+    assert registry.get_sample_value("test_seconds_count", {"method": "query"}) == 1
+    assert (
+        registry.get_sample_value("test_seconds_count", {"method": "_private"}) is None
+    )
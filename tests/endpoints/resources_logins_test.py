@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from uuid import uuid4
 
@@ -6,6 +7,7 @@ from fastapi import HTTPException, status
 
 from userauth.common.roles import Role
 from userauth.database.models import LoginEntry, UserEntry
+from userauth.endpoints.models import BatchGetRequest
 from userauth.endpoints.resources import (
     get_logins,
     get_logins_id,
@@ -13,6 +15,7 @@ from userauth.endpoints.resources import (
     get_users_id_logins_id,
     get_users_me_logins,
     get_users_me_logins_id,
+    post_logins_batch_get,
 )
 
 pytest_plugins = ("pytest_asyncio",)
@@ -50,22 +53,35 @@ admin_login = LoginEntry(
 )
 
 
-class MockedManager:
-    async def get_logins(self, user_uuid):
-        if user_uuid == admin_user.uuid:
-            return [admin_login]
-
-        if user_uuid == normal_user.uuid:
-            return [normal_login]
-
-        return [normal_login, admin_login]
+def in_scope(scope, login):
+    """Evaluate the (simple equality) scope predicates of the policies."""
+    return scope is None or scope.compare(LoginEntry.user == login.user)
 
-    async def get_login(self, uuid):
-        if uuid == admin_login.uuid:
-            return admin_login
 
-        if uuid == normal_login.uuid:
-            return normal_login
+class MockedManager:
+    async def get_logins(self, user_uuid=None, uuids=None, scope=None, **filters):
+        all_logins = [normal_login, admin_login]
+        if uuids is not None:
+            all_logins = [login for login in all_logins if login.uuid in uuids]
+        if user_uuid is not None:
+            all_logins = [login for login in all_logins if login.user == user_uuid]
+        return [login for login in all_logins if in_scope(scope, login)]
+
+    async def get_user_logins(self, user_uuid, scope=None):
+        if scope is not None and not scope.compare(UserEntry.uuid == user_uuid):
+            return None
+        return await self.get_logins(user_uuid=user_uuid)
+
+    async def get_logins_version(self, user_uuid):
+        logins = await self.get_logins(user_uuid=user_uuid)
+        return len(logins), max(login.ctime for login in logins)
+
+    async def get_login(self, uuid, user_uuid=None, scope=None):
+        for login in [admin_login, normal_login]:
+            if login.uuid != uuid or not in_scope(scope, login):
+                continue
+            if user_uuid is None or login.user == user_uuid:
+                return login
 
     async def get_user(self, uuid=None, username=None):
         if username == admin_user.username or uuid == admin_user.uuid:
@@ -84,7 +100,7 @@ async def test_get_users_me_logins():
         "dbmanager": MockedManager(),
     }
     result = await get_users_me_logins(**request_arguments)
-    assert [res.uuid for res in result] == [normal_login.uuid]
+    assert [res["uuid"] for res in json.loads(result.body)] == [str(normal_login.uuid)]
 
     request_arguments["login_id"] = normal_login.uuid
     result = await get_users_me_logins_id(**request_arguments)
@@ -101,12 +117,40 @@ async def test_get_users_id_logins():
         "dbmanager": MockedManager(),
     }
     result = await get_users_id_logins(**request_arguments)
-    assert [res.uuid for res in result] == [normal_login.uuid]
+    assert [res["uuid"] for res in json.loads(result.body)] == [str(normal_login.uuid)]
 
     request_arguments["login_id"] = normal_login.uuid
     result = await get_users_id_logins_id(**request_arguments)
     assert result.uuid == normal_login.uuid
 
+    # Logins are only found under the user they belong to
+    request_arguments["user_id"] = admin_user.uuid
+    request_arguments["active_user"] = admin_user
+    with pytest.raises(HTTPException) as excinfo:
+        await get_users_id_logins_id(**request_arguments)
+    assert excinfo.value.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_get_users_id_logins_not_modified():
+    """Test that unchanged login lists are answered with a 304."""
+
+    request_arguments = {
+        "user_id": normal_user.uuid,
+        "active_user": normal_user,
+        "dbmanager": MockedManager(),
+    }
+    result = await get_users_id_logins(**request_arguments)
+    etag = result.headers["ETag"]
+
+    result = await get_users_id_logins(if_none_match=etag, **request_arguments)
+    assert result.status_code == status.HTTP_304_NOT_MODIFIED
+
+    request_arguments["user_id"] = admin_user.uuid
+    with pytest.raises(HTTPException) as excinfo:
+        await get_users_id_logins(if_none_match="*", **request_arguments)
+    assert excinfo.value.status_code == status.HTTP_404_NOT_FOUND
+
 
 @pytest.mark.asyncio
 async def test_get_logins():
@@ -117,9 +161,9 @@ async def test_get_logins():
         "dbmanager": MockedManager(),
     }
     result = await get_logins(**request_arguments)
-    result = [res.uuid for res in result]
+    result = [res["uuid"] for res in json.loads(result.body)]
     result = set(result)
-    assert result == {normal_login.uuid, admin_login.uuid}
+    assert result == {str(normal_login.uuid), str(admin_login.uuid)}
 
     request_arguments = {
         "active_user": normal_user,
@@ -155,3 +199,29 @@ async def test_get_logins_id():
     request_arguments["login_id"] = normal_login.uuid
     result = await get_logins_id(**request_arguments)
     assert result.uuid == normal_login.uuid
+
+
+@pytest.mark.asyncio
+async def test_post_logins_batch_get():
+    """Test that batches keep the order and hide what you can't see."""
+    missing_uuid = uuid4()
+    batch_request = BatchGetRequest(
+        ids=[admin_login.uuid, normal_login.uuid, missing_uuid],
+    )
+
+    result = await post_logins_batch_get(
+        batch_request=batch_request,
+        active_user=admin_user,
+        dbmanager=MockedManager(),
+    )
+    assert [item.id for item in result] == batch_request.ids
+    assert [item.found for item in result] == [True, True, False]
+
+    result = await post_logins_batch_get(
+        batch_request=batch_request,
+        active_user=normal_user,
+        dbmanager=MockedManager(),
+    )
+    assert [item.found for item in result] == [False, True, False]
+    assert result[0].login is None
+    assert result[1].login.uuid == normal_login.uuid
@@ -1,15 +1,23 @@
+import json
+from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 
 import pytest
-from fastapi import HTTPException, status
+from fastapi import HTTPException, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 
 from userauth.common.roles import Role
-from userauth.database.models import UserEntry
+from userauth.database.manager import DatabaseManager
+from userauth.database.models import Base, UserEntry
+from userauth.endpoints.models import BatchGetRequest, User
 from userauth.endpoints.resources import (
     delete_users_id,
     get_users,
     get_users_id,
     get_users_me,
+    get_users_search,
+    post_models_celeb_detector_reload,
+    post_users_batch_get,
     post_users_id_validate,
     update_users_id,
 )
@@ -56,8 +64,17 @@ class MockedManager:
         self.normal_user_updated = False
         self.normal_user_deleted = False
 
-    async def get_users(self):
-        return [admin_user, normal_user, celebrity_user]
+    async def get_users(self, uuids=None, role=None, scope=None, **filters):
+        all_users = [admin_user, normal_user, celebrity_user]
+        if scope is not None:
+            all_users = [
+                user for user in all_users if scope.compare(UserEntry.uuid == user.uuid)
+            ]
+        if role is not None:
+            all_users = [user for user in all_users if user.role == role]
+        if uuids is None:
+            return all_users
+        return [user for user in all_users if user.uuid in uuids]
 
     async def get_user(self, uuid=None, username=None):
         if username == admin_user.username or uuid == admin_user.uuid:
@@ -69,6 +86,10 @@ class MockedManager:
         if username == normal_user.username or uuid == normal_user.uuid:
             return normal_user
 
+    async def search_users(self, query, **kwargs):
+        all_users = [admin_user, normal_user, celebrity_user]
+        return [user for user in all_users if user.username.startswith(query)]
+
     async def update_user(self, uuid, *args, **kwargs):
         if uuid == admin_user.uuid:
             self.admin_user_updated = True
@@ -96,9 +117,17 @@ class MockedManager:
 @pytest.mark.asyncio
 async def test_get_users_me():
     """Test that you get yourself."""
-    result = await get_users_me(active_user=normal_user)
+    response = Response()
+    result = await get_users_me(response=response, active_user=normal_user)
     assert result.username == "normal_user"
 
+    etag = response.headers["ETag"]
+    result = await get_users_me(
+        response=Response(), if_none_match=etag, active_user=normal_user
+    )
+    assert result.status_code == status.HTTP_304_NOT_MODIFIED
+    assert result.headers["ETag"] == etag
+
 
 @pytest.mark.asyncio
 async def test_get_users_id():
@@ -106,6 +135,7 @@ async def test_get_users_id():
     mocked_manager = MockedManager()
 
     result = await get_users_id(
+        response=Response(),
         user_id=normal_user.uuid,
         active_user=normal_user,
         dbmanager=mocked_manager,
@@ -113,6 +143,7 @@ async def test_get_users_id():
     assert result.username == "normal_user"
 
     result = await get_users_id(
+        response=Response(),
         user_id=normal_user.uuid,
         active_user=admin_user,
         dbmanager=mocked_manager,
@@ -120,6 +151,7 @@ async def test_get_users_id():
     assert result.username == "normal_user"
 
     result = await get_users_id(
+        response=Response(),
         user_id=celebrity_user.uuid,
         active_user=admin_user,
         dbmanager=mocked_manager,
@@ -128,6 +160,7 @@ async def test_get_users_id():
 
     with pytest.raises(HTTPException) as excinfo:
         result = await get_users_id(
+            response=Response(),
             user_id=celebrity_user.uuid,
             active_user=normal_user,
             dbmanager=mocked_manager,
@@ -136,6 +169,7 @@ async def test_get_users_id():
 
     with pytest.raises(HTTPException) as excinfo:
         result = await get_users_id(
+            response=Response(),
             user_id=normal_user.uuid,
             active_user=celebrity_user,
             dbmanager=mocked_manager,
@@ -149,7 +183,16 @@ async def test_get_users():
     mocked_manager = MockedManager()
 
     result = await get_users(active_user=admin_user, dbmanager=mocked_manager)
-    assert len(result) == 3
+    assert len(json.loads(result.body)) == 3
+
+    result = await get_users(
+        role=Role.celebrity,
+        active_user=admin_user,
+        dbmanager=mocked_manager,
+    )
+    result = json.loads(result.body)
+    assert [user["username"] for user in result] == ["celebrity_user"]
+    assert result[0]["role"] == Role.celebrity.value
 
     with pytest.raises(HTTPException) as excinfo:
         result = await get_users(
@@ -159,6 +202,88 @@ async def test_get_users():
     assert excinfo.value.status_code == status.HTTP_404_NOT_FOUND
 
 
+@pytest.mark.asyncio
+async def test_get_users_ctime_offset():
+    """Test that creation times with an offset are compared in UTC."""
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession(engine) as session:
+        session.add(
+            UserEntry(
+                uuid=uuid4(),
+                role=Role.normal,
+                username="utc_user",
+                email="utc_user@email.com",
+                name="name",
+                surname="surname",
+                hashed_password="password",
+                ctime=datetime(2024, 1, 1, 10, 30),
+            )
+        )
+        await session.commit()
+
+        # 12:00 at UTC+2 is 10:00 UTC, before the user was created
+        offset_time = datetime(2024, 1, 1, 12, tzinfo=timezone(timedelta(hours=2)))
+        manager = DatabaseManager(session)
+        result = await get_users(
+            ctime_from=offset_time, active_user=admin_user, dbmanager=manager
+        )
+        assert [user["username"] for user in json.loads(result.body)] == ["utc_user"]
+        result = await get_users(
+            ctime_to=offset_time, active_user=admin_user, dbmanager=manager
+        )
+        assert json.loads(result.body) == []
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_get_users_search():
+    """Test that only admins can search users."""
+    result = await get_users_search(
+        q="normal",
+        active_user=admin_user,
+        dbmanager=MockedManager(),
+    )
+    assert [user["username"] for user in json.loads(result.body)] == ["normal_user"]
+
+    with pytest.raises(HTTPException) as excinfo:
+        await get_users_search(
+            q="normal",
+            active_user=normal_user,
+            dbmanager=MockedManager(),
+        )
+    assert excinfo.value.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_post_users_batch_get():
+    """Test that batches keep the order and hide what you can't see."""
+    missing_uuid = uuid4()
+    batch_request = BatchGetRequest(
+        ids=[celebrity_user.uuid, missing_uuid, normal_user.uuid],
+    )
+
+    result = await post_users_batch_get(
+        batch_request=batch_request,
+        active_user=admin_user,
+        dbmanager=MockedManager(),
+    )
+    assert [item.id for item in result] == batch_request.ids
+    assert [item.found for item in result] == [True, False, True]
+    assert result[0].user.username == "celebrity_user"
+    assert result[1].user is None
+
+    result = await post_users_batch_get(
+        batch_request=batch_request,
+        active_user=normal_user,
+        dbmanager=MockedManager(),
+    )
+    assert [item.found for item in result] == [False, False, True]
+    assert result[0].user is None
+    assert result[2].user.username == "normal_user"
+
+
 @pytest.mark.asyncio
 async def test_update_users_id():
     """Test that you can only update your username and admins also role."""
@@ -219,6 +344,26 @@ async def test_update_users_id():
     assert excinfo.value.status_code == status.HTTP_405_METHOD_NOT_ALLOWED
 
 
+@pytest.mark.asyncio
+async def test_update_users_id_concurrently():
+    """Test that an update of a user modified concurrently is a conflict."""
+
+    class ConcurrentlyModifiedManager(MockedManager):
+        async def update_user(self, uuid, *args, **kwargs):
+            return None
+
+    updated_user = User.from_dbentry(normal_user)
+    updated_user.username = "changed_username"
+    with pytest.raises(HTTPException) as excinfo:
+        await update_users_id(
+            user_id=normal_user.uuid,
+            updated_user=updated_user,
+            active_user=normal_user,
+            dbmanager=ConcurrentlyModifiedManager(),
+        )
+    assert excinfo.value.status_code == status.HTTP_409_CONFLICT
+
+
 @pytest.mark.asyncio
 async def test_delete_users_id():
     """Test that you can only delete yourself."""
@@ -247,26 +392,52 @@ async def test_post_users_id_validate():
     """Test celebrity recognition."""
     from pathlib import Path
 
+    from fastapi import UploadFile
+
+    from userauth.picmodel import InferenceScheduler, PhotoResultCache
+
     root_path = Path(__file__).parent.parent.parent
     file_path = root_path / "userauth" / "picmodel" / "tom.jpeg"
 
     with open(file_path, "rb") as image_file:
-        filedata = image_file.read()
+        request_arguments = {
+            "file": UploadFile(image_file),
+            "active_user": normal_user,
+            "dbmanager": None,
+            "inference_scheduler": InferenceScheduler(workers=0),
+            "photo_cache": PhotoResultCache(),
+            "prefer": None,
+        }
+
+        request_arguments["active_user"] = normal_user
+        request_arguments["dbmanager"] = MockedManager()
+        result = await post_users_id_validate(**request_arguments)
+        assert result.username == "normal_user"
+        assert request_arguments["dbmanager"].normal_user_updated
+
+        request_arguments["active_user"] = admin_user
+        request_arguments["dbmanager"] = MockedManager()
+        with pytest.raises(HTTPException) as excinfo:
+            await post_users_id_validate(**request_arguments)
+        assert excinfo.value.status_code == status.HTTP_403_FORBIDDEN
 
-    request_arguments = {
-        "file": filedata,
-        "active_user": normal_user,
-        "dbmanager": None,
-    }
 
-    request_arguments["active_user"] = normal_user
-    request_arguments["dbmanager"] = MockedManager()
-    result = await post_users_id_validate(**request_arguments)
-    assert result.username == "normal_user"
-    assert request_arguments["dbmanager"].normal_user_updated
+@pytest.mark.asyncio
+async def test_post_models_celeb_detector_reload():
+    """Test that only admins can reload the model."""
+    from userauth.picmodel import INFERENCE_SCHEDULER
+
+    try:
+        result = await post_models_celeb_detector_reload(active_user=admin_user)
+        first_load = INFERENCE_SCHEDULER.loaded_at
+        assert result.loaded_at == first_load
+        assert INFERENCE_SCHEDULER.is_running
+
+        result = await post_models_celeb_detector_reload(active_user=admin_user)
+        assert result.loaded_at >= first_load
+    finally:
+        await INFERENCE_SCHEDULER.stop()
 
-    request_arguments["active_user"] = admin_user
-    request_arguments["dbmanager"] = MockedManager()
     with pytest.raises(HTTPException) as excinfo:
-        await post_users_id_validate(**request_arguments)
-    assert excinfo.value.status_code == status.HTTP_403_FORBIDDEN
+        await post_models_celeb_detector_reload(active_user=normal_user)
+    assert excinfo.value.status_code == status.HTTP_404_NOT_FOUND
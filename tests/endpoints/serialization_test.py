@@ -0,0 +1,38 @@
+import json
+from datetime import datetime
+from uuid import uuid4
+
+from userauth.common.roles import Role
+from userauth.database.models import LoginEntry, UserEntry
+from userauth.endpoints import serialization
+from userauth.endpoints.models import LoginRecord, User
+from userauth.endpoints.serialization import encode_json, login_row, user_row
+
+user_entry = UserEntry(
+    uuid=uuid4(),
+    role=Role.celebrity,
+    username="user",
+    email="user@email.com",
+    name="Zoë",
+    surname="Saldaña",
+    hashed_password="password",
+)
+
+login_entry = LoginEntry(
+    uuid=uuid4(),
+    user=user_entry.uuid,
+    ctime=datetime(2023, 10, 18, 12, 30, 15, 123456),
+)
+
+
+def test_rows_match_models(monkeypatch):
+    """Test that the fast path encodes exactly as the response models."""
+    expected_user = json.loads(User.from_dbentry(user_entry).model_dump_json())
+    expected_login = json.loads(LoginRecord.from_dbentry(login_entry).model_dump_json())
+
+    assert json.loads(encode_json([user_row(user_entry)])) == [expected_user]
+    assert json.loads(encode_json([login_row(login_entry)])) == [expected_login]
+
+    monkeypatch.setattr(serialization, "orjson", None)
+    assert json.loads(encode_json([user_row(user_entry)])) == [expected_user]
+    assert json.loads(encode_json([login_row(login_entry)])) == [expected_login]
@@ -0,0 +1,115 @@
+from io import BytesIO
+from tempfile import SpooledTemporaryFile
+
+import pytest
+from fastapi import FastAPI, File, HTTPException, UploadFile, status
+from fastapi.testclient import TestClient
+
+from userauth.endpoints.errors import HTTP_413_CONTENT_TOO_LARGE
+from userauth.endpoints.uploads import (
+    UPLOAD_FORM_OVERHEAD,
+    UploadLimitMiddleware,
+    UploadTooLarge,
+    read_into_buffer,
+    read_photo,
+    read_upload,
+)
+from userauth.picmodel.preprocessing import synthetic_image
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+def test_read_into_buffer():
+    """Test reading files of known and unknown size into one buffer."""
+    data = bytes(range(256)) * 1000
+
+    buffer = read_into_buffer(BytesIO(data), max_bytes=len(data), chunk_size=1000)
+    assert buffer == data
+
+    buffer = read_into_buffer(
+        BytesIO(data),
+        max_bytes=len(data),
+        size_hint=len(data),
+        chunk_size=1000,
+    )
+    assert buffer == data
+
+    assert read_into_buffer(BytesIO(b""), max_bytes=10) == b""
+
+    with pytest.raises(UploadTooLarge):
+        read_into_buffer(BytesIO(data), max_bytes=len(data) - 1, chunk_size=1000)
+
+
+@pytest.mark.asyncio
+async def test_read_upload():
+    """Test that uploads over the limit are rejected with a 413."""
+    data = b"photo" * 1000
+    spooled_file = SpooledTemporaryFile(max_size=1024)
+    spooled_file.write(data)
+
+    upload = UploadFile(spooled_file)
+    assert await read_upload(upload, max_bytes=len(data)) == data
+
+    with pytest.raises(HTTPException) as excinfo:
+        await read_upload(upload, max_bytes=len(data) - 1)
+    assert excinfo.value.status_code == HTTP_413_CONTENT_TOO_LARGE
+
+    upload = UploadFile(BytesIO(data), size=len(data))
+    with pytest.raises(HTTPException) as excinfo:
+        await read_upload(upload, max_bytes=100)
+    assert excinfo.value.status_code == HTTP_413_CONTENT_TOO_LARGE
+
+
+@pytest.mark.asyncio
+async def test_read_photo():
+    """Test that files which are not supported images are rejected."""
+    photo = synthetic_image(64, 48)
+    assert await read_photo(UploadFile(BytesIO(photo))) == photo
+
+    with pytest.raises(HTTPException) as excinfo:
+        await read_photo(UploadFile(BytesIO(b"not a photo")))
+    assert excinfo.value.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_upload_limit_middleware():
+    """Test that bodies over the limit are rejected before being read."""
+    app = FastAPI()
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File()):
+        return {"size": len(await file.read())}
+
+    limited_app = UploadLimitMiddleware(app, max_bytes=1000)
+    test_client = TestClient(limited_app)
+
+    response = test_client.post("/upload", files={"file": b"x" * 1000})
+    assert response.json() == {"size": 1000}
+
+    oversized = b"x" * (1000 + UPLOAD_FORM_OVERHEAD + 1)
+    response = test_client.post("/upload", files={"file": oversized})
+    assert response.status_code == HTTP_413_CONTENT_TOO_LARGE
+
+    # Without a declared length, the body stops being received at the limit
+    header = b'--x\r\nContent-Disposition: form-data; name="file"; filename="a"\r\n\r\n'
+    chunks = [header] + [b"x" * UPLOAD_FORM_OVERHEAD for _ in range(10)]
+    received = []
+    sent = []
+
+    async def receive():
+        received.append(chunks[len(received)])
+        more = len(received) < len(chunks)
+        return {"type": "http.request", "body": received[-1], "more_body": more}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/upload",
+        "headers": [(b"content-type", b"multipart/form-data; boundary=x")],
+    }
+    await limited_app(scope, receive, send)
+    assert sent[0]["status"] == HTTP_413_CONTENT_TOO_LARGE
+    assert len(received) < len(chunks)
@@ -3,15 +3,15 @@ Test the deployed app with a mock database.
 """
 import asyncio
 
-from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.pool import StaticPool
 
+from userauth.app import create_app
+from userauth.common.metrics import render_prometheus, sample_value
 from userauth.database.manager import DatabaseManager
 from userauth.database.models import Base
 from userauth.database.session import get_database_manager
-from userauth.endpoints import authentication, resources
 
 ################################################################################
 # SETUP DB IN MEMORY
@@ -47,14 +47,8 @@ async def get_test_manager():
         await test_session.close()
 
 
-app = FastAPI(
-    title="UserAuth",
-    description="A python-based user authentication REST-API server for automated celebrity recognition.",
-    version="0.1.0",
-)
-app.include_router(router=authentication)
-app.include_router(router=resources)
-
+# The client isn't used as a context manager, so the lifespan doesn't run
+app = create_app()
 app.dependency_overrides[get_database_manager] = get_test_manager
 
 test_client = TestClient(app)
@@ -219,6 +213,30 @@ def test_user_access():
     assert response.status_code == 200
     assert len(list(response.json())) == 1
 
+    # UNCHANGED RESOURCES ARE ANSWERED WITH A 304
+    response = test_client.get(f"/users/{user01_uuid}", headers=user01_header)
+    user01_etag = response.headers["ETag"]
+    conditional_header = {**user01_header, "If-None-Match": user01_etag}
+    response = test_client.get(f"/users/{user01_uuid}", headers=conditional_header)
+    assert response.status_code == 304
+    assert response.headers["ETag"] == user01_etag
+
+    response = test_client.get(f"/users/me", headers=conditional_header)
+    assert response.status_code == 304
+
+    response = test_client.get(f"/users/{user01_uuid}/logins", headers=user01_header)
+    conditional_header = {**user01_header, "If-None-Match": response.headers["ETag"]}
+    response = test_client.get(
+        f"/users/{user01_uuid}/logins", headers=conditional_header
+    )
+    assert response.status_code == 304
+
+    conditional_header = {**user02_header, "If-None-Match": "*"}
+    response = test_client.get(
+        f"/users/{user01_uuid}/logins", headers=conditional_header
+    )
+    assert response.status_code == 404
+
     # USER 1 CAN ONLY DELETE ITSELF
     # (After which credentials no longer work)
     response = test_client.delete(f"/users/{user02_uuid}", headers=user01_header)
@@ -235,3 +253,25 @@ def test_user_access():
 
     response = test_client.delete(f"/users/{user02_uuid}", headers=user02_header)
     assert response.status_code == 204
+
+
+def test_app_factory():
+    """Test that every worker gets its own app with all the routes."""
+    other_app = create_app()
+    assert other_app is not app
+    paths = other_app.openapi()["paths"]
+    assert paths.keys() == app.openapi()["paths"].keys()
+    assert "/users/{user_id}/validate_photo" in paths
+
+    # The previous tests made requests
+    assert sample_value("userauth_first_request_seconds") > 0
+
+
+def test_metrics():
+    """Test that the metrics of the previous requests are exported."""
+    # Only exported on the internal port
+    assert test_client.get("/metrics").status_code == 404
+    metrics = render_prometheus()
+    assert 'userauth_database_method_seconds_count{method="create_user"}' in metrics
+    assert 'userauth_password_hash_seconds_count{operation="verify"}' in metrics
+    assert 'userauth_jwt_seconds_count{operation="decode"}' in metrics
@@ -0,0 +1,95 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from userauth.common.metrics import sample_value
+from userauth.picmodel.cascade import (
+    REJECTED_PREDICTION,
+    CascadedDetector,
+    record_stage_stats,
+)
+from userauth.picmodel.gallery import EmbeddingGallery
+from userauth.picmodel.preprocessing import InvalidImage, synthetic_image
+
+
+def plain_image(color, mode="RGB") -> bytes:
+    output = io.BytesIO()
+    Image.new(mode, (64, 48), color).save(output, format="PNG")
+    return output.getvalue()
+
+
+class CountingDetector:
+    """Placeholder detector counting the images it sees."""
+
+    def __init__(self, gallery=None):
+        self.gallery = gallery
+        self.images = 0
+
+    def predict_batch(self, images, output_names, output_percents):
+        self.images += len(images)
+        return list(zip(output_names, output_percents))
+
+
+def cascaded_detector(tmp_path, gallery=None) -> CascadedDetector:
+    cascade = CascadedDetector(tmp_path / "model.h5")
+    cascade.detector = CountingDetector(gallery)
+    cascade.stages[0].gallery = gallery
+    return cascade
+
+
+def test_face_stage(tmp_path):
+    """Test that photos without skin tones never reach the detector."""
+    cascade = cascaded_detector(tmp_path)
+    photo = synthetic_image(64, 48)
+    images = [
+        photo,
+        plain_image((20, 60, 200)),
+        b"not an image",
+        plain_image(90, mode="L"),
+        plain_image((200, 150, 120)),
+    ]
+    predictions = cascade.predict_batch(images, ["A B"] * 5, [0.96] * 5)
+
+    assert predictions[0] == ("A B", 0.96)
+    assert predictions[1] == REJECTED_PREDICTION
+    assert isinstance(predictions[2], InvalidImage)
+    # Black and white photos can't be checked, so they pass
+    assert predictions[3] == ("A B", 0.96)
+    assert predictions[4] == ("A B", 0.96)
+    assert cascade.detector.images == 3
+
+    stats = {stage_stats.stage: stage_stats for stage_stats in cascade.last_stats}
+    assert (stats["name"].images, stats["name"].passed) == (5, 5)
+    assert (stats["face"].images, stats["face"].passed) == (5, 3)
+    assert (stats["detector"].images, stats["detector"].passed) == (3, 3)
+
+    metric = "userauth_cascade_stage_images_total"
+    passed_before = sample_value(metric, stage="face", outcome="passed")
+    rejected_before = sample_value(metric, stage="face", outcome="rejected")
+    record_stage_stats(cascade.last_stats)
+    assert sample_value(metric, stage="face", outcome="passed") == passed_before + 3
+    assert sample_value(metric, stage="face", outcome="rejected") == (
+        rejected_before + 2
+    )
+
+
+def test_name_stage(tmp_path):
+    """Test that claims of names missing from the gallery are rejected early."""
+    gallery = EmbeddingGallery.create(tmp_path / "gallery", 4)
+    gallery.append(np.eye(2, 4, dtype=np.float32), ["Alice Smith", "Bob Jones"])
+    cascade = cascaded_detector(tmp_path, gallery)
+
+    photo = synthetic_image(64, 48)
+    predictions = cascade.predict_batch(
+        [photo, photo],
+        ["Bob Jones", "Carol White"],
+        [0.96, 0.96],
+    )
+    assert predictions == [("Bob Jones", 0.96), REJECTED_PREDICTION]
+    assert cascade.detector.images == 1
+
+    # Low probabilities pass the detector stage but don't count as accepted
+    predictions = cascade.predict_batch([photo], ["Alice Smith"], [0.5])
+    assert predictions == [("Alice Smith", 0.5)]
+    assert cascade.last_stats[-1].passed == 0
@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+from userauth.common.config import SERVER_CONFIG
+from userauth.picmodel.celeb_detector import (
+    EMBEDDING_WEIGHTS,
+    CelebDetector,
+    MissingEmbedder,
+)
+from userauth.picmodel.gallery import NAME_HASHES_FILE, EmbeddingGallery, normalize_rows
+from userauth.picmodel.preprocessing import INPUT_SIZE, synthetic_image
+from userauth.picmodel.weights import save_weights
+
+
+def random_embeddings(count: int, dimension: int = 16, seed: int = 0):
+    generator = np.random.default_rng(seed)
+    return generator.standard_normal((count, dimension)).astype(np.float32)
+
+
+def test_gallery_search(tmp_path):
+    """Test the exact top-k search and appending to an existing gallery."""
+    embeddings = random_embeddings(300)
+    names = [f"Celeb {idx}" for idx in range(300)]
+    gallery = EmbeddingGallery.create(tmp_path / "gallery", 16)
+    gallery.append(embeddings[:200], names[:200])
+    assert len(gallery) == 200
+
+    # Appended rows are kept when the gallery is opened again
+    gallery = EmbeddingGallery(tmp_path / "gallery")
+    gallery.append(embeddings[200:], names[200:])
+    gallery = EmbeddingGallery(tmp_path / "gallery")
+    assert len(gallery) == 300
+    assert gallery.name(250) == "Celeb 250"
+
+    # Queries are normalized, so scaling them doesn't change the matches
+    matches = gallery.search(3 * embeddings[[5, 250]], k=3)
+    assert [query_matches[0][0] for query_matches in matches] == [
+        "Celeb 5",
+        "Celeb 250",
+    ]
+    assert abs(matches[0][0][1] - 1.0) < 1e-5
+
+    scores = normalize_rows(embeddings) @ normalize_rows(embeddings[[5]])[0]
+    expected = [f"Celeb {idx}" for idx in np.argsort(-scores)[:3]]
+    assert [name for name, _ in matches[0]] == expected
+
+
+def test_gallery_names(tmp_path):
+    """Test the lookups of names, with and without the name index."""
+    gallery = EmbeddingGallery.create(tmp_path / "gallery", 16)
+    assert not gallery.has_name("Celeb 0")
+    gallery.append(random_embeddings(3), ["Celeb 0", "Celeb 1", "Celeb 0"])
+    assert gallery.has_name("Celeb 0") and gallery.has_name("Celeb 1")
+    assert not gallery.has_name("Celeb 2")
+
+    gallery = EmbeddingGallery(tmp_path / "gallery")
+    gallery.append(random_embeddings(1), ["Celeb 2"])
+    gallery = EmbeddingGallery(tmp_path / "gallery")
+    assert all(gallery.has_name(f"Celeb {idx}") for idx in range(3))
+    assert not gallery.has_name("Celeb 3")
+
+    # Galleries created before the name index still find their names
+    (tmp_path / "gallery" / NAME_HASHES_FILE).unlink()
+    gallery = EmbeddingGallery(tmp_path / "gallery")
+    assert gallery.has_name("Celeb 1") and not gallery.has_name("Celeb 3")
+    gallery.append(random_embeddings(1), ["Celeb 3"])
+    gallery = EmbeddingGallery(tmp_path / "gallery")
+    assert all(gallery.has_name(f"Celeb {idx}") for idx in range(4))
+
+
+def test_gallery_index(tmp_path):
+    """Test the IVF search, including the rows appended after indexing."""
+    embeddings = random_embeddings(500, seed=1)
+    names = [f"Celeb {idx}" for idx in range(500)]
+    gallery = EmbeddingGallery.create(tmp_path / "gallery", 16)
+    gallery.append(embeddings[:400], names[:400])
+    gallery.build_index(8)
+    gallery.append(embeddings[400:], names[400:])
+
+    gallery = EmbeddingGallery(tmp_path / "gallery")
+    assert gallery.ivf_lists == 8
+    matches = gallery.search(embeddings[[10, 450]], k=1, probes=8)
+    assert [query_matches[0][0] for query_matches in matches] == [
+        "Celeb 10",
+        "Celeb 450",
+    ]
+
+
+def test_detector_with_gallery(tmp_path, monkeypatch):
+    """Test that the detector predicts the closest celebrity of the gallery."""
+    embeddings = np.eye(4, dtype=np.float32)
+    gallery = EmbeddingGallery.create(tmp_path / "gallery", 4)
+    gallery.append(embeddings, ["Alice", "Bob", "Carol", "Dave"])
+
+    detector = CelebDetector(tmp_path / "model.h5")
+    detector.gallery = gallery
+    monkeypatch.setattr(
+        detector,
+        "embed",
+        lambda batch: np.tile([0.1, 0.9, 0.0, 0.0], (len(batch), 1)),
+    )
+
+    image = synthetic_image(64, 48)
+    predictions = detector.predict_batch([image, b"not an image", image], [], [])
+    assert predictions[0][0] == predictions[2][0] == "Bob"
+    assert 0.99 < predictions[0][1] <= 1.0
+    assert isinstance(predictions[1], ValueError)
+
+
+def test_detector_embeddings(tmp_path, monkeypatch):
+    """Test that a gallery needs a model computing its embeddings."""
+    gallery = EmbeddingGallery.create(tmp_path / "gallery", 4)
+    gallery.append(np.eye(4, dtype=np.float32), ["Alice", "Bob", "Carol", "Dave"])
+    monkeypatch.setattr(SERVER_CONFIG, "CELEB_GALLERY_PATH", str(tmp_path / "gallery"))
+
+    # Without the weights of the embeddings, the model fails to load
+    with pytest.raises(MissingEmbedder):
+        CelebDetector(tmp_path / "model.h5")
+    save_weights({"dense/kernel": np.ones((2, 2))}, tmp_path / "no_embeddings")
+    with pytest.raises(MissingEmbedder):
+        CelebDetector(tmp_path / "no_embeddings")
+    wrong_kernel = np.ones((INPUT_SIZE**2 * 3, 8), dtype=np.float32)
+    save_weights({EMBEDDING_WEIGHTS: wrong_kernel}, tmp_path / "wrong_dimension")
+    with pytest.raises(MissingEmbedder):
+        CelebDetector(tmp_path / "wrong_dimension")
+
+    # Every value of the image adds to the second dimension: "Bob"
+    kernel = np.zeros((INPUT_SIZE**2 * 3, 4), dtype=np.float32)
+    kernel[:, 1] = 1.0
+    save_weights({EMBEDDING_WEIGHTS: kernel}, tmp_path / "model")
+    detector = CelebDetector(tmp_path / "model")
+    assert detector.can_embed
+
+    assert detector.predict(synthetic_image(64, 48), "", 0.0)[0] == "Bob"
+
+
+def test_detector_quantized_embeddings(tmp_path, monkeypatch):
+    """Test that quantized kernels embed like their dequantized copies."""
+    monkeypatch.setattr(SERVER_CONFIG, "CELEB_GALLERY_PATH", None)
+    generator = np.random.default_rng(2)
+    kernel = generator.standard_normal((INPUT_SIZE**2 * 3, 4)).astype(np.float32)
+    save_weights({EMBEDDING_WEIGHTS: kernel}, tmp_path / "model", quantize=True)
+    detector = CelebDetector(tmp_path / "model")
+
+    batch = generator.random((3, INPUT_SIZE, INPUT_SIZE, 3), dtype=np.float32)
+    expected = batch.reshape(3, -1) @ detector.weights.dequantized(EMBEDDING_WEIGHTS)
+    assert np.allclose(detector.embed(batch), expected, rtol=1e-4, atol=1e-2)
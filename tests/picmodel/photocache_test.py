@@ -0,0 +1,65 @@
+import io
+import time
+from uuid import uuid4
+
+from PIL import Image
+
+from userauth.common.metrics import sample_value
+from userauth.picmodel.photocache import (
+    PhotoResultCache,
+    hamming_distance,
+    perceptual_hash,
+)
+from userauth.picmodel.preprocessing import synthetic_image
+
+
+def reencode(data: bytes, **save_options) -> bytes:
+    output = io.BytesIO()
+    Image.open(io.BytesIO(data)).save(output, **save_options)
+    return output.getvalue()
+
+
+def test_perceptual_hash():
+    """Test that re-encoded photos keep (nearly) the same hash."""
+    photo = synthetic_image(320, 240, seed=1)
+    photo_hash = perceptual_hash(photo)
+    assert 0 <= photo_hash < 2**64
+
+    reencoded_hash = perceptual_hash(reencode(photo, format="JPEG", quality=60))
+    assert hamming_distance(photo_hash, reencoded_hash) <= 6
+
+    other_hash = perceptual_hash(synthetic_image(320, 240, seed=2))
+    assert hamming_distance(photo_hash, other_hash) > 6
+
+
+def test_photo_result_cache():
+    """Test the exact and near-duplicate lookups, the expiration and LRU."""
+    cache = PhotoResultCache(max_entries=3, ttl=60, max_distance=2)
+    user_uuid = uuid4()
+    metric = "userauth_photo_cache_lookups_total"
+    hits_before = sample_value(metric, outcome="hit")
+    near_hits_before = sample_value(metric, outcome="near_hit")
+
+    assert cache.get(user_uuid, 0b1010) is None
+    cache.put(user_uuid, 0b1010, ("Tom Cruise", 0.96))
+    assert cache.get(user_uuid, 0b1010) == ("Tom Cruise", 0.96)
+    assert cache.get(user_uuid, 0b1001) == ("Tom Cruise", 0.96)
+    assert cache.get(user_uuid, 0b0101) is None
+    assert cache.get(uuid4(), 0b1010) is None
+    assert sample_value(metric, outcome="hit") == hits_before + 1
+    assert sample_value(metric, outcome="near_hit") == near_hits_before + 1
+
+    # The least recently used entries are evicted
+    for photo_hash in (0b1 << 10, 0b1 << 20, 0b1 << 30):
+        cache.put(user_uuid, photo_hash, ("Someone", 0.5))
+    assert len(cache) == 3
+    assert cache.get(user_uuid, 0b1010) is None
+
+    # Expired entries are not served
+    cache.ttl = -1
+    cache.put(user_uuid, (1 << 40) - 1, ("Someone", 0.5))
+    time.sleep(0.001)
+    assert cache.get(user_uuid, (1 << 40) - 1) is None
+
+    cache.clear()
+    assert len(cache) == 0
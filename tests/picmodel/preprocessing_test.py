@@ -0,0 +1,78 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from userauth.picmodel.preprocessing import (
+    CHANNEL_MEAN,
+    CHANNEL_STD,
+    ImagePreprocessor,
+    ImageTooLarge,
+    InvalidImage,
+    check_image,
+    synthetic_image,
+)
+
+
+def encode_image(image: Image.Image, **save_options) -> bytes:
+    output = io.BytesIO()
+    image.save(output, **save_options)
+    return output.getvalue()
+
+
+def test_check_image():
+    """Test that invalid images are rejected from their header."""
+    check_image(synthetic_image(64, 48))
+    check_image(bytearray(encode_image(Image.new("RGB", (8, 8)), format="PNG")))
+
+    with pytest.raises(InvalidImage):
+        check_image(b"not an image")
+    with pytest.raises(InvalidImage):
+        check_image(encode_image(Image.new("RGB", (8, 8)), format="GIF"))
+    with pytest.raises(ImageTooLarge):
+        check_image(synthetic_image(100, 100), max_pixels=9999)
+
+
+def test_preprocess_batch():
+    """Test the normalized batches and the errors of the invalid images."""
+    preprocessor = ImagePreprocessor(size=32)
+    red_image = encode_image(Image.new("RGB", (80, 40), (255, 0, 0)), format="PNG")
+
+    batch, errors = preprocessor.preprocess_batch(
+        [red_image, b"broken", synthetic_image(50, 60)]
+    )
+    assert batch.shape == (2, 32, 32, 3)
+    assert batch.dtype == np.float32
+    assert batch.flags["C_CONTIGUOUS"]
+    assert list(errors) == [1]
+    assert isinstance(errors[1], InvalidImage)
+
+    expected = (np.array([1.0, 0.0, 0.0]) - CHANNEL_MEAN) / CHANNEL_STD
+    assert np.allclose(batch[0], expected, atol=1e-5)
+    preprocessor.release(batch)
+
+    # The buffers are reused by the following batches
+    allocations = preprocessor._batch_pool.allocations
+    for _ in range(3):
+        batch, errors = preprocessor.preprocess_batch([red_image, red_image])
+        preprocessor.release(batch)
+    assert preprocessor._batch_pool.allocations == allocations
+
+
+def test_exif_orientation():
+    """Test that images are rotated as indicated by their EXIF tags."""
+    preprocessor = ImagePreprocessor(size=16)
+
+    # Left half black and right half white, stored rotated by 90 degrees
+    image = Image.new("RGB", (16, 16), (0, 0, 0))
+    image.paste((255, 255, 255), (8, 0, 16, 16))
+    exif = Image.Exif()
+    exif[0x0112] = 8
+    rotated_data = encode_image(
+        image.transpose(Image.Transpose.ROTATE_270), format="PNG", exif=exif
+    )
+
+    decoded = np.asarray(preprocessor.decode(rotated_data))
+    assert decoded[:, :4].max() < 10
+    assert decoded[:, 12:].min() > 245
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+
+from userauth.picmodel.celeb_detector import CelebDetector
+from userauth.picmodel.registry import ModelRegistry
+
+
+class CountingDetector(CelebDetector):
+    """Detector that records its warm-up inferences."""
+
+    def __init__(self, filepath: Path):
+        super().__init__(filepath)
+        self.inferences = 0
+
+    def predict(self, image, output_name, output_percent):
+        self.inferences += 1
+        return super().predict(image, output_name, output_percent)
+
+
+@pytest.mark.asyncio
+async def test_model_registry():
+    """Test that the model is loaded once, warmed up and hot-swapped."""
+    registry = ModelRegistry(model_class=CountingDetector)
+    assert not registry.is_loaded
+
+    first_detector = await registry.get()
+    assert await registry.get() is first_detector
+    assert first_detector.inferences == 1
+
+    second_detector = await registry.load(Path("other_model.h5"), warmup=3)
+    assert second_detector is not first_detector
+    assert second_detector.inferences == 3
+    assert await registry.get() is second_detector
+    assert registry.model_path == Path("other_model.h5")
+
+    # Reloading without a path reloads the current model file
+    third_detector = await registry.load(warmup=0)
+    assert third_detector.path_to_model == Path("other_model.h5")
+
+    registry.unload()
+    assert not registry.is_loaded
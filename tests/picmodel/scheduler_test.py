@@ -0,0 +1,130 @@
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pytest
+
+from userauth.common.metrics import sample_value
+from userauth.picmodel.celeb_detector import CelebDetector
+from userauth.picmodel.preprocessing import InvalidImage, synthetic_image
+from userauth.picmodel.registry import ModelRegistry
+from userauth.picmodel.scheduler import InferenceScheduler
+
+IMAGE = synthetic_image(64, 48)
+
+
+class BatchRecordingDetector(CelebDetector):
+    """Detector that records the size of the batches it runs."""
+
+    def __init__(self, filepath: Path):
+        super().__init__(filepath)
+        self.batch_sizes = []
+
+    def predict_batch(self, images, output_names, output_percents):
+        self.batch_sizes.append(len(images))
+        return super().predict_batch(images, output_names, output_percents)
+
+
+class CrashingDetector(CelebDetector):
+    """Detector whose process dies when asked to predict a `crash`."""
+
+    def predict_batch(self, images, output_names, output_percents):
+        if b"crash" in images:
+            os._exit(1)
+        return super().predict_batch(images, output_names, output_percents)
+
+
+@pytest.mark.asyncio
+async def test_inference_scheduler_batches():
+    """Test that concurrent predictions are run in batches."""
+    registry = ModelRegistry(model_class=BatchRecordingDetector)
+    scheduler = InferenceScheduler(
+        registry=registry,
+        max_batch_size=4,
+        max_wait=0.05,
+        workers=0,
+    )
+    await scheduler.start()
+    detector = await registry.get()
+    detector.batch_sizes.clear()
+    batches_before = sample_value("userauth_inference_batch_size_count")
+
+    predictions = await asyncio.gather(
+        *[scheduler.predict(IMAGE, f"name {idx}", idx / 10) for idx in range(10)]
+    )
+    assert predictions == [(f"name {idx}", idx / 10) for idx in range(10)]
+    assert detector.batch_sizes == [4, 4, 2]
+    assert sample_value("userauth_inference_batch_size_count") == batches_before + 3
+
+    # A lone prediction leaves after the maximum wait
+    assert await scheduler.predict(IMAGE, "alone", 0.5) == ("alone", 0.5)
+    assert detector.batch_sizes[-1] == 1
+
+    # Invalid images only fail their own prediction
+    predictions = await asyncio.gather(
+        scheduler.predict(IMAGE, "valid", 0.5),
+        scheduler.predict(b"broken", "invalid", 0.5),
+        return_exceptions=True,
+    )
+    assert predictions[0] == ("valid", 0.5)
+    assert isinstance(predictions[1], InvalidImage)
+
+    assert len(await scheduler.worker_memory()) == 1
+
+    await scheduler.stop()
+    assert not scheduler.is_running
+
+
+@pytest.mark.asyncio
+async def test_inference_scheduler_workers():
+    """Test the predictions and the model reload with a worker process."""
+    scheduler = InferenceScheduler(max_batch_size=8, max_wait=0.01, workers=1)
+    try:
+        await scheduler.start(Path("first_model.h5"))
+        assert scheduler.model_path == Path("first_model.h5")
+        first_load = scheduler.loaded_at
+
+        predictions = await asyncio.gather(
+            *[scheduler.predict(IMAGE, "name", 0.96) for _ in range(5)]
+        )
+        assert predictions == [("name", 0.96)] * 5
+
+        await scheduler.reload(Path("second_model.h5"))
+        assert scheduler.model_path == Path("second_model.h5")
+        assert scheduler.loaded_at >= first_load
+        assert await scheduler.predict(IMAGE, "name", 0.5) == ("name", 0.5)
+
+        # The memory is sampled in the worker (not in this process)
+        memory = await scheduler.worker_memory()
+        assert len(memory) == 1 and memory[0]["peak_rss"] > 0
+    finally:
+        await scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_inference_scheduler_worker_crash():
+    """Test that a crashed worker is replaced by a new one."""
+    registry = ModelRegistry(model_class=CrashingDetector)
+    scheduler = InferenceScheduler(
+        registry=registry,
+        max_batch_size=8,
+        max_wait=0.01,
+        workers=1,
+    )
+    try:
+        await scheduler.start(Path("model.h5"))
+        metric = "userauth_inference_worker_restarts_total"
+        restarts_before = sample_value(metric)
+
+        with pytest.raises(BrokenProcessPool):
+            await scheduler.predict(b"crash", "name", 0.5)
+        assert sample_value(metric) == restarts_before + 1
+        assert scheduler.model_path == Path("model.h5")
+
+        predictions = await asyncio.gather(
+            *[scheduler.predict(IMAGE, "name", 0.96) for _ in range(3)]
+        )
+        assert predictions == [("name", 0.96)] * 3
+    finally:
+        await scheduler.stop()
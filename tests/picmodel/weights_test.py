@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from userauth.picmodel.celeb_detector import CelebDetector
+from userauth.picmodel.weights import (
+    MappedWeights,
+    convert_h5,
+    memory_usage,
+    quantize_int8,
+    save_weights,
+)
+
+
+def model_arrays():
+    generator = np.random.default_rng(0)
+    return {
+        "conv/kernel": generator.standard_normal((3, 3, 3, 8)).astype(np.float32),
+        "conv/bias": generator.standard_normal(8).astype(np.float32),
+        "dense/kernel": generator.standard_normal((72, 10)).astype(">f4"),
+        "steps": np.arange(5, dtype=np.int64),
+    }
+
+
+def test_mapped_weights(tmp_path):
+    """Test that the mapped arrays are read-only views equal to the saved ones."""
+    arrays = model_arrays()
+    save_weights(arrays, tmp_path / "weights")
+    weights = MappedWeights(tmp_path / "weights")
+
+    assert set(weights) == set(arrays)
+    for name, array in arrays.items():
+        assert weights[name].dtype.isnative
+        np.testing.assert_array_equal(weights[name], array)
+        assert weights.scale(name) is None
+    assert not weights["conv/kernel"].flags.writeable
+
+
+def test_quantized_weights(tmp_path):
+    """Test that only the kernels are quantized, within the expected error."""
+    arrays = model_arrays()
+    save_weights(arrays, tmp_path / "weights", quantize=True)
+    weights = MappedWeights(tmp_path / "weights")
+
+    assert weights.is_quantized("conv/kernel")
+    assert weights["conv/kernel"].dtype == np.int8
+    assert not weights.is_quantized("conv/bias")
+    assert not weights.is_quantized("steps")
+
+    kernel = arrays["conv/kernel"]
+    max_error = np.abs(weights.dequantized("conv/kernel") - kernel).max(axis=(0, 1, 2))
+    assert np.all(max_error <= np.abs(kernel).max(axis=(0, 1, 2)) / 254 + 1e-6)
+
+    quantized, scale = quantize_int8(np.zeros((4, 2)))
+    assert np.all(quantized == 0) and np.all(scale == 1)
+
+
+def test_convert_h5(tmp_path):
+    """Test the conversion of the datasets of an HDF5 file."""
+    h5py = pytest.importorskip("h5py")
+    with h5py.File(tmp_path / "model.h5", "w") as h5_file:
+        h5_file["model_weights/dense/kernel"] = np.ones((4, 2), dtype=np.float32)
+        h5_file["model_weights/dense/bias"] = np.zeros(2, dtype=np.float32)
+
+    convert_h5(tmp_path / "model.h5", tmp_path / "weights")
+    weights = MappedWeights(tmp_path / "weights")
+    np.testing.assert_array_equal(weights["model_weights/dense/kernel"], 1)
+
+
+def test_detector_with_mapped_weights(tmp_path):
+    """Test that the detector maps the converted weights it is given."""
+    save_weights(model_arrays(), tmp_path / "weights")
+    assert CelebDetector(tmp_path / "weights").weights is not None
+    assert CelebDetector(tmp_path / "model.h5").weights is None
+
+    usage = memory_usage()
+    assert usage["rss"] > 0 and usage["peak_rss"] > 0
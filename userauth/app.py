@@ -0,0 +1,154 @@
+"""
+Module with the factory of the REST API application.
+
+The server runs several worker processes, each one importing this module
+and calling `create_app` (so that nothing is shared between them but the
+listening socket). The one-time work, like creating the database schema
+or loading the model weights into the page cache, is done once in the
+parent process by `prepare_server`, before the workers start.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from prometheus_client import Gauge
+
+# Reference of the startup times (the workers import this module first)
+STARTED_AT = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+# Set by the parent process once the one-time work is done
+PREPARED_ENV_VAR = "USERAUTH_SERVER_PREPARED"
+
+STARTUP_SECONDS = Gauge(
+    "userauth_startup_seconds",
+    "Time from the start of the worker until it is ready to serve requests "
+    "(the slowest worker).",
+    multiprocess_mode="livemax",
+)
+FIRST_REQUEST_SECONDS = Gauge(
+    "userauth_first_request_seconds",
+    "Time from the start of the worker until its first request was served "
+    "(the slowest worker).",
+    multiprocess_mode="livemax",
+)
+
+
+class FirstRequestTimer:
+    """ASGI middleware measuring the time until the first request is served.
+
+    Once measured, requests go straight through it.
+    """
+
+    def __init__(self, app):
+        """Wrap an ASGI application."""
+        self.app = app
+        self.served = False
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+        if not self.served and scope["type"] == "http":
+            self.served = True
+            seconds = time.perf_counter() - STARTED_AT
+            FIRST_REQUEST_SECONDS.set(seconds)
+            logger.info("first request served %.2fs after start", seconds)
+
+
+async def prepare_database():
+    """Create the database schema and close the connections used for it."""
+    from userauth.database.session import get_engine, safe_create_db
+
+    await safe_create_db()
+    # Connections must not be inherited by the workers
+    await get_engine().dispose()
+
+
+def prepare_server():
+    """Run the one-time work of the server, before starting the workers.
+
+    The directory of the metrics is prepared even before, by the command
+    starting the server (see `userauth.common.metrics`).
+    """
+    from userauth.picmodel.registry import configured_model_path
+    from userauth.picmodel.weights import MappedWeights, is_weights_dir
+
+    asyncio.run(prepare_database())
+
+    model_path = configured_model_path()
+    if is_weights_dir(model_path):
+        # Read once here, the workers map the pages already in the cache
+        MappedWeights(model_path).preload()
+        logger.info("preloaded the model weights in %s", model_path)
+
+    os.environ[PREPARED_ENV_VAR] = "1"
+
+
+@asynccontextmanager
+async def lifespan_function(app: FastAPI):
+    """Create the database and return control to API service.
+
+    The user cache starts listening to invalidations from the other
+    replicas, and stops when the server shuts down. The celebrity
+    detector is loaded (and warmed up) once in the inference workers,
+    before accepting requests, and the asynchronous jobs left unfinished
+    by a previous run are resumed.
+    The schema is only created here when the parent process didn't. With
+    the metrics enabled, the worker samples the state of its database
+    pool periodically, and drops its gauges from the exported metrics
+    when it exits.
+    """
+    from userauth.common.config import get_server_config
+    from userauth.common.metrics import mark_process_dead
+    from userauth.database import safe_create_db, start_cache, stop_cache
+    from userauth.endpoints.jobs import JOB_RUNNER
+    from userauth.endpoints.monitoring import sample_pool_periodically
+    from userauth.picmodel import INFERENCE_SCHEDULER
+
+    if os.getenv(PREPARED_ENV_VAR) != "1":
+        await safe_create_db()
+    await start_cache()
+    await INFERENCE_SCHEDULER.start()
+    await JOB_RUNNER.start()
+    startup_seconds = time.perf_counter() - STARTED_AT
+    STARTUP_SECONDS.set(startup_seconds)
+    logger.info("ready to serve requests %.2fs after start", startup_seconds)
+
+    server_config = get_server_config()
+    sample_task = None
+    if server_config.METRICS_ENABLED:
+        sample_task = asyncio.create_task(
+            sample_pool_periodically(server_config.METRICS_SAMPLE_SECONDS)
+        )
+    yield
+    if sample_task is not None:
+        sample_task.cancel()
+    await JOB_RUNNER.stop()
+    await INFERENCE_SCHEDULER.stop()
+    await stop_cache()
+    mark_process_dead()
+
+
+def create_app() -> FastAPI:
+    """Create the REST API application (once per worker process)."""
+    from userauth.common.config import get_server_config
+    from userauth.endpoints import authentication, resources
+    from userauth.endpoints.monitoring import RequestMetricsMiddleware
+    from userauth.endpoints.uploads import UploadLimitMiddleware
+
+    app = FastAPI(
+        title="UserAuth",
+        description="A python-based user authentication REST-API server for automated celebrity recognition.",
+        version="0.1.0",
+        lifespan=lifespan_function,
+    )
+    app.include_router(router=authentication)
+    app.include_router(router=resources)
+    if get_server_config().METRICS_ENABLED:
+        app.add_middleware(RequestMetricsMiddleware)
+    app.add_middleware(UploadLimitMiddleware)
+    app.add_middleware(FirstRequestTimer)
+    return app
@@ -0,0 +1,507 @@
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from uuid import uuid4
+
+import click
+
+
+@click.group("bench")
+def cmd_bench():
+    """Commands to benchmark the performance critical paths."""
+
+
+def best_rate(function, rows, repeat):
+    """Run the function several times and return the best rows per second."""
+    best_time = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        best_time = min(best_time, time.perf_counter() - start_time)
+    return rows / best_time
+
+
+@cmd_bench.command("serialization")
+@click.option(
+    "-n",
+    "--rows",
+    type=int,
+    default=10000,
+    show_default=True,
+    help="Number of login rows in the list.",
+)
+@click.option(
+    "-r",
+    "--repeat",
+    type=int,
+    default=5,
+    show_default=True,
+    help="Number of runs (the best one is reported).",
+)
+def cmd_bench_serialization(rows, repeat):
+    """Compare the validated and the trusted serialization of login lists."""
+    from typing import List
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from pydantic import TypeAdapter
+
+    from userauth.database import LoginEntry
+    from userauth.endpoints.models import LoginRecord
+    from userauth.endpoints.serialization import RowsResponse, login_row, orjson
+
+    user_uuid = uuid4()
+    start_time = datetime.now()
+    login_entries = [
+        LoginEntry(
+            uuid=uuid4(),
+            user=user_uuid,
+            ctime=start_time + timedelta(seconds=idx),
+        )
+        for idx in range(rows)
+    ]
+    response_adapter = TypeAdapter(List[LoginRecord])
+
+    def validated_path():
+        # What the endpoints did before: validated models, validated again
+        # against the response model and encoded with the stdlib encoder
+        logins_list = [
+            LoginRecord(
+                uuid=entry.uuid,
+                user_uuid=entry.user,
+                login_time=entry.ctime,
+            )
+            for entry in login_entries
+        ]
+        logins_list = response_adapter.validate_python(logins_list)
+        content = response_adapter.dump_python(logins_list, mode="json")
+        return JSONResponse(jsonable_encoder(content)).body
+
+    def trusted_path():
+        return RowsResponse([login_row(entry) for entry in login_entries]).body
+
+    before = best_rate(validated_path, rows, repeat)
+    after = best_rate(trusted_path, rows, repeat)
+    encoder = "json" if orjson is None else "orjson"
+    print(f"Validated serialization: {before:12,.0f} rows/s")
+    print(f"Trusted serialization:   {after:12,.0f} rows/s ({encoder})")
+    print(f"Speedup: {after / before:.1f}x")
+
+
+def load_detector_stats(model_path, warmup, results):
+    """Load a detector in a fresh process and report its load time and memory."""
+    from userauth.picmodel.registry import MODEL_REGISTRY
+    from userauth.picmodel.weights import memory_usage
+
+    start_time = time.perf_counter()
+    detector = MODEL_REGISTRY.model_class(model_path)
+    detector.warmup(warmup)
+    stats = memory_usage()
+    stats["load_seconds"] = time.perf_counter() - start_time
+    results.put(stats)
+
+
+@cmd_bench.command("startup")
+@click.argument("model_path", type=click.Path(exists=True, path_type=Path))
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Number of worker processes loading the model at the same time.",
+)
+@click.option(
+    "--warmup",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of warm-up inferences of each worker.",
+)
+def cmd_bench_startup(model_path, workers, warmup):
+    """Measure the load time and memory of the workers loading a model.
+
+    The model can be an .h5 file or a directory of converted weights,
+    whose pages are shared by the workers (the `shared` column).
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=load_detector_stats,
+            args=(model_path, warmup, results),
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    worker_stats = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    mebibyte = 2**20
+    print("Worker  Load (s)  RSS (MiB)  Private (MiB)  Shared (MiB)")
+    for idx, stats in enumerate(worker_stats):
+        print(
+            f"{idx:6d}  {stats['load_seconds']:8.2f}  {stats['rss'] / mebibyte:9.1f}"
+            f"  {stats.get('private', 0) / mebibyte:13.1f}"
+            f"  {stats.get('shared', 0) / mebibyte:12.1f}"
+        )
+    total_private = sum(stats.get("private", stats["rss"]) for stats in worker_stats)
+    print(f"Total private memory: {total_private / mebibyte:.1f} MiB")
+
+
+DETECTOR_CLASSES = {
+    "celeb": "userauth.picmodel.celeb_detector:CelebDetector",
+    "cascade": "userauth.picmodel.cascade:CascadedDetector",
+}
+
+
+def load_detector_class(detector):
+    """Detector class from its short name or its `module:Class` path."""
+    import importlib
+
+    module_name, _, class_name = DETECTOR_CLASSES.get(detector, detector).partition(":")
+    try:
+        return getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError):
+        raise click.BadParameter(f"can't import the detector `{detector}`")
+
+
+def parse_int_list(ctx, param, value):
+    try:
+        values = [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        values = []
+    if not values:
+        raise click.BadParameter("expected a comma separated list of integers")
+    return values
+
+
+async def run_picmodel_point(
+    model_class,
+    model_path,
+    images,
+    requests,
+    batch_size,
+    workers,
+    concurrency,
+    max_wait,
+):
+    """Run the requests through an inference scheduler and measure them."""
+    import asyncio
+
+    import numpy as np
+
+    from userauth.picmodel.registry import ModelRegistry
+    from userauth.picmodel.scheduler import InferenceScheduler
+
+    scheduler = InferenceScheduler(
+        registry=ModelRegistry(model_class=model_class),
+        max_batch_size=batch_size,
+        max_wait=max_wait,
+        workers=workers,
+    )
+    await scheduler.start(model_path)
+    try:
+        # One untimed round, so that the workers have seen a batch
+        await asyncio.gather(
+            *(scheduler.predict(images[0], "", 0.0) for _ in range(batch_size))
+        )
+
+        latencies = []
+        next_request = 0
+
+        async def client():
+            nonlocal next_request
+            while next_request < requests:
+                image = images[next_request % len(images)]
+                next_request += 1
+                start_time = time.perf_counter()
+                await scheduler.predict(image, "", 0.0)
+                latencies.append(time.perf_counter() - start_time)
+
+        batches_before = scheduler.batches
+        start_time = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+        batches = scheduler.batches - batches_before
+        memory = await scheduler.worker_memory()
+    finally:
+        await scheduler.stop()
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {
+        "workers": workers,
+        "batch_size": batch_size,
+        "concurrency": concurrency,
+        "throughput": requests / elapsed,
+        "mean_batch": requests / batches,
+        "latency_ms": {"p50": p50, "p95": p95, "p99": p99},
+        "peak_rss_mib": max(sample["peak_rss"] for sample in memory) / 2**20,
+    }
+
+
+@cmd_bench.command("picmodel")
+@click.option(
+    "-d",
+    "--detector",
+    default="celeb",
+    show_default=True,
+    help=(
+        "Detector to measure: `celeb`, `cascade` or the `module:Class` "
+        "path of any class with the interface of the celebrity detector."
+    ),
+)
+@click.option(
+    "-m",
+    "--model-path",
+    type=click.Path(path_type=Path),
+    default=None,
+    help="Model file (or converted weights) of the detector.",
+)
+@click.option(
+    "-b",
+    "--batch-sizes",
+    default="1,4,16",
+    show_default=True,
+    callback=parse_int_list,
+    help="Comma separated maximum batch sizes to sweep.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    default="0,1,2",
+    show_default=True,
+    callback=parse_int_list,
+    help="Comma separated numbers of worker processes to sweep (0: a thread).",
+)
+@click.option(
+    "-n",
+    "--requests",
+    type=int,
+    default=500,
+    show_default=True,
+    help="Number of predictions per point of the sweep.",
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    type=int,
+    default=None,
+    help="Concurrent clients (by default, twice the batch size per worker).",
+)
+@click.option(
+    "--size",
+    type=(int, int),
+    default=(640, 480),
+    show_default=True,
+    help="Width and height of the synthetic images.",
+)
+@click.option(
+    "--max-wait-ms",
+    type=float,
+    default=5.0,
+    show_default=True,
+    help="Maximum time a batch waits to be filled.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="JSON file where the results are written (`-` for stdout).",
+)
+def cmd_bench_picmodel(
+    detector,
+    model_path,
+    batch_sizes,
+    workers,
+    requests,
+    concurrency,
+    size,
+    max_wait_ms,
+    output,
+):
+    """Measure the throughput, latency and memory of the photo predictions.
+
+    Synthetic photos are predicted through the inference scheduler for
+    each combination of batch size and number of workers.
+    """
+    import asyncio
+    import json
+
+    from userauth.picmodel.preprocessing import synthetic_image
+    from userauth.picmodel.registry import configured_model_path
+
+    model_class = load_detector_class(detector)
+    model_path = model_path or configured_model_path()
+    width, height = size
+    images = [synthetic_image(width, height, seed=seed) for seed in range(16)]
+
+    results = []
+    for worker_count in workers:
+        for batch_size in batch_sizes:
+            point_concurrency = concurrency or 2 * batch_size * max(1, worker_count)
+            result = asyncio.run(
+                run_picmodel_point(
+                    model_class,
+                    model_path,
+                    images,
+                    requests,
+                    batch_size,
+                    worker_count,
+                    point_concurrency,
+                    max_wait_ms / 1000,
+                )
+            )
+            results.append(result)
+            if output != Path("-"):
+                latency = result["latency_ms"]
+                print(
+                    f"workers={worker_count:<2d} batch={batch_size:<3d} "
+                    f"{result['throughput']:9.1f} img/s  "
+                    f"p50={latency['p50']:7.1f}ms  p95={latency['p95']:7.1f}ms  "
+                    f"p99={latency['p99']:7.1f}ms  "
+                    f"peak RSS={result['peak_rss_mib']:7.1f} MiB"
+                )
+
+    if output is not None:
+        report = {
+            "detector": f"{model_class.__module__}:{model_class.__qualname__}",
+            "model_path": str(model_path),
+            "image_size": [width, height],
+            "requests": requests,
+            "results": results,
+        }
+        content = json.dumps(report, indent=2)
+        if output == Path("-"):
+            print(content)
+        else:
+            output.write_text(content)
+
+
+@cmd_bench.command("metrics")
+@click.option(
+    "-n",
+    "--requests",
+    type=int,
+    default=20000,
+    show_default=True,
+    help="Number of requests per run.",
+)
+@click.option(
+    "-r",
+    "--repeat",
+    type=int,
+    default=5,
+    show_default=True,
+    help="Number of runs (the best one is reported).",
+)
+@click.option(
+    "--rps",
+    type=float,
+    default=500.0,
+    show_default=True,
+    help="Requests per second served by each worker.",
+)
+@click.option(
+    "--calls-per-request",
+    type=int,
+    default=4,
+    show_default=True,
+    help="Timed calls per request (database methods, hashes and tokens).",
+)
+def cmd_bench_metrics(requests, repeat, rps, calls_per_request):
+    """Measure the overhead of the metrics on the requests.
+
+    The requests go straight to the ASGI application (with and without the
+    request metrics), on a route that does nothing, so the difference is
+    only the cost of the instrumentation.
+    """
+    import asyncio
+
+    from fastapi import FastAPI
+    from prometheus_client import Histogram
+
+    from userauth.common.metrics import time_coroutines
+    from userauth.endpoints.monitoring import RequestMetricsMiddleware
+
+    def build_app(instrumented):
+        app = FastAPI()
+
+        @app.get("/users/{user_id}")
+        async def get_user(user_id: str):
+            return {"user_id": user_id}
+
+        if instrumented:
+            app.add_middleware(RequestMetricsMiddleware)
+        return app
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/users/someone",
+        "raw_path": b"/users/someone",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [],
+        "server": ("localhost", 8000),
+        "client": ("localhost", 50000),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    async def run_requests(app):
+        for _ in range(requests):
+            await app(dict(scope), receive, send)
+
+    class Manager:
+        async def query(self):
+            return None
+
+    histogram = Histogram("bench_seconds", "", ("method",), registry=None)
+
+    @time_coroutines(histogram, "method")
+    class TimedManager(Manager):
+        async def query(self):
+            return None
+
+    async def run_calls(manager):
+        for _ in range(requests):
+            await manager.query()
+
+    def best_seconds(coroutine_function, argument):
+        asyncio.run(coroutine_function(argument))  # warm-up
+        best_time = float("inf")
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            asyncio.run(coroutine_function(argument))
+            best_time = min(best_time, time.perf_counter() - start_time)
+        return best_time / requests
+
+    plain_request = best_seconds(run_requests, build_app(False))
+    timed_request = best_seconds(run_requests, build_app(True))
+    plain_call = best_seconds(run_calls, Manager())
+    timed_call = best_seconds(run_calls, TimedManager())
+
+    request_overhead = max(0.0, timed_request - plain_request)
+    call_overhead = max(0.0, timed_call - plain_call)
+    total_overhead = request_overhead + calls_per_request * call_overhead
+    cpu_share = 100 * total_overhead * rps
+    print(f"Request without metrics: {plain_request * 1e6:8.1f} us")
+    print(f"Request metrics:         {request_overhead * 1e6:8.1f} us per request")
+    print(f"Timed calls:             {call_overhead * 1e6:8.1f} us per call")
+    print(
+        f"Overhead at {rps:.0f} requests/s: {cpu_share:.2f}% of a core "
+        f"({'within' if cpu_share < 2 else 'above'} the 2% budget)"
+    )
@@ -1,4 +1,5 @@
 import asyncio
+from pathlib import Path
 
 import click
 
@@ -79,16 +80,157 @@ def cmd_database_makeadmin(username):
         async for mydatabase in get_database_manager():
             dbuser = await mydatabase.get_user(username=username)
             if dbuser is None:
-                return None
+                print(f"User {username} not found.")
+                return
             output = await mydatabase.update_user(
                 uuid=dbuser.uuid,
                 new_role=Role.admin,
                 new_username=username,
             )
-        return output
+            if output is None:
+                print(f"User {username} was modified concurrently, try again.")
+            else:
+                print(f"User {username} is now admin!")
 
-    updated = asyncio.run(internal_makeadmin(username))
-    if updated is None:
-        print(f"User {username} not found.")
-    else:
-        print(f"User {username} is now admin!")
+    asyncio.run(internal_makeadmin(username))
+
+
+@cmd_database.command("import")
+@click.argument(
+    "filepath",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+@click.option(
+    "-f",
+    "--format",
+    "fileformat",
+    type=click.Choice(["jsonl", "csv"]),
+    default="jsonl",
+    show_default=True,
+    help="Format of the input file.",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    type=int,
+    default=5000,
+    show_default=True,
+    help="Number of users inserted per transaction.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of processes hashing passwords (defaults to the CPU count).",
+)
+@click.option(
+    "-c",
+    "--checkpoint",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="File to keep track of the progress (re-run with it to resume).",
+)
+def cmd_database_import(filepath, fileformat, batch_size, workers, checkpoint):
+    """Import users in bulk from a file.
+
+    Each record must contain username, email, name, surname and either a
+    plain `password` or an already hashed `hashed_password`.
+    """
+    from userauth.database.importer import import_users
+    from userauth.database.session import get_engine
+
+    def report_progress(progress):
+        print(
+            f"Imported {progress.records_done} users "
+            f"({progress.throughput:.0f} users/s)",
+        )
+
+    progress = asyncio.run(
+        import_users(
+            get_engine(),
+            filepath,
+            fileformat,
+            batch_size=batch_size,
+            workers=workers,
+            checkpoint_path=checkpoint,
+            progress_callback=report_progress,
+        )
+    )
+    print(
+        f"Import finished: {progress.records_done - progress.records_skipped} users "
+        f"in {progress.elapsed_seconds:.1f}s.",
+    )
+
+
+@cmd_database.command("export")
+@click.argument(
+    "directory",
+    type=click.Path(file_okay=False, path_type=Path),
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=10000,
+    show_default=True,
+    help="Number of rows per compressed chunk.",
+)
+@click.option(
+    "--database-url",
+    type=str,
+    default=None,
+    help="Database to export from (defaults to the server database).",
+)
+def cmd_database_export(directory, chunk_size, database_url):
+    """Export the users, logins and jobs tables into a backup directory."""
+    from userauth.database.backup import export_database
+
+    async def internal_export():
+        engine = get_engine_for(database_url)
+        try:
+            return await export_database(engine, directory, chunk_size=chunk_size)
+        finally:
+            await engine.dispose()
+
+    manifest = asyncio.run(internal_export())
+    for table_name, entry in manifest["tables"].items():
+        print(f"Exported {entry['rows']} rows from {table_name}.")
+
+
+@cmd_database.command("restore")
+@click.argument(
+    "directory",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+)
+@click.option(
+    "--database-url",
+    type=str,
+    default=None,
+    help="Database to restore into (defaults to the server database).",
+)
+def cmd_database_restore(directory, database_url):
+    """Restore the users, logins and jobs tables from a backup directory."""
+    from userauth.database.backup import restore_database
+
+    async def internal_restore():
+        engine = get_engine_for(database_url)
+        try:
+            return await restore_database(engine, directory)
+        finally:
+            await engine.dispose()
+
+    restored = asyncio.run(internal_restore())
+    for table_name, row_count in restored.items():
+        print(f"Restored {row_count} rows into {table_name}.")
+
+
+def get_engine_for(database_url):
+    """Return an engine for the given url, or the server engine if None."""
+    if database_url is None:
+        from userauth.database.session import get_engine
+
+        return get_engine()
+
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    return create_async_engine(database_url)
@@ -0,0 +1,101 @@
+from pathlib import Path
+
+import click
+
+
+@click.group("gallery")
+def cmd_gallery():
+    """Commands to manage the gallery of celebrity embeddings."""
+
+
+def load_embeddings(embeddings_path, names_path):
+    """Read a .npy matrix of embeddings and a text file with a name per line."""
+    import numpy as np
+
+    embeddings = np.load(embeddings_path, mmap_mode="r")
+    names = names_path.read_text(encoding="utf-8").splitlines()
+    if embeddings.ndim != 2 or len(embeddings) != len(names):
+        raise click.BadParameter(
+            "the embeddings must be a matrix with one row per name",
+        )
+    return embeddings, names
+
+
+def append_in_chunks(gallery, embeddings, names, chunk_rows=100000):
+    for start in range(0, len(names), chunk_rows):
+        end = start + chunk_rows
+        gallery.append(embeddings[start:end], names[start:end])
+
+
+def index_gallery(gallery, lists):
+    """Build the IVF index (by default, only for galleries large enough)."""
+    from userauth.picmodel.gallery import IVF_MIN_ROWS
+
+    if lists is None:
+        if len(gallery) < IVF_MIN_ROWS:
+            return
+        lists = 4 * int(len(gallery) ** 0.5)
+    if lists > 0:
+        gallery.build_index(lists)
+        print(f"Indexed {len(gallery)} embeddings in {lists} lists.")
+
+
+EMBEDDINGS_ARGUMENT = click.argument(
+    "embeddings_path",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+NAMES_ARGUMENT = click.argument(
+    "names_path",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+LISTS_OPTION = click.option(
+    "-l",
+    "--lists",
+    type=int,
+    default=None,
+    help=(
+        "Number of lists of the IVF index (0 for none; by default, "
+        "4 x sqrt(rows) for galleries of 1M rows or more)."
+    ),
+)
+
+
+@cmd_gallery.command("build")
+@click.argument("gallery_path", type=click.Path(file_okay=False, path_type=Path))
+@EMBEDDINGS_ARGUMENT
+@NAMES_ARGUMENT
+@LISTS_OPTION
+def cmd_gallery_build(gallery_path, embeddings_path, names_path, lists):
+    """Create a gallery from embeddings (.npy) and names (one per line)."""
+    from userauth.picmodel.gallery import EmbeddingGallery
+
+    embeddings, names = load_embeddings(embeddings_path, names_path)
+    gallery = EmbeddingGallery.create(gallery_path, embeddings.shape[1])
+    append_in_chunks(gallery, embeddings, names)
+    print(f"Gallery created with {len(gallery)} embeddings.")
+    index_gallery(gallery, lists)
+
+
+@cmd_gallery.command("append")
+@click.argument(
+    "gallery_path",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+)
+@EMBEDDINGS_ARGUMENT
+@NAMES_ARGUMENT
+@click.option(
+    "--reindex",
+    is_flag=True,
+    help="Rebuild the IVF index (otherwise the new rows are searched exhaustively).",
+)
+@LISTS_OPTION
+def cmd_gallery_append(gallery_path, embeddings_path, names_path, reindex, lists):
+    """Add embeddings (.npy) and names (one per line) to a gallery."""
+    from userauth.picmodel.gallery import EmbeddingGallery
+
+    embeddings, names = load_embeddings(embeddings_path, names_path)
+    gallery = EmbeddingGallery(gallery_path)
+    append_in_chunks(gallery, embeddings, names)
+    print(f"Gallery has now {len(gallery)} embeddings.")
+    if reindex:
+        index_gallery(gallery, lists if lists is not None else gallery.ivf_lists)
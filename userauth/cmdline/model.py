@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import click
+
+
+@click.group("model")
+def cmd_model():
+    """Commands to manage the celebrity detection model."""
+
+
+@cmd_model.command("convert")
+@click.argument(
+    "h5_path",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+)
+@click.argument("output_path", type=click.Path(file_okay=False, path_type=Path))
+@click.option(
+    "-q",
+    "--quantize",
+    is_flag=True,
+    help="Store the kernels quantized to int8 (a quarter of the size).",
+)
+def cmd_model_convert(h5_path, output_path, quantize):
+    """Convert the weights of an .h5 model into memory-mappable weights.
+
+    The output directory can be used as the model path of the server, so
+    that all the worker processes share the same (read-only) weights.
+    """
+    from userauth.picmodel.weights import MappedWeights, convert_h5
+
+    try:
+        convert_h5(h5_path, output_path, quantize)
+    except RuntimeError as exception:
+        raise click.ClickException(str(exception))
+
+    weights = MappedWeights(output_path)
+    print(f"Converted {len(weights)} arrays ({weights.nbytes / 2**20:.1f} MiB).")
@@ -1,6 +1,9 @@
 import click
 
+from .bench import cmd_bench
 from .database import cmd_database
+from .gallery import cmd_gallery
+from .model import cmd_model
 from .server import cmd_server
 
 
@@ -11,3 +14,6 @@ def cmd_root():
 
 cmd_root.add_command(cmd_server)
 cmd_root.add_command(cmd_database)
+cmd_root.add_command(cmd_bench)
+cmd_root.add_command(cmd_gallery)
+cmd_root.add_command(cmd_model)
@@ -19,33 +19,79 @@ def cmd_server():
     default=8000,
     help="Port to use for deploying the server.",
 )
-def cmd_server_start(ip, port):
-    """Start the REST API server."""
-    from contextlib import asynccontextmanager
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of worker processes (usually, one per core of the pod).",
+)
+@click.option(
+    "--loop",
+    type=click.Choice(["auto", "asyncio", "uvloop"]),
+    default="auto",
+    show_default=True,
+    help="Event loop of the workers (uvloop if installed, with auto).",
+)
+@click.option(
+    "--http",
+    type=click.Choice(["auto", "h11", "httptools"]),
+    default="auto",
+    show_default=True,
+    help="HTTP parser of the workers (httptools if installed, with auto).",
+)
+@click.option(
+    "--backlog",
+    type=int,
+    default=2048,
+    show_default=True,
+    help="Maximum number of connections waiting to be accepted.",
+)
+@click.option(
+    "--limit-concurrency",
+    type=int,
+    default=None,
+    help="Maximum concurrent connections per worker, beyond which 503 is returned.",
+)
+def cmd_server_start(ip, port, workers, loop, http, backlog, limit_concurrency):
+    """Start the REST API server.
 
+    The database schema is created and the model weights are loaded once,
+    before starting the workers; each worker then creates its own
+    application (and database connections) from `userauth.app:create_app`.
+    With the metrics enabled, this process exports the metrics of all the
+    workers on their own address (METRICS_HOST and METRICS_PORT), apart
+    from the public API.
+    """
     import uvicorn
-    from fastapi import FastAPI
-
-    from userauth.database import safe_create_db
-    from userauth.endpoints import authentication, resources
-
-    @asynccontextmanager
-    async def lifespan_function(app: FastAPI):
-        """Create the database and return control to API service.
-
-        There is nothing after yielding because there are no resources
-        to release at shutdown time.
-        """
-        await safe_create_db()
-        yield
-
-    app = FastAPI(
-        title="UserAuth",
-        description="A python-based user authentication REST-API server for automated celebrity recognition.",
-        version="0.1.0",
-        lifespan=lifespan_function,
-    )
-    app.include_router(router=authentication)
-    app.include_router(router=resources)
 
-    uvicorn.run(app=app, host=ip, port=port)
+    from userauth.common.config import get_server_config
+    from userauth.common.metrics import prepare_metrics_dir
+
+    server_config = get_server_config()
+    if server_config.METRICS_ENABLED:
+        # Before the modules creating the metrics are imported
+        prepare_metrics_dir()
+
+    from userauth.app import prepare_server
+    from userauth.endpoints.monitoring import start_metrics_server
+
+    prepare_server()
+    if server_config.METRICS_ENABLED:
+        start_metrics_server(
+            server_config.METRICS_HOST,
+            server_config.METRICS_PORT,
+            server_config.METRICS_DIR,
+        )
+    uvicorn.run(
+        "userauth.app:create_app",
+        factory=True,
+        host=ip,
+        port=port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=backlog,
+        limit_concurrency=limit_concurrency,
+    )
@@ -25,6 +25,78 @@ class ServerConfig(BaseModel):
     AUTH_ALGORITHM: str = "HS256"
     AUTH_EXPIRATION_MINS: int = 30
 
+    # fuzzy user search through the pg_trgm extension (postgres only,
+    # otherwise postgres matches the users containing the query)
+    SEARCH_TRIGRAM: bool = False
+
+    # cache of user lookups: None (disabled), "memory://" (in-process)
+    # or "redis://host:port/db" (in-process + shared between replicas,
+    # through a pool of connections whose commands are treated as misses
+    # when they take longer than the timeout)
+    CACHE_URL: Optional[str] = None
+    CACHE_TTL_SECONDS: float = 30.0
+    CACHE_LOCAL_MAX_ENTRIES: int = 10000
+    CACHE_TIMEOUT_SECONDS: float = 0.1
+    CACHE_POOL_SIZE: int = 4
+
+    # user lookup fields whose concurrent queries are shared between
+    # requests (comma separated, empty to disable)
+    SINGLE_FLIGHT_SCOPES: str = "uuid,username,email"
+
+    # celebrity detector model (None: the one shipped in the package) and
+    # number of warm-up inferences run when it is loaded
+    CELEB_MODEL_PATH: Optional[str] = None
+    CELEB_MODEL_WARMUP: int = 1
+
+    # directory of the gallery of celebrity embeddings the photos are
+    # matched against (None: no gallery, see `userauth gallery build`)
+    CELEB_GALLERY_PATH: Optional[str] = None
+
+    # run cheap checks (face presence, name in the gallery) before the
+    # celebrity detector, which only sees the photos passing them (off by
+    # default: the face check rejects color photos with hardly any skin
+    # tones, even if they show a face)
+    CELEB_CASCADE: bool = False
+
+    # maximum size of the uploaded photos, in bytes
+    MAX_UPLOAD_BYTES: int = 10 * 1024 * 1024
+
+    # cache of the predictions of the submitted photos, by user and
+    # perceptual hash (photos whose hashes differ in up to the given
+    # number of bits share the prediction; 0 entries disables the cache)
+    PHOTO_CACHE_MAX_ENTRIES: int = 10000
+    PHOTO_CACHE_TTL_SECONDS: float = 3600.0
+    PHOTO_CACHE_MAX_DISTANCE: int = 6
+
+    # number of asynchronous jobs (photo validations requested with the
+    # `Prefer: respond-async` header) run concurrently in the background
+    JOB_WORKERS: int = 4
+
+    # seconds a job stays claimed by the process running it: once expired
+    # (the process stopped without finishing it), another process runs it
+    # again, so it must be longer than the jobs take
+    JOB_LEASE_SECONDS: float = 600.0
+
+    # micro-batching of the detector inferences: batches are sent when
+    # full or when their first image waited the given milliseconds, and
+    # run in the given number of worker processes (0: in a thread of the
+    # server process, with the detector of the model registry)
+    INFERENCE_MAX_BATCH_SIZE: int = 16
+    INFERENCE_MAX_WAIT_MS: float = 5.0
+    INFERENCE_WORKERS: int = 1
+
+    # count and time the requests by route, and export all the metrics of
+    # the server (added up across its workers) at `/metrics` of a separate
+    # port, meant to stay internal (bound to the given host, by default
+    # only reachable from the pod); the workers write their metrics to a
+    # shared directory (by default, a temporary one) and sample the state
+    # of their database pool every given seconds
+    METRICS_ENABLED: bool = False
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int = 9100
+    METRICS_SAMPLE_SECONDS: float = 1.0
+    METRICS_DIR: Optional[str] = None
+
 
 def envload_dburl():
     """Load the database URL from the environment."""
@@ -55,13 +127,49 @@ def envload_dburl():
     return postgresql_string
 
 
-deployment_type = os.getenv("DEPLOYMENT_TYPE", default="DEV")
+def envload_overrides():
+    """Load overrides of the server configuration from the environment.
 
-if deployment_type == "PROD":
-    dburl = envload_dburl()
-    SERVER_CONFIG = ServerConfig(
-        DATABASE_ENGINE_URL=dburl,
-        DATABASE_ENGINE_ARGS=None,
-    )
-else:
-    SERVER_CONFIG = ServerConfig()
+    Any field of the ServerConfig with a simple value can be set through
+    a `USERAUTH_<FIELD NAME>` environment variable.
+    """
+    overrides = {}
+    for field_name in ServerConfig.model_fields:
+        value = os.getenv(f"USERAUTH_{field_name}")
+        if value is not None:
+            overrides[field_name] = value
+    return overrides
+
+
+def load_server_config() -> ServerConfig:
+    """Build the server configuration from the environment."""
+    deployment_type = os.getenv("DEPLOYMENT_TYPE", default="DEV")
+    overrides = envload_overrides()
+
+    if deployment_type == "PROD":
+        settings = {"DATABASE_ENGINE_ARGS": None}
+        # An explicit USERAUTH_DATABASE_ENGINE_URL takes precedence
+        if "DATABASE_ENGINE_URL" not in overrides:
+            settings["DATABASE_ENGINE_URL"] = envload_dburl()
+        return ServerConfig(**{**settings, **overrides})
+    return ServerConfig(**overrides)
+
+
+_server_config: Optional[ServerConfig] = None
+
+
+def get_server_config() -> ServerConfig:
+    """The server configuration (read from the environment on first use)."""
+    global _server_config
+
+    if _server_config is None:
+        _server_config = load_server_config()
+    return _server_config
+
+
+def __getattr__(name):
+    # `SERVER_CONFIG` is only built when first accessed, so importing this
+    # module (for example, from commands that don't need it) reads nothing
+    if name == "SERVER_CONFIG":
+        return get_server_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
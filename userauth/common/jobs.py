@@ -0,0 +1,17 @@
+"""
+Module for the status of the asynchronous jobs.
+
+Like the roles, it is separated so that both the database models and
+the models of the REST API can use it.
+"""
+from enum import Enum
+
+
+class JobStatus(Enum):
+    pending = "pending"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+FINISHED_JOB_STATUSES = (JobStatus.succeeded, JobStatus.failed)
@@ -0,0 +1,125 @@
+"""
+Module with the metrics of the server.
+
+Metrics are the counters, gauges and histograms of `prometheus_client`,
+declared by the modules they measure in its default registry.
+
+With several workers, they use the multiprocess mode of the library:
+every process writes its values to memory-mapped files in a shared
+directory (PROMETHEUS_MULTIPROC_DIR), which the exporter adds up when it
+is scraped. The files are named after the PID of the process, so that a
+worker restarted with the PID of one that exited continues its counters
+instead of replacing them. Counters and histograms cover all the
+workers, including the ones that exited, while gauges only cover the
+live workers (the ones that exit drop theirs).
+
+The library picks the multiprocess mode when it is imported, so the
+directory must be set before: `prepare_metrics_dir` is called first
+thing by the process starting the workers.
+"""
+import functools
+import inspect
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from userauth.common.config import get_server_config
+
+logger = logging.getLogger(__name__)
+
+# Directory of the metrics of the processes (read by prometheus_client)
+MULTIPROC_DIR_ENV_VAR = "PROMETHEUS_MULTIPROC_DIR"
+
+
+def prepare_metrics_dir() -> str:
+    """Create (or empty) the directory where the processes write their metrics.
+
+    Its path is set in the configuration, and in the environment for the
+    workers (and prometheus_client) to read it.
+    """
+    if "prometheus_client" in sys.modules:
+        logger.warning(
+            "prometheus_client was imported before setting %s: the metrics of "
+            "this process won't be exported",
+            MULTIPROC_DIR_ENV_VAR,
+        )
+
+    server_config = get_server_config()
+    directory = server_config.METRICS_DIR
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="userauth-metrics-")
+    os.makedirs(directory, exist_ok=True)
+    # Metrics left by a previous run would be added up to the new ones
+    for filename in os.listdir(directory):
+        if filename.endswith(".db"):
+            os.remove(os.path.join(directory, filename))
+
+    server_config.METRICS_DIR = directory
+    os.environ["USERAUTH_METRICS_DIR"] = directory
+    os.environ[MULTIPROC_DIR_ENV_VAR] = directory
+    return directory
+
+
+def mark_process_dead(pid: Optional[int] = None) -> None:
+    """Drop the gauges of a process that exits (this one by default)."""
+    directory = os.environ.get(MULTIPROC_DIR_ENV_VAR)
+    if directory is None:
+        return
+
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(os.getpid() if pid is None else pid, directory)
+
+
+def render_prometheus(directory: Optional[str] = None) -> str:
+    """The metrics in the Prometheus text format.
+
+    With a directory, the ones written there by all the processes (added
+    up), otherwise the ones of this process.
+    """
+    from prometheus_client import REGISTRY, CollectorRegistry, generate_latest
+    from prometheus_client.multiprocess import MultiProcessCollector
+
+    registry = REGISTRY
+    if directory is not None:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, path=directory)
+    return generate_latest(registry).decode()
+
+
+def sample_value(name: str, **labels: str) -> float:
+    """Value of a sample of the metrics of this process (0 if it has none)."""
+    from prometheus_client import REGISTRY
+
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def time_coroutines(histogram, labelname: str):
+    """Class decorator timing every public coroutine method in a histogram.
+
+    The observations are labelled with the name of the method.
+    """
+
+    def timed_method(name, method):
+        observe = histogram.labels(**{labelname: name}).observe
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - start_time)
+
+        return wrapper
+
+    def decorator(cls):
+        for name, method in list(vars(cls).items()):
+            if not name.startswith("_") and inspect.iscoroutinefunction(method):
+                setattr(cls, name, timed_method(name, method))
+        return cls
+
+    return decorator
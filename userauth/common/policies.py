@@ -6,8 +6,10 @@ the policy enforcers requires the definition of User and
 User require the definitions of Role.
 """
 from typing import Union
+from uuid import UUID
 
-from userauth.common.roles import Role
+from userauth.common.roles import CELEBRITY_MIN_PROBABILITY, Role
+from userauth.database.models import JobEntry, LoginEntry, UserEntry
 from userauth.endpoints.models import LoginRecord, User
 
 
@@ -39,6 +41,34 @@ class PolicyEnforcer:
 
         return False
 
+    def can_see_user_data(self, user_uuid: UUID):
+        """Check access rights to see the data (and logins) of a user by uuid."""
+        if self._user.role == Role.admin:
+            return True
+
+        return self._user.uuid == user_uuid
+
+    def visible_users(self):
+        """SQL predicate on the users visible to the user (None if all are)."""
+        if self._user.role == Role.admin:
+            return None
+
+        return UserEntry.uuid == self._user.uuid
+
+    def visible_logins(self):
+        """SQL predicate on the logins visible to the user (None if all are)."""
+        if self._user.role == Role.admin:
+            return None
+
+        return LoginEntry.user == self._user.uuid
+
+    def visible_jobs(self):
+        """SQL predicate on the jobs visible to the user (None if all are)."""
+        if self._user.role == Role.admin:
+            return None
+
+        return JobEntry.user == self._user.uuid
+
     def can_update_username(self, object: User):
         """Check access rights to update the username of a given User."""
         if self._user.role == Role.admin:
@@ -57,6 +87,10 @@ class PolicyEnforcer:
         """Check access rights to delete a given User."""
         return self._user.uuid == object.uuid
 
+    def can_manage_models(self):
+        """Check access rights to reload the recognition models."""
+        return self._user.role == Role.admin
+
     def can_claim_celebrity(self, celebrity_name: str, probability: float):
         """Check if similarity is enough to claim celebrity role."""
 
@@ -64,4 +98,4 @@ class PolicyEnforcer:
         if full_name != celebrity_name:
             return False
 
-        return probability > 0.95
+        return probability > CELEBRITY_MIN_PROBABILITY
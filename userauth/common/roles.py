@@ -12,3 +12,7 @@ class Role(Enum):
     normal = "normal user"
     admin = "admin user"
     celebrity = "celebrity user"
+
+
+# Minimum probability of the detector for a user to claim the celebrity role
+CELEBRITY_MIN_PROBABILITY = 0.95
@@ -1,11 +1,21 @@
 from .manager import DatabaseManager
-from .models import LoginEntry, UserEntry
-from .session import get_database_manager, safe_create_db
+from .models import JobEntry, LoginEntry, UserEntry
+from .session import (
+    get_database_manager,
+    safe_create_db,
+    start_cache,
+    stop_cache,
+    update_pool_metrics,
+)
 
 __all__ = (
     "DatabaseManager",
     "safe_create_db",
     "get_database_manager",
+    "start_cache",
+    "stop_cache",
+    "update_pool_metrics",
     "UserEntry",
     "LoginEntry",
+    "JobEntry",
 )
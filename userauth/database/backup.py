@@ -0,0 +1,201 @@
+"""
+Module for streaming backups of the database tables.
+
+A backup is a directory with one file per table plus a `manifest.json`.
+Each table file is a sequence of independent chunks; every chunk holds a
+fixed number of rows stored column by column (JSON arrays, which
+compress much better than row objects), compressed with zlib and framed
+with its length and a CRC32. The manifest records the row count and the
+SHA256 of every table file.
+
+The format only uses portable types (strings, numbers and nulls), so a
+backup taken from PostgreSQL can be restored in SQLite and vice versa.
+
+Backups of the previous format (1) can still be restored: they predate
+the `jobs` table and the `version` column of the users, which gets its
+default value.
+"""
+import asyncio
+import hashlib
+import json
+import struct
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Sequence, Tuple
+
+from sqlalchemy import Table, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .bulk import bulk_insert
+from .encoding import decode_column, encode_value
+from .models import Base, JobEntry, LoginEntry, UserEntry
+
+BACKUP_FORMAT_VERSION = 2
+SUPPORTED_FORMAT_VERSIONS = (1, 2)
+BACKUP_MAGIC = b"UABK\x01"
+CHUNK_HEADER = struct.Struct(">II")
+
+# Order matters: tables are restored in this order to satisfy foreign keys
+BACKUP_TABLES: Tuple[Table, ...] = (
+    UserEntry.__table__,
+    LoginEntry.__table__,
+    JobEntry.__table__,
+)
+
+
+class BackupIntegrityError(RuntimeError):
+    """The backup files do not match their recorded checksums."""
+
+
+def pack_chunk(columns: Sequence[str], rows: Sequence[Sequence[Any]]) -> bytes:
+    """Compress and frame a chunk of rows in columnar layout."""
+    columnar = {
+        column: [encode_value(row[idx]) for row in rows]
+        for idx, column in enumerate(columns)
+    }
+    payload = json.dumps(
+        {"rows": len(rows), "columns": columnar}, separators=(",", ":")
+    )
+    compressed = zlib.compress(payload.encode(), 6)
+    return CHUNK_HEADER.pack(len(compressed), zlib.crc32(compressed)) + compressed
+
+
+def unpack_chunk(table: Table, compressed: bytes) -> List[Dict[str, Any]]:
+    """Decompress a chunk and transform it back into row dictionaries."""
+    payload = json.loads(zlib.decompress(compressed))
+    columns = {
+        column: decode_column(table, column, values)
+        for column, values in payload["columns"].items()
+    }
+    return [
+        {column: values[idx] for column, values in columns.items()}
+        for idx in range(payload["rows"])
+    ]
+
+
+async def export_table(
+    engine: AsyncEngine,
+    table: Table,
+    filepath: Path,
+    chunk_size: int,
+) -> Dict[str, Any]:
+    """Stream a table into a backup file and return its manifest entry.
+
+    Rows are read through a server-side cursor (`yield_per`) so memory
+    stays bounded by the chunk size, and compression runs in a thread
+    (zlib releases the GIL) while the next chunk is being fetched.
+    """
+    columns = [column.name for column in table.columns]
+    checksum = hashlib.sha256(BACKUP_MAGIC)
+    row_count = 0
+    chunk_count = 0
+
+    with open(filepath, "wb") as fileobj:
+        fileobj.write(BACKUP_MAGIC)
+        async with engine.connect() as connection:
+            querystr = select(table).execution_options(yield_per=chunk_size)
+            result = await connection.stream(querystr)
+            async for rows in result.partitions(chunk_size):
+                chunk = await asyncio.to_thread(pack_chunk, columns, rows)
+                fileobj.write(chunk)
+                checksum.update(chunk)
+                row_count += len(rows)
+                chunk_count += 1
+
+    return {
+        "file": filepath.name,
+        "rows": row_count,
+        "chunks": chunk_count,
+        "sha256": checksum.hexdigest(),
+    }
+
+
+async def export_database(
+    engine: AsyncEngine,
+    directory: Path,
+    chunk_size: int = 10000,
+) -> Dict[str, Any]:
+    """Export all tables into the backup directory.
+
+    Tables are read in parallel, each through its own connection. Note
+    that this means the tables are not read from the same snapshot: the
+    backup should be taken while no users are being deleted.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    entries = await asyncio.gather(
+        *[
+            export_table(engine, table, directory / f"{table.name}.ubk", chunk_size)
+            for table in BACKUP_TABLES
+        ]
+    )
+
+    manifest = {
+        "format": BACKUP_FORMAT_VERSION,
+        "created": datetime.utcnow().isoformat(),
+        "tables": {table.name: entry for table, entry in zip(BACKUP_TABLES, entries)},
+    }
+    with open(directory / "manifest.json", "w") as fileobj:
+        json.dump(manifest, fileobj, indent=2)
+    return manifest
+
+
+async def read_chunks(filepath: Path) -> AsyncIterator[Tuple[bytes, bytes]]:
+    """Iterate over the (framed chunk, compressed payload) pairs of a backup file."""
+    with open(filepath, "rb") as fileobj:
+        if fileobj.read(len(BACKUP_MAGIC)) != BACKUP_MAGIC:
+            raise BackupIntegrityError(f"{filepath.name} is not a backup file")
+
+        while True:
+            header = fileobj.read(CHUNK_HEADER.size)
+            if not header:
+                return
+            if len(header) != CHUNK_HEADER.size:
+                raise BackupIntegrityError(f"{filepath.name} is truncated")
+
+            length, crc = CHUNK_HEADER.unpack(header)
+            compressed = await asyncio.to_thread(fileobj.read, length)
+            if len(compressed) != length or zlib.crc32(compressed) != crc:
+                raise BackupIntegrityError(f"{filepath.name} has a corrupted chunk")
+            yield header + compressed, compressed
+
+
+async def restore_database(engine: AsyncEngine, directory: Path) -> Dict[str, int]:
+    """Load a backup directory into the database.
+
+    The tables are created if needed and the whole restore happens in a
+    single transaction, so a checksum mismatch leaves the database as it
+    was. Returns the number of rows restored per table.
+    """
+    with open(directory / "manifest.json") as fileobj:
+        manifest = json.load(fileobj)
+
+    if manifest["format"] not in SUPPORTED_FORMAT_VERSIONS:
+        raise BackupIntegrityError(f"unsupported backup format {manifest['format']}")
+
+    # Only the tables added after the format of the backup can be missing
+    tables = [table for table in BACKUP_TABLES if table.name in manifest["tables"]]
+    if manifest["format"] == BACKUP_FORMAT_VERSION and len(tables) < len(BACKUP_TABLES):
+        raise BackupIntegrityError("the backup is missing tables")
+
+    restored = {}
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+
+        for table in tables:
+            entry = manifest["tables"][table.name]
+            checksum = hashlib.sha256(BACKUP_MAGIC)
+            row_count = 0
+
+            async for framed, compressed in read_chunks(directory / entry["file"]):
+                checksum.update(framed)
+                rows = await asyncio.to_thread(unpack_chunk, table, compressed)
+                row_count += await bulk_insert(connection, table, rows)
+
+            if checksum.hexdigest() != entry["sha256"] or row_count != entry["rows"]:
+                raise BackupIntegrityError(
+                    f"{entry['file']} does not match the manifest"
+                )
+            restored[table.name] = row_count
+
+    return restored
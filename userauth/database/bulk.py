@@ -0,0 +1,72 @@
+"""
+Module with the helpers for inserting rows in bulk.
+
+The ORM unit of work is very convenient for single entries, but it
+becomes the bottleneck when thousands of rows need to be written. The
+functions here go directly to the core layer (or, for PostgreSQL, to
+the driver connection so that the binary COPY protocol can be used).
+"""
+import json
+from typing import Any, Dict, List, Sequence
+
+from sqlalchemy import JSON, Table
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+
+def is_postgresql(connection: AsyncConnection) -> bool:
+    """Check if the connection points to a PostgreSQL backend."""
+    return connection.dialect.name == "postgresql"
+
+
+def rows_to_records(
+    table: Table,
+    rows: Sequence[Dict[str, Any]],
+    columns: Sequence[str],
+) -> List[tuple]:
+    """Transform a list of row dictionaries into positional records.
+
+    Enumerated values are stored by name (which is how the ORM column
+    persists them), and JSON values serialized, since COPY bypasses the
+    type processors.
+    """
+    records = []
+    for row in rows:
+        record = []
+        for column in columns:
+            value = row.get(column)
+            if hasattr(value, "name") and hasattr(table.c[column].type, "enums"):
+                value = value.name
+            elif value is not None and isinstance(table.c[column].type, JSON):
+                value = json.dumps(value)
+            record.append(value)
+        records.append(tuple(record))
+    return records
+
+
+async def bulk_insert(
+    connection: AsyncConnection,
+    table: Table,
+    rows: Sequence[Dict[str, Any]],
+) -> int:
+    """Insert a batch of rows in a single round trip.
+
+    On PostgreSQL this uses the asyncpg `copy_records_to_table`, on any
+    other backend it falls back to an `executemany` insert. The caller
+    is responsible for the transaction (the rows are not committed).
+    """
+    if not rows:
+        return 0
+
+    if is_postgresql(connection):
+        columns = list(rows[0].keys())
+        records = rows_to_records(table, rows, columns)
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            table.name,
+            records=records,
+            columns=columns,
+        )
+    else:
+        await connection.execute(table.insert(), list(rows))
+
+    return len(rows)
@@ -0,0 +1,371 @@
+"""
+Module with the cache tier for user lookups.
+
+The cache has two levels: an in-process LRU (L1) and an optional shared
+Redis store (L2, through `redis.asyncio`), so that replicas of the server
+can reuse each other's lookups. Writes invalidate the entries in both
+levels and publish the invalidated keys on a pub/sub channel, so every
+replica drops them from its own L1 as soon as the message arrives.
+
+Entries also expire after a TTL, which bounds the staleness in the
+corner cases that invalidations can't cover (for example, a read that
+started before a write and stores its result after the invalidation).
+
+The shared level is only an optimization: every command sent to it is
+bounded by a short timeout, and when it fails or is slow the lookups
+fall back to the database (and skip it for a moment). Password hashes
+are never cached.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import urlparse
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:  # pragma: no cover - depends on the environment
+    redis = None
+
+from .encoding import decode_column, encode_value
+from .events import UserSnapshot
+from .models import UserEntry
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "userauth:invalidations"
+USER_KEY_FIELDS = ("uuid", "username", "email")
+
+# Columns of the users that are never stored in the cache
+UNCACHED_USER_COLUMNS = ("hashed_password",)
+
+# Time the shared level is skipped after it failed or timed out
+SHARED_RETRY_SECONDS = 1.0
+
+
+# Failures of the shared level, which are treated as misses
+SHARED_CACHE_ERRORS = (OSError, asyncio.TimeoutError) + (
+    () if redis is None else (redis.RedisError,)
+)
+
+
+class CacheBackend:
+    """Interface of the cache levels (values are bytes)."""
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """Return the value stored for the key, or None if missing."""
+        raise NotImplementedError
+
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        """Store several values that expire after ttl seconds."""
+        raise NotImplementedError
+
+    async def delete(self, keys: Sequence[str]) -> None:
+        """Remove the keys (missing keys are ignored)."""
+        raise NotImplementedError
+
+
+class LocalCache(CacheBackend):
+    """In-process LRU cache with expiration times."""
+
+    def __init__(self, max_entries: int = 10000):
+        """Initialize the cache with a maximum number of entries."""
+        self._entries: OrderedDict = OrderedDict()
+        self._max_entries = max_entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        value, expiration = entry
+        if expiration < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        expiration = time.monotonic() + ttl
+        for key, value in items.items():
+            self._entries[key] = (value, expiration)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, keys: Sequence[str]) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all the entries."""
+        self._entries.clear()
+
+
+class RedisCache(CacheBackend):
+    """Shared cache level on a Redis server."""
+
+    def __init__(self, url: str, pool_size: int = 4, timeout: float = 0.1):
+        """Initialize the cache for the server at the given url.
+
+        Commands go through a pool of connections, and fail if they take
+        longer than the timeout (in seconds), including the wait for a
+        free connection.
+        """
+        if redis is None:
+            raise RuntimeError(
+                "the redis cache requires redis (pip install userauth[redis])"
+            )
+
+        self.url = url
+        self.timeout = timeout
+        # RESP2, which every version of the server speaks
+        self._pool = redis.asyncio.BlockingConnectionPool.from_url(
+            url,
+            max_connections=max(1, pool_size),
+            timeout=timeout,
+            socket_connect_timeout=timeout,
+            socket_timeout=timeout,
+            protocol=2,
+        )
+        self._client = redis.asyncio.Redis(connection_pool=self._pool)
+        # Subscriptions wait for messages indefinitely, out of the pool
+        self._subscriber_client = redis.asyncio.Redis.from_url(
+            url, socket_connect_timeout=timeout, protocol=2
+        )
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.wait_for(self._client.get(key), self.timeout)
+
+    async def set_many(self, items: Dict[str, bytes], ttl: float) -> None:
+        milliseconds = max(1, int(ttl * 1000))
+        pipeline = self._client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(key, value, px=milliseconds)
+        await asyncio.wait_for(pipeline.execute(), self.timeout)
+
+    async def delete(self, keys: Sequence[str]) -> None:
+        if keys:
+            await asyncio.wait_for(self._client.delete(*keys), self.timeout)
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        await asyncio.wait_for(self._client.publish(channel, message), self.timeout)
+
+    def pubsub(self):
+        """New subscriber (see `redis.asyncio.client.PubSub`)."""
+        return self._subscriber_client.pubsub(ignore_subscribe_messages=True)
+
+    async def close(self) -> None:
+        await self._client.aclose()
+        await self._pool.aclose()
+        await self._subscriber_client.aclose()
+
+
+class TieredCache:
+    """Two level cache that keeps replicas coherent through pub/sub.
+
+    Errors and timeouts of the shared level are logged and treated as
+    misses: the cache must never be the reason a request fails (or
+    waits). After a failure, lookups skip the shared level for a moment.
+    """
+
+    def __init__(
+        self,
+        local: LocalCache,
+        shared: Optional[RedisCache] = None,
+        ttl: float = 60.0,
+    ):
+        """Initialize the cache with its levels and the TTL of the entries."""
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._subscriber: Optional[asyncio.Task] = None
+        self._shared_retry_at = 0.0
+
+    @property
+    def shared_available(self) -> bool:
+        """Whether the shared level is used (it's skipped after failures)."""
+        return self.shared is not None and time.monotonic() >= self._shared_retry_at
+
+    def _shared_failed(self) -> None:
+        logger.warning("shared cache unavailable", exc_info=True)
+        self._shared_retry_at = time.monotonic() + SHARED_RETRY_SECONDS
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = await self.local.get(key)
+        if value is None and self.shared_available:
+            try:
+                value = await self.shared.get(key)
+            except SHARED_CACHE_ERRORS:
+                self._shared_failed()
+            if value is not None:
+                await self.local.set_many({key: value}, self.ttl)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set_many(self, items: Dict[str, bytes]) -> None:
+        await self.local.set_many(items, self.ttl)
+        if self.shared_available:
+            try:
+                await self.shared.set_many(items, self.ttl)
+            except SHARED_CACHE_ERRORS:
+                self._shared_failed()
+
+    async def invalidate(self, keys: Sequence[str]) -> None:
+        """Remove the keys from all levels and notify the other replicas.
+
+        Unlike lookups, invalidations are always sent to the shared level.
+        """
+        await self.local.delete(keys)
+        if self.shared is not None and keys:
+            try:
+                await self.shared.delete(keys)
+                await self.shared.publish(
+                    INVALIDATION_CHANNEL,
+                    json.dumps(list(keys)).encode(),
+                )
+            except SHARED_CACHE_ERRORS:
+                self._shared_failed()
+
+    async def start(self) -> None:
+        """Start listening to the invalidations of other replicas."""
+        if self.shared is not None and self._subscriber is None:
+            self._subscriber = asyncio.create_task(self._listen_invalidations())
+
+    async def stop(self) -> None:
+        """Stop listening to invalidations and close the connections."""
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            try:
+                await self._subscriber
+            except asyncio.CancelledError:
+                pass
+            self._subscriber = None
+        if self.shared is not None:
+            await self.shared.close()
+
+    async def _listen_invalidations(self) -> None:
+        """Drop the invalidated keys from the L1 (reconnecting if needed).
+
+        After a reconnection the L1 is cleared entirely, since any
+        invalidation sent while disconnected was missed.
+        """
+        backoff = 0.1
+        while True:
+            pubsub = self.shared.pubsub()
+            try:
+                await asyncio.wait_for(
+                    pubsub.subscribe(INVALIDATION_CHANNEL), self.shared.timeout
+                )
+                self.local.clear()
+                backoff = 0.1
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        await self.local.delete(json.loads(message["data"]))
+            except SHARED_CACHE_ERRORS:
+                logger.warning("invalidation channel lost, reconnecting")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 5.0)
+            finally:
+                await pubsub.aclose()
+
+
+def user_cache_key(field: str, value: Any) -> str:
+    """Key of a user entry looked up by one of its unique fields."""
+    return f"userauth:user:{field}:{value}"
+
+
+def user_cache_keys(snapshot: UserSnapshot) -> List[str]:
+    """All keys under which a user can be cached."""
+    return [
+        user_cache_key(field, getattr(snapshot, field)) for field in USER_KEY_FIELDS
+    ]
+
+
+class UserCache:
+    """Cache of user rows by uuid, username and email.
+
+    The cached rows don't have the password hashes (see
+    `UNCACHED_USER_COLUMNS`), which are left unloaded in the users
+    built from them.
+    """
+
+    def __init__(self, cache: TieredCache):
+        """Initialize on top of a tiered cache."""
+        self.cache = cache
+        self._table = UserEntry.__table__
+        self._columns = [
+            column.name
+            for column in self._table.columns
+            if column.name not in UNCACHED_USER_COLUMNS
+        ]
+
+    async def get(self, field: str, value: Any) -> Optional[Dict[str, Any]]:
+        """Return the cached row of a user, or None if not cached."""
+        data = await self.cache.get(user_cache_key(field, value))
+        if data is None:
+            return None
+
+        encoded_row = json.loads(data)
+        return {
+            column: decode_column(self._table, column, [encoded_value])[0]
+            for column, encoded_value in encoded_row.items()
+        }
+
+    async def store(self, user_entry: UserEntry) -> None:
+        """Cache the row of a user under all of its keys."""
+        encoded_row = {
+            column: encode_value(getattr(user_entry, column))
+            for column in self._columns
+        }
+        data = json.dumps(encoded_row).encode()
+        snapshot = UserSnapshot.from_dbentry(user_entry)
+        await self.cache.set_many({key: data for key in user_cache_keys(snapshot)})
+
+    async def invalidate(self, *snapshots: Optional[UserSnapshot]) -> None:
+        """Invalidate all the keys of the given versions of users."""
+        keys: List[str] = []
+        for snapshot in snapshots:
+            if snapshot is not None:
+                keys.extend(user_cache_keys(snapshot))
+        await self.cache.invalidate(list(dict.fromkeys(keys)))
+
+
+def build_user_cache(
+    url: Optional[str],
+    ttl: float,
+    max_entries: int,
+    timeout: float = 0.1,
+    pool_size: int = 4,
+) -> Optional[UserCache]:
+    """Build the user cache from its configuration.
+
+    The url can be None (no cache), `memory://` (only the in-process
+    level) or `redis://...` (both levels, with invalidations, through a
+    pool of connections whose commands time out after `timeout` seconds,
+    which requires the `redis` package).
+    """
+    if url is None:
+        return None
+
+    shared: Optional[RedisCache] = None
+    scheme = urlparse(url).scheme
+    if scheme == "redis":
+        shared = RedisCache(url, pool_size=pool_size, timeout=timeout)
+    elif scheme != "memory":
+        raise ValueError(f"unsupported cache url `{url}`")
+
+    return UserCache(TieredCache(LocalCache(max_entries), shared, ttl))
@@ -0,0 +1,44 @@
+"""
+Module with the portable encoding of the column values.
+
+Values are transformed into JSON compatible types (strings, numbers and
+nulls) that any backend can load back, as used by the backups and by the
+shared level of the user cache.
+"""
+import base64
+from datetime import datetime
+from enum import Enum as PythonEnum
+from typing import Any, List
+from uuid import UUID
+
+from sqlalchemy import DateTime, Enum, LargeBinary, Table, Uuid
+
+
+def encode_value(value: Any) -> Any:
+    """Transform a column value into its portable representation."""
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, PythonEnum):
+        return value.name
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    return value
+
+
+def decode_column(table: Table, column: str, values: List[Any]) -> List[Any]:
+    """Transform portable values back into the python types of the column."""
+    column_type = table.c[column].type
+    if isinstance(column_type, Uuid):
+        return [None if value is None else UUID(value) for value in values]
+    if isinstance(column_type, DateTime):
+        return [
+            None if value is None else datetime.fromisoformat(value) for value in values
+        ]
+    if isinstance(column_type, Enum) and column_type.enum_class is not None:
+        enum_class = column_type.enum_class
+        return [None if value is None else enum_class[value] for value in values]
+    if isinstance(column_type, LargeBinary):
+        return [None if value is None else base64.b64decode(value) for value in values]
+    return values
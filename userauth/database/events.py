@@ -0,0 +1,82 @@
+"""
+Module with the notifications of changes to the users table.
+
+Some components keep derived in-memory state about the users (search
+indexes, caches, filters). Instead of the database manager knowing
+about each of them, they subscribe here and get notified after every
+committed write.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+from uuid import UUID
+
+from .models import UserEntry
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Immutable copy of the public identifiers of a user."""
+
+    uuid: UUID
+    username: str
+    email: str
+    name: str
+    surname: str
+
+    @classmethod
+    def from_dbentry(cls, user_entry: UserEntry) -> "UserSnapshot":
+        """Constructor from a database user entry."""
+        return cls(
+            uuid=user_entry.uuid,
+            username=user_entry.username,
+            email=user_entry.email,
+            name=user_entry.name,
+            surname=user_entry.surname,
+        )
+
+
+@dataclass(frozen=True)
+class UserChange:
+    """A committed change: `before` is None for creations, `after` for deletions."""
+
+    before: Optional[UserSnapshot]
+    after: Optional[UserSnapshot]
+
+
+UserListener = Callable[[UserChange], None]
+
+
+class UserEvents:
+    """Registry of the listeners notified of user changes."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._listeners: List[UserListener] = []
+
+    def subscribe(self, listener: UserListener) -> None:
+        """Register a listener (registering twice has no effect)."""
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener: UserListener) -> None:
+        """Remove a listener if it was registered."""
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def publish(self, change: UserChange) -> None:
+        """Notify all listeners of a change.
+
+        The change is already committed at this point, so a failing
+        listener is logged but does not fail the request.
+        """
+        for listener in list(self._listeners):
+            try:
+                listener(change)
+            except Exception:
+                logger.exception("user change listener %r failed", listener)
+
+
+USER_EVENTS = UserEvents()
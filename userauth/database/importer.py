@@ -0,0 +1,215 @@
+"""
+Module for importing users in bulk from external files.
+
+Records are streamed from the input file, the passwords are hashed
+across a pool of processes (bcrypt is CPU bound and holds the GIL) and
+the resulting rows are written in large batches. Each batch is its own
+transaction, and a checkpoint file is updated after every commit so an
+interrupted import can be resumed where it left off.
+"""
+import asyncio
+import csv
+import json
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from uuid import UUID, uuid4
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from userauth.common.roles import Role
+
+from .bulk import bulk_insert
+from .manager import hash_password
+from .models import UserEntry
+
+IMPORT_FORMATS = ("jsonl", "csv")
+REQUIRED_FIELDS = ("username", "email", "name", "surname")
+
+
+@dataclass
+class ImportProgress:
+    """Snapshot of the state of an ongoing import."""
+
+    records_done: int
+    records_skipped: int
+    elapsed_seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Imported records per second since the start of this run."""
+        if self.elapsed_seconds <= 0:
+            return 0.0
+        return (self.records_done - self.records_skipped) / self.elapsed_seconds
+
+
+def read_records(filepath: Path, fileformat: str) -> Iterator[Dict[str, Any]]:
+    """Stream the records of the input file one by one."""
+    if fileformat not in IMPORT_FORMATS:
+        raise ValueError(f"unknown import format `{fileformat}`")
+
+    with open(filepath, newline="") as fileobj:
+        if fileformat == "csv":
+            yield from csv.DictReader(fileobj)
+            return
+
+        for line in fileobj:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    """Hash a chunk of passwords (runs inside the worker processes)."""
+    return [hash_password(password) for password in passwords]
+
+
+def load_checkpoint(checkpoint_path: Optional[Path]) -> int:
+    """Return the number of records already imported according to the checkpoint."""
+    if checkpoint_path is None or not checkpoint_path.exists():
+        return 0
+    with open(checkpoint_path) as fileobj:
+        return int(json.load(fileobj)["records_done"])
+
+
+def save_checkpoint(checkpoint_path: Optional[Path], records_done: int) -> None:
+    """Atomically store the number of records imported so far."""
+    if checkpoint_path is None:
+        return
+    temporary_path = checkpoint_path.with_suffix(checkpoint_path.suffix + ".tmp")
+    with open(temporary_path, "w") as fileobj:
+        json.dump({"records_done": records_done}, fileobj)
+    os.replace(temporary_path, checkpoint_path)
+
+
+def validate_record(record: Dict[str, Any], position: int) -> None:
+    """Check that the record has all the information required to create a user."""
+    for field in REQUIRED_FIELDS:
+        if not record.get(field):
+            raise ValueError(f"record {position} is missing the `{field}` field")
+
+    if not record.get("password") and not record.get("hashed_password"):
+        raise ValueError(f"record {position} has neither password nor hashed_password")
+
+    role = record.get("role")
+    if role:
+        try:
+            Role[role]
+        except KeyError:
+            raise ValueError(
+                f"record {position} has an invalid role `{role}`"
+            ) from None
+
+
+async def prepare_rows(
+    records: List[Dict[str, Any]],
+    executor: Executor,
+    chunksize: int,
+) -> List[Dict[str, Any]]:
+    """Transform raw records into `users` rows, hashing passwords if needed.
+
+    Records that already come with a `hashed_password` are used as is.
+    """
+    loop = asyncio.get_running_loop()
+
+    to_hash = [
+        idx for idx, record in enumerate(records) if not record.get("hashed_password")
+    ]
+    futures = []
+    for start in range(0, len(to_hash), chunksize):
+        end = start + chunksize
+        chunk = [records[idx]["password"] for idx in to_hash[start:end]]
+        futures.append(loop.run_in_executor(executor, hash_passwords, chunk))
+
+    hashed_passwords = [
+        hashed for chunk in await asyncio.gather(*futures) for hashed in chunk
+    ]
+    hashed_by_index = dict(zip(to_hash, hashed_passwords))
+
+    rows = []
+    for idx, record in enumerate(records):
+        role = record.get("role") or Role.normal.name
+        rows.append(
+            {
+                "uuid": UUID(str(record["uuid"])) if record.get("uuid") else uuid4(),
+                "role": Role[role],
+                "username": record["username"],
+                "email": record["email"],
+                "name": record["name"],
+                "surname": record["surname"],
+                "hashed_password": hashed_by_index.get(
+                    idx, record.get("hashed_password")
+                ),
+            }
+        )
+    return rows
+
+
+async def import_users(
+    engine: AsyncEngine,
+    filepath: Path,
+    fileformat: str,
+    batch_size: int = 5000,
+    workers: Optional[int] = None,
+    checkpoint_path: Optional[Path] = None,
+    progress_callback: Optional[Callable[[ImportProgress], None]] = None,
+) -> ImportProgress:
+    """Import all the users from the file into the database.
+
+    Hashing of the next batch overlaps with the insertion of the current
+    one, so the database and the hashing pool are kept busy at the same
+    time. Returns the final progress of the import.
+    """
+    records_skipped = load_checkpoint(checkpoint_path)
+    records_done = records_skipped
+    start_time = time.perf_counter()
+
+    records = read_records(filepath, fileformat)
+    for _ in islice(records, records_skipped):
+        pass
+
+    def next_batch() -> List[Dict[str, Any]]:
+        batch = list(islice(records, batch_size))
+        for offset, record in enumerate(batch):
+            validate_record(record, records_done + offset + 1)
+        return batch
+
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, batch_size // (4 * workers))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        batch = next_batch()
+        pending_rows = asyncio.ensure_future(prepare_rows(batch, executor, chunksize))
+
+        try:
+            while batch:
+                rows = await pending_rows
+                records_done += len(batch)
+
+                batch = next_batch()
+                if batch:
+                    pending_rows = asyncio.ensure_future(
+                        prepare_rows(batch, executor, chunksize)
+                    )
+
+                async with engine.begin() as connection:
+                    await bulk_insert(connection, UserEntry.__table__, rows)
+                save_checkpoint(checkpoint_path, records_done)
+
+                if progress_callback is not None:
+                    elapsed_seconds = time.perf_counter() - start_time
+                    progress_callback(
+                        ImportProgress(records_done, records_skipped, elapsed_seconds)
+                    )
+        except BaseException:
+            # The hashing of the next batch must not outlive the import
+            pending_rows.cancel()
+            await asyncio.gather(pending_rows, return_exceptions=True)
+            raise
+
+    elapsed_seconds = time.perf_counter() - start_time
+    return ImportProgress(records_done, records_skipped, elapsed_seconds)
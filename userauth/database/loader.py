@@ -0,0 +1,102 @@
+"""
+Module with the request-scoped loader of users.
+
+A single request can look up the same user several times (the
+authentication, the handler, the manager methods), by uuid, username
+or email. The loader lives as long as the database manager (one per
+request), memoizes every lookup under the three keys of the user and
+batches the lookups requested concurrently into a single `IN` query.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import inspect
+
+from .models import UserEntry
+
+USER_LOOKUP_FIELDS = ("uuid", "username", "email")
+
+BatchFunction = Callable[[str, Sequence[Any]], Awaitable[List[UserEntry]]]
+
+
+class UserLoader:
+    """Memoizing and batching loader of users (dataloader style)."""
+
+    def __init__(self, batch_function: BatchFunction):
+        """Initialize the loader.
+
+        The batch function receives a field and a list of values and
+        returns the users found (in any order, missing ones omitted).
+        """
+        self._batch_function = batch_function
+        self._memo: Dict[Tuple[str, Any], Optional[UserEntry]] = {}
+        self._pending: Dict[str, Dict[Any, asyncio.Future]] = {}
+        self._dispatch_lock: Optional[asyncio.Lock] = None
+        self.batches = 0
+
+    async def load(self, field: str, value: Any) -> Optional[UserEntry]:
+        """Get a user by one of its lookup fields (None if it doesn't exist)."""
+        key = (field, value)
+        if key in self._memo:
+            user = self._memo[key]
+            if user is None or not inspect(user).expired_attributes:
+                return user
+            del self._memo[key]
+
+        pending = self._pending.setdefault(field, {})
+        future = pending.get(value)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            pending[value] = future
+            if len(pending) == 1:
+                # Wait one loop iteration so concurrent lookups join the batch
+                asyncio.get_running_loop().call_soon(self._schedule, field)
+        return await future
+
+    def _schedule(self, field: str) -> None:
+        asyncio.ensure_future(self._dispatch(field))
+
+    async def _dispatch(self, field: str) -> None:
+        """Resolve all the pending lookups of a field with one batch."""
+        if self._dispatch_lock is None:
+            self._dispatch_lock = asyncio.Lock()
+
+        # The session does not allow concurrent queries
+        async with self._dispatch_lock:
+            pending = self._pending.pop(field, {})
+            if not pending:
+                return
+
+            try:
+                users = await self._batch_function(field, list(pending))
+            except Exception as exception:
+                for future in pending.values():
+                    if not future.done():
+                        future.set_exception(exception)
+                return
+
+            self.batches += 1
+            found = {getattr(user, field): user for user in users}
+            for user in users:
+                self.prime(user)
+            for value, future in pending.items():
+                user = found.get(value)
+                if user is None:
+                    self._memo[(field, value)] = None
+                if not future.done():
+                    future.set_result(user)
+
+    def prime(self, user: UserEntry) -> None:
+        """Memoize a user under all its lookup fields."""
+        for field in USER_LOOKUP_FIELDS:
+            self._memo[(field, getattr(user, field))] = user
+
+    def forget(self, *snapshots) -> None:
+        """Drop the memoized lookups of users (entries or snapshots)."""
+        for snapshot in snapshots:
+            for field in USER_LOOKUP_FIELDS:
+                self._memo.pop((field, getattr(snapshot, field)), None)
+
+    def clear(self) -> None:
+        """Drop all the memoized lookups."""
+        self._memo.clear()
@@ -1,42 +1,175 @@
 """
 Module containing the database manager.
 """
-from typing import List, Optional
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 from uuid import UUID, uuid4
 
-from passlib.context import CryptContext
-from sqlalchemy import select
+from prometheus_client import Histogram
+from sqlalchemy import and_, case, delete, exists, func, inspect, or_, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached, undefer
+from sqlalchemy.orm.exc import StaleDataError
 
+from userauth.common.config import get_server_config
+from userauth.common.jobs import FINISHED_JOB_STATUSES, JobStatus
+from userauth.common.metrics import time_coroutines
 from userauth.common.roles import Role
 
-from .models import LoginEntry, UserEntry
+from .cache import UserCache
+from .events import USER_EVENTS, UserChange, UserSnapshot
+from .loader import USER_LOOKUP_FIELDS, UserLoader
+from .models import JobEntry, LoginEntry, UserEntry
+from .search import USER_SEARCH_INDEX, prefix_match
+from .singleflight import SingleFlight
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Fields whose availability can be checked before registering
+AVAILABILITY_FIELDS = ("username", "email")
+
+DATABASE_METHOD_SECONDS = Histogram(
+    "userauth_database_method_seconds",
+    "Time taken by the methods of the database manager, by method.",
+    labelnames=("method",),
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    "userauth_password_hash_seconds",
+    "Time taken by the bcrypt password hashes, by operation (hash or verify).",
+    labelnames=("operation",),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0),
+)
+
+_pwd_context = None
+
+
+def get_pwd_context():
+    """Context of the password hashes (passlib is imported on first use)."""
+    global _pwd_context
+
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return _pwd_context
 
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    start_time = time.perf_counter()
+    verified = get_pwd_context().verify(plain_password, hashed_password)
+    PASSWORD_HASH_SECONDS.labels(operation="verify").observe(
+        time.perf_counter() - start_time
+    )
+    return verified
 
 
 def hash_password(password):
-    return pwd_context.hash(password)
+    start_time = time.perf_counter()
+    hashed_password = get_pwd_context().hash(password)
+    PASSWORD_HASH_SECONDS.labels(operation="hash").observe(
+        time.perf_counter() - start_time
+    )
+    return hashed_password
+
+
+USER_SORT_COLUMNS = {
+    "ctime": UserEntry.ctime,
+    "username": UserEntry.username,
+    "name": UserEntry.name,
+    "surname": UserEntry.surname,
+}
 
+LOGIN_SORT_COLUMNS = {
+    "ctime": LoginEntry.ctime,
+}
 
+
+def sort_clauses(sort: Optional[str], sort_columns: Dict, tiebreaker) -> list:
+    """Translate a sort key into ORDER BY clauses.
+
+    The key is the name of one of the sort columns, optionally preceded
+    by a `-` for descending order. The tiebreaker column keeps the order
+    deterministic when the sort column has repeated values.
+    """
+    if sort is None:
+        return []
+
+    descending = sort.startswith("-")
+    column = sort_columns.get(sort.lstrip("-"))
+    if column is None:
+        raise ValueError(f"Unknown sort key `{sort}`.")
+
+    if descending:
+        return [column.desc(), tiebreaker.desc()]
+    return [column.asc(), tiebreaker.asc()]
+
+
+@time_coroutines(DATABASE_METHOD_SECONDS, "method")
 class DatabaseManager:
     """
     Class to wrap the current session and database procedures.
     """
 
-    def __init__(self, session: AsyncSession):
-        """Initialize the manager with a scoped async session."""
+    def __init__(
+        self,
+        session: AsyncSession,
+        cache: Optional[UserCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+    ):
+        """Initialize the manager with a scoped async session.
+
+        If a cache is provided, single user lookups go through it, and
+        writes to users invalidate the affected entries. Lookups are also
+        memoized for the lifetime of the manager (i.e. the request), and
+        if a single-flight layer is provided, the queries of concurrent
+        identical lookups (from any request) are shared.
+        """
         self._session = session
+        self._cache = cache
+        self._single_flight = single_flight
+        self._loader = UserLoader(self._fetch_users)
+
+    @property
+    def dialect_name(self) -> str:
+        """Name of the database backend (`sqlite`, `postgresql`...)."""
+        return self._session.bind.dialect.name
 
-    async def get_users(self) -> List[UserEntry]:
-        """Get all users from the database."""
+    async def get_users(
+        self,
+        uuids: Optional[List[UUID]] = None,
+        role: Optional[Role] = None,
+        ctime_from: Optional[datetime] = None,
+        ctime_to: Optional[datetime] = None,
+        sort: Optional[str] = None,
+        scope=None,
+    ) -> List[UserEntry]:
+        """Get users from the database.
+
+        If a list of uuids is provided, only those users are fetched (in
+        a single query, the order of the results is not guaranteed).
+        Users can also be filtered by role and by creation time (from is
+        inclusive, to is exclusive), and sorted by any of the keys in
+        USER_SORT_COLUMNS. The scope is an extra predicate restricting the
+        users that can be returned (see `PolicyEnforcer.visible_users`).
+        """
         querystr = select(UserEntry)
+        if scope is not None:
+            querystr = querystr.filter(scope)
+        if uuids is not None:
+            querystr = querystr.filter(UserEntry.uuid.in_(set(uuids)))
+        if role is not None:
+            querystr = querystr.filter(UserEntry.role == role)
+        if ctime_from is not None:
+            querystr = querystr.filter(UserEntry.ctime >= ctime_from)
+        if ctime_to is not None:
+            querystr = querystr.filter(UserEntry.ctime < ctime_to)
+        querystr = querystr.order_by(
+            *sort_clauses(sort, USER_SORT_COLUMNS, UserEntry.uuid)
+        )
         results = await self._session.execute(querystr)
         results = [result[0] for result in results]
+        for result in results:
+            self._loader.prime(result)
         return results
 
     async def get_user(
@@ -61,22 +194,200 @@ class DatabaseManager:
             )
 
         if username is not None:
-            querystr = select(UserEntry).filter_by(username=username)
+            field, value = "username", username
 
         elif email is not None:
-            querystr = select(UserEntry).filter_by(email=email)
+            field, value = "email", email
 
         elif uuid is not None:
-            querystr = select(UserEntry).filter_by(uuid=uuid)
+            field, value = "uuid", uuid
 
         else:
             raise ValueError(
                 "You must provide at least one of: username, email, uuid.",
             )
 
+        return await self._loader.load(field, value)
+
+    async def _fetch_users(self, field: str, values: Sequence[Any]) -> List[UserEntry]:
+        """Get the users matching any of the values of a field.
+
+        Used by the loader to resolve a batch of lookups: the cache is
+        checked first and the misses are fetched with a single query.
+        """
+        found_users = list()
+        missing_values = list(values)
+        if self._cache is not None:
+            missing_values = list()
+            for value in values:
+                cached_row = await self._cache.get(field, value)
+                if cached_row is None:
+                    missing_values.append(value)
+                else:
+                    found_users.append(await self._adopt_user(cached_row))
+
+        if not missing_values:
+            return found_users
+
+        if self._single_flight is None or not self._single_flight.covers(field):
+            found_users.extend(await self._query_users(field, missing_values))
+            return found_users
+
+        flight_keys = [(field, value) for value in missing_values]
+        rows = await self._single_flight.do_many(flight_keys, self._query_user_rows)
+        for row in rows.values():
+            if row is not None:
+                found_users.append(await self._adopt_user(row))
+        return found_users
+
+    async def _query_users(self, field: str, values: Sequence[Any]) -> List[UserEntry]:
+        """Query the users matching any of the values of a field."""
+        column = getattr(UserEntry, field)
+        querystr = select(UserEntry).filter(column.in_(values))
+        results = await self._session.execute(querystr)
+        results = results.scalars().all()
+
+        if self._cache is not None:
+            for result in results:
+                await self._cache.store(result)
+        return results
+
+    async def _query_user_rows(self, flight_keys: List[Tuple]) -> Dict[Tuple, dict]:
+        """Query users for the single-flight layer (all keys of one field).
+
+        Results are shared with other requests, so they are returned as
+        plain rows that each manager adopts into its own session.
+        """
+        field = flight_keys[0][0]
+        values = [value for _, value in flight_keys]
+        rows = dict()
+        for result in await self._query_users(field, values):
+            rows[(field, getattr(result, field))] = {
+                column.name: getattr(result, column.name)
+                for column in UserEntry.__table__.columns
+            }
+        return rows
+
+    def _forget_users(self, *snapshots: UserSnapshot) -> None:
+        """Drop the lookups of the given users that precede a write."""
+        self._loader.forget(*snapshots)
+        if self._single_flight is not None:
+            self._single_flight.forget(
+                (field, getattr(snapshot, field))
+                for snapshot in snapshots
+                for field in USER_LOOKUP_FIELDS
+            )
+
+    async def _adopt_user(self, row: dict) -> UserEntry:
+        """Attach a user row obtained outside the session (no query emitted).
+
+        The entry behaves as if it had been loaded by the session, so it
+        can be modified or deleted like any other.
+        """
+        user = UserEntry(**row)
+        make_transient_to_detached(user)
+        return await self._session.merge(user, load=False)
+
+    async def search_users(
+        self,
+        query: str,
+        limit: int = 20,
+        offset: int = 0,
+        fuzzy: bool = False,
+    ) -> List[UserEntry]:
+        """Search users by username, name or surname.
+
+        The default is a case-insensitive prefix search, ranked by the
+        field that matched (username, then name, then surname). With
+        fuzzy enabled, users are ranked by trigram similarity instead
+        (on PostgreSQL without `pg_trgm`, the fields that contain the
+        query are returned, with the same ranking as the prefix search).
+        """
+        columns = (UserEntry.username, UserEntry.name, UserEntry.surname)
+        if fuzzy and self.dialect_name == "postgresql":
+            if get_server_config().SEARCH_TRIGRAM:
+                return await self._search_users_trigram(query, limit, offset)
+            matches = [column.icontains(query, autoescape=True) for column in columns]
+            return await self._search_users_ranked(matches, limit, offset)
+
+        if fuzzy:
+            return await self._search_users_index(query, limit, offset)
+
+        matches = [prefix_match(column, query, self.dialect_name) for column in columns]
+        return await self._search_users_ranked(matches, limit, offset)
+
+    async def _search_users_ranked(
+        self,
+        matches: list,
+        limit: int,
+        offset: int,
+    ) -> List[UserEntry]:
+        """Users matching any of the predicates (of username, name, surname)."""
+        ranking = case(
+            (matches[0], 0),
+            (matches[1], 1),
+            else_=2,
+        )
+        querystr = (
+            select(UserEntry)
+            .filter(or_(*matches))
+            .order_by(ranking, UserEntry.username)
+            .limit(limit)
+            .offset(offset)
+        )
         results = await self._session.execute(querystr)
-        result = results.scalars().first()
-        return result
+        return list(results.scalars())
+
+    async def _search_users_trigram(
+        self,
+        query: str,
+        limit: int,
+        offset: int,
+    ) -> List[UserEntry]:
+        """Fuzzy search through the pg_trgm extension."""
+        query = query.lower()
+        columns = [
+            func.lower(column)
+            for column in (UserEntry.username, UserEntry.name, UserEntry.surname)
+        ]
+        score = func.greatest(*[func.similarity(column, query) for column in columns])
+        querystr = (
+            select(UserEntry)
+            .filter(or_(*[column.op("%")(query) for column in columns]))
+            .order_by(score.desc(), UserEntry.username)
+            .limit(limit)
+            .offset(offset)
+        )
+        results = await self._session.execute(querystr)
+        return list(results.scalars())
+
+    async def _search_users_index(
+        self,
+        query: str,
+        limit: int,
+        offset: int,
+    ) -> List[UserEntry]:
+        """Fuzzy search through the in-process trigram index (SQLite only)."""
+        await USER_SEARCH_INDEX.sync(self._session)
+        matches = USER_SEARCH_INDEX.search(query, limit=limit, offset=offset)
+        if not matches:
+            return []
+
+        users = await self.get_users(uuids=[uuid for uuid, _ in matches])
+        users_by_uuid = {user.uuid: user for user in users}
+        return [users_by_uuid[uuid] for uuid, _ in matches if uuid in users_by_uuid]
+
+    async def is_registered(self, field: str, value: str) -> bool:
+        """Check if a username or an email is already in use.
+
+        It is an existence query on the unique index of the field.
+        """
+        if field not in AVAILABILITY_FIELDS:
+            raise ValueError(f"Availability can't be checked for `{field}`.")
+
+        querystr = select(exists().where(getattr(UserEntry, field) == value))
+        results = await self._session.execute(querystr)
+        return bool(results.scalar())
 
     async def authenticate_user(
         self,
@@ -90,10 +401,21 @@ class DatabaseManager:
         user = await self.get_user(username)
         if not user:
             return None
-        if not verify_password(password, user.hashed_password):
+
+        hashed_password = await self._get_hashed_password(user)
+        if hashed_password is None or not verify_password(password, hashed_password):
             return None
         return user
 
+    async def _get_hashed_password(self, user: UserEntry) -> Optional[str]:
+        """Password hash of a user (read again if the user came from the cache)."""
+        if "hashed_password" not in inspect(user).unloaded:
+            return user.hashed_password
+
+        querystr = select(UserEntry.hashed_password).filter_by(uuid=user.uuid)
+        results = await self._session.execute(querystr)
+        return results.scalar_one_or_none()
+
     async def create_user(
         self,
         username: str,
@@ -118,9 +440,20 @@ class DatabaseManager:
         )
 
         self._session.add(new_user)
-        await self._session.commit()
+        try:
+            await self._session.commit()
+        except IntegrityError:
+            # Registered concurrently since the availability was checked
+            await self._session.rollback()
+            return None
         await self._session.refresh(new_user)
 
+        after = UserSnapshot.from_dbentry(new_user)
+        self._forget_users(after)
+        self._loader.prime(new_user)
+        if self._cache is not None:
+            await self._cache.invalidate(after)
+        USER_EVENTS.publish(UserChange(None, after))
         return new_user
 
     async def record_login(self, user: UserEntry):
@@ -136,36 +469,126 @@ class DatabaseManager:
 
         return new_login
 
-    async def get_login(self, uuid: UUID) -> LoginEntry:
-        """Get a single login record from the database."""
+    async def get_login(
+        self,
+        uuid: UUID,
+        user_uuid: Optional[UUID] = None,
+        scope=None,
+    ) -> Optional[LoginEntry]:
+        """Get a single login record from the database.
+
+        If a user uuid is provided, the record must also belong to that
+        user. The scope is an extra predicate restricting the records that
+        can be returned (see `PolicyEnforcer.visible_logins`).
+        """
         querystr = select(LoginEntry).filter_by(uuid=uuid)
+        if user_uuid is not None:
+            querystr = querystr.filter_by(user=user_uuid)
+        if scope is not None:
+            querystr = querystr.filter(scope)
         result = await self._session.execute(querystr)
         return result.scalars().first()
 
-    async def get_logins(self, user_uuid: Optional[UUID]) -> List[LoginEntry]:
+    async def get_logins(
+        self,
+        user_uuid: Optional[UUID] = None,
+        uuids: Optional[List[UUID]] = None,
+        ctime_from: Optional[datetime] = None,
+        ctime_to: Optional[datetime] = None,
+        sort: Optional[str] = None,
+        scope=None,
+    ) -> List[LoginEntry]:
         """Get a list of login records from the database.
 
         If a user uuid is provided, it will only be logins from
-        said user.
+        said user. If a list of uuids is provided, only those login
+        records are fetched (in a single query, in no particular order).
+        Logins can also be filtered by time (from is inclusive, to is
+        exclusive) and sorted by any of the keys in LOGIN_SORT_COLUMNS.
+        The scope is an extra predicate restricting the records that can
+        be returned (see `PolicyEnforcer.visible_logins`).
         """
-        if user_uuid is None:
-            querystr = select(LoginEntry)
-        else:
-            querystr = select(LoginEntry).filter_by(user=user_uuid)
+        querystr = select(LoginEntry)
+        if scope is not None:
+            querystr = querystr.filter(scope)
+        if user_uuid is not None:
+            querystr = querystr.filter_by(user=user_uuid)
+        if uuids is not None:
+            querystr = querystr.filter(LoginEntry.uuid.in_(set(uuids)))
+        if ctime_from is not None:
+            querystr = querystr.filter(LoginEntry.ctime >= ctime_from)
+        if ctime_to is not None:
+            querystr = querystr.filter(LoginEntry.ctime < ctime_to)
+        querystr = querystr.order_by(
+            *sort_clauses(sort, LOGIN_SORT_COLUMNS, LoginEntry.uuid)
+        )
         results = await self._session.execute(querystr)
         results = [result[0] for result in results]
         return results
 
+    async def get_user_logins(
+        self,
+        user_uuid: UUID,
+        scope=None,
+    ) -> Optional[List[LoginEntry]]:
+        """Get the login records of a user, or None if the user is not found.
+
+        The user and its logins come from a single query (users left
+        joined with logins), so that a user without logins can be told
+        apart from a missing one. The scope is an extra predicate on the
+        users (see `PolicyEnforcer.visible_users`): users outside of it are
+        reported as missing.
+        """
+        querystr = (
+            select(UserEntry.uuid, LoginEntry)
+            .outerjoin(LoginEntry, LoginEntry.user == UserEntry.uuid)
+            .filter(UserEntry.uuid == user_uuid)
+        )
+        if scope is not None:
+            querystr = querystr.filter(scope)
+        results = (await self._session.execute(querystr)).all()
+        if not results:
+            return None
+        return [login for _, login in results if login is not None]
+
+    async def get_user_version(self, uuid: UUID) -> Optional[int]:
+        """Get only the row version of a user (None if it doesn't exist)."""
+        querystr = select(UserEntry.version).filter_by(uuid=uuid)
+        results = await self._session.execute(querystr)
+        return results.scalar()
+
+    async def get_logins_version(
+        self,
+        user_uuid: UUID,
+    ) -> Tuple[int, Optional[datetime]]:
+        """Get the number of logins of a user and the time of the latest.
+
+        Both values come from the (user, ctime) index, without reading
+        the login records themselves.
+        """
+        querystr = select(func.count(), func.max(LoginEntry.ctime)).filter(
+            LoginEntry.user == user_uuid
+        )
+        results = await self._session.execute(querystr)
+        login_count, last_login = results.one()
+        return login_count, last_login
+
     async def delete_user(self, uuid: UUID) -> None:
-        """Delete a user and all login records from the database."""
+        """Delete a user and all login records (and jobs) from the database."""
         user = await self.get_user(uuid=uuid)
         logins = await self.get_logins(user_uuid=uuid)
+        before = UserSnapshot.from_dbentry(user)
 
+        await self._session.execute(delete(JobEntry).filter_by(user=uuid))
         await self._session.delete(user)
         for login in logins:
             await self._session.delete(login)
 
         await self._session.commit()
+        self._forget_users(before)
+        if self._cache is not None:
+            await self._cache.invalidate(before)
+        USER_EVENTS.publish(UserChange(before, None))
 
     async def update_user(
         self,
@@ -173,8 +596,14 @@ class DatabaseManager:
         new_role: Optional[Role] = None,
         new_username: Optional[str] = None,
     ) -> UserEntry:
-        """Update user information (username or role)."""
+        """Update user information (username or role).
+
+        Returns None if the user was modified since it was read (the copy
+        was stale, for example, because it came from the cache), after
+        dropping that copy so the next attempt reads the current one.
+        """
         user = await self.get_user(uuid=uuid)
+        before = UserSnapshot.from_dbentry(user)
 
         if new_username is not None:
             user.username = new_username
@@ -182,6 +611,153 @@ class DatabaseManager:
         if new_role is not None:
             user.role = new_role
 
-        await self._session.commit()
-        user = await self.get_user(uuid=uuid)
+        after = UserSnapshot.from_dbentry(user)
+        try:
+            await self._session.commit()
+        except StaleDataError:
+            await self._session.rollback()
+            self._forget_users(before)
+            self._session.expunge(user)
+            if self._cache is not None:
+                await self._cache.invalidate(before)
+            return None
+        if inspect(user).expired_attributes:
+            await self._session.refresh(user)
+
+        self._forget_users(before, after)
+        self._loader.prime(user)
+        if self._cache is not None:
+            await self._cache.invalidate(before, after)
+        USER_EVENTS.publish(UserChange(before, after))
         return user
+
+    async def create_job(self, user_uuid: UUID, kind: str, payload) -> JobEntry:
+        """Store a pending job with its input."""
+        new_job = JobEntry(
+            uuid=uuid4(),
+            user=user_uuid,
+            kind=kind,
+            status=JobStatus.pending,
+            payload=bytes(payload),
+        )
+
+        self._session.add(new_job)
+        await self._session.commit()
+        await self._session.refresh(new_job)
+
+        return new_job
+
+    async def get_job(
+        self,
+        uuid: UUID,
+        with_payload: bool = False,
+        scope=None,
+    ) -> Optional[JobEntry]:
+        """Get a job from the database.
+
+        The input of the job is only loaded if requested. The scope is an
+        extra predicate restricting the jobs that can be returned (see
+        `PolicyEnforcer.visible_jobs`).
+        """
+        querystr = select(JobEntry).filter_by(uuid=uuid)
+        if with_payload:
+            querystr = querystr.options(undefer(JobEntry.payload))
+        if scope is not None:
+            querystr = querystr.filter(scope)
+        result = await self._session.execute(querystr)
+        return result.scalars().first()
+
+    @staticmethod
+    def _claimable_jobs(now: datetime):
+        # Pending, or running in a process whose lease expired (or that
+        # started it before the jobs had leases)
+        return or_(
+            JobEntry.status == JobStatus.pending,
+            and_(
+                JobEntry.status == JobStatus.running,
+                or_(JobEntry.lease_expires.is_(None), JobEntry.lease_expires < now),
+            ),
+        )
+
+    async def get_claimable_jobs(self) -> List[UUID]:
+        """Get the uuids of the jobs that can be claimed, oldest first."""
+        querystr = (
+            select(JobEntry.uuid)
+            .filter(self._claimable_jobs(datetime.now()))
+            .order_by(JobEntry.ctime, JobEntry.uuid)
+        )
+        result = await self._session.execute(querystr)
+        return list(result.scalars())
+
+    async def claim_job(
+        self,
+        uuid: UUID,
+        owner: str,
+        lease_seconds: float,
+    ) -> Optional[JobEntry]:
+        """Mark a job as running in a process, returning it with its input.
+
+        The claim is a single conditional update, so that only one of the
+        processes trying to claim the same job gets it (the others get
+        None, as for jobs that are finished or being run elsewhere).
+        """
+        now = datetime.now()
+        querystr = (
+            update(JobEntry)
+            .where(JobEntry.uuid == uuid, self._claimable_jobs(now))
+            .values(
+                status=JobStatus.running,
+                owner=owner,
+                lease_expires=now + timedelta(seconds=lease_seconds),
+                mtime=now,
+            )
+            .execution_options(synchronize_session="fetch")
+        )
+        result = await self._session.execute(querystr)
+        await self._session.commit()
+        if result.rowcount != 1:
+            return None
+
+        querystr = (
+            select(JobEntry)
+            .filter_by(uuid=uuid)
+            .options(undefer(JobEntry.payload))
+            .execution_options(populate_existing=True)
+        )
+        result = await self._session.execute(querystr)
+        return result.scalars().first()
+
+    async def release_jobs(self, owner: str) -> int:
+        """Return the jobs running in a process to pending, returning how many."""
+        querystr = (
+            update(JobEntry)
+            .where(JobEntry.owner == owner, JobEntry.status == JobStatus.running)
+            .values(status=JobStatus.pending, owner=None, lease_expires=None)
+            .execution_options(synchronize_session="fetch")
+        )
+        result = await self._session.execute(querystr)
+        await self._session.commit()
+        return result.rowcount
+
+    async def update_job(
+        self,
+        job: JobEntry,
+        status: JobStatus,
+        result: Optional[Any] = None,
+        error: Optional[str] = None,
+        status_code: Optional[int] = None,
+    ) -> JobEntry:
+        """Update the status of a job (and its outcome, once finished).
+
+        The input of finished jobs is dropped, since it is no longer needed.
+        """
+        job.status = status
+        job.mtime = datetime.now()
+        if status in FINISHED_JOB_STATUSES:
+            job.payload = None
+            job.result = result
+            job.error = error
+            job.status_code = status_code
+
+        await self._session.commit()
+        return job
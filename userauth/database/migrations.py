@@ -0,0 +1,130 @@
+"""
+Module with the migrations of the database schema.
+
+`create_all` only creates the tables that don't exist yet, so the
+columns and indexes that newer versions add to existing tables are added
+here (the columns with `ALTER TABLE ... ADD COLUMN`). Migrations are
+additive: new columns must be nullable or have a server default (so that
+the existing rows get a value), and dropped columns or changed types
+aren't migrated. Once migrated, the tables, columns and indexes of the
+database are checked against the ones of the models.
+"""
+from typing import List, Set
+
+from sqlalchemy import Column, Index, Table, inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from .models import Base
+
+
+class SchemaMigrationError(RuntimeError):
+    """The schema of the database can't be migrated to the one of the models."""
+
+
+def missing_columns(connection) -> List[Column]:
+    """Columns of the models missing from the existing tables."""
+    inspector = inspect(connection)
+    table_names = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        column_names = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(
+            column for column in table.columns if column.name not in column_names
+        )
+    return missing
+
+
+def add_missing_columns(connection) -> List[str]:
+    """Add the columns missing from the existing tables, returning their names."""
+    added = []
+    preparer = connection.dialect.identifier_preparer
+    for column in missing_columns(connection):
+        name = f"{column.table.name}.{column.name}"
+        if not column.nullable and column.server_default is None:
+            raise SchemaMigrationError(
+                f"column {name} can't be added to the existing rows "
+                "(it isn't nullable and has no server default)"
+            )
+        definition = CreateColumn(column).compile(dialect=connection.dialect)
+        table = preparer.format_table(column.table)
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {definition}"))
+        added.append(name)
+    return added
+
+
+def expected_indexes(table: Table, dialect_name: str) -> List[Index]:
+    """Indexes of a table in the models (the ones of the dialect)."""
+    return [
+        index
+        for index in table.indexes
+        if index.info.get("dialect", dialect_name) == dialect_name
+    ]
+
+
+def existing_index_names(connection, table_name: str) -> Set[str]:
+    """Names of the indexes of an existing table."""
+    if connection.dialect.name == "sqlite":
+        # Reflection skips the indexes on expressions (like `lower(name)`)
+        result = connection.execute(
+            text(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'index' AND tbl_name = :table_name"
+            ),
+            {"table_name": table_name},
+        )
+        return set(result.scalars())
+    return {index["name"] for index in inspect(connection).get_indexes(table_name)}
+
+
+def add_missing_indexes(connection) -> List[str]:
+    """Create the indexes missing from the existing tables, returning their names."""
+    added = []
+    for table in Base.metadata.sorted_tables:
+        index_names = existing_index_names(connection, table.name)
+        for index in expected_indexes(table, connection.dialect.name):
+            if index.name not in index_names:
+                index.create(connection)
+                added.append(index.name)
+    return added
+
+
+def schema_differences(connection) -> List[str]:
+    """Tables, columns and indexes of the models missing from the database."""
+    differences = []
+    table_names = set(inspect(connection).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            differences.append(f"table {table.name} is missing")
+    differences.extend(
+        f"column {column.table.name}.{column.name} is missing"
+        for column in missing_columns(connection)
+    )
+    for table in Base.metadata.sorted_tables:
+        if table.name not in table_names:
+            continue
+        index_names = existing_index_names(connection, table.name)
+        differences.extend(
+            f"index {index.name} is missing"
+            for index in expected_indexes(table, connection.dialect.name)
+            if index.name not in index_names
+        )
+    return differences
+
+
+def migrate_schema(connection) -> List[str]:
+    """Create the schema of the models, migrating the existing tables.
+
+    Returns the columns and indexes added to the existing tables. Raises
+    a SchemaMigrationError if the schema still differs from the models.
+    """
+    Base.metadata.create_all(connection)
+    added = add_missing_columns(connection) + add_missing_indexes(connection)
+    differences = schema_differences(connection)
+    if differences:
+        details = "; ".join(differences)
+        raise SchemaMigrationError(
+            f"the schema of the database doesn't match the models: {details}"
+        )
+    return added
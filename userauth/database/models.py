@@ -1,10 +1,27 @@
 """
 Module with the database ORM models.
 """
-from sqlalchemy import TIMESTAMP, Column, Enum, ForeignKey, String, Uuid
-from sqlalchemy.orm import DeclarativeBase
+import hashlib
+from functools import lru_cache
+
+from sqlalchemy import (
+    DDL,
+    JSON,
+    TIMESTAMP,
+    Column,
+    Enum,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    Uuid,
+    event,
+)
+from sqlalchemy.orm import DeclarativeBase, deferred
 from sqlalchemy.sql import func
 
+from userauth.common.jobs import JobStatus
 from userauth.common.roles import Role
 
 
@@ -12,6 +29,12 @@ class Base(DeclarativeBase):
     pass
 
 
+def dialect_index(index: Index, dialect: str) -> Index:
+    """Make an index only exist on one dialect (noted in its info)."""
+    index.info["dialect"] = dialect
+    return index.ddl_if(dialect=dialect)
+
+
 class UserEntry(Base):
     __tablename__ = "users"
 
@@ -27,6 +50,33 @@ class UserEntry(Base):
     # Private properties
     hashed_password = Column(String)
 
+    # Row version, increased by the ORM on every update (and checked, so
+    # updates made from stale copies of the row fail instead of winning)
+    version = Column(Integer, nullable=False, server_default="1")
+    __mapper_args__ = {"version_id_col": version}
+
+    # Case-insensitive prefix search (text_pattern_ops lets postgres
+    # use the index for `LIKE 'prefix%'` with any collation)
+    __table_args__ = (
+        Index("ix_users_ctime", ctime),
+        dialect_index(Index("ix_users_role_ctime", role, ctime), "sqlite"),
+        Index(
+            "ix_users_username_lower",
+            func.lower(username).label("username_lower"),
+            postgresql_ops={"username_lower": "text_pattern_ops"},
+        ),
+        Index(
+            "ix_users_name_lower",
+            func.lower(name).label("name_lower"),
+            postgresql_ops={"name_lower": "text_pattern_ops"},
+        ),
+        Index(
+            "ix_users_surname_lower",
+            func.lower(surname).label("surname_lower"),
+            postgresql_ops={"surname_lower": "text_pattern_ops"},
+        ),
+    )
+
 
 class LoginEntry(Base):
     __tablename__ = "logins"
@@ -34,3 +84,104 @@ class LoginEntry(Base):
     uuid = Column(Uuid, primary_key=True, index=True)
     user = Column(Uuid, ForeignKey("users.uuid"), nullable=False)
     ctime = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_logins_ctime", ctime),
+        Index("ix_logins_user_ctime", user, ctime),
+    )
+
+
+class JobEntry(Base):
+    __tablename__ = "jobs"
+
+    uuid = Column(Uuid, primary_key=True, index=True)
+    user = Column(Uuid, ForeignKey("users.uuid"), nullable=False)
+    kind = Column(String, nullable=False)
+    status = Column(Enum(JobStatus), nullable=False)
+    ctime = Column(TIMESTAMP, server_default=func.now())
+    mtime = Column(TIMESTAMP)
+
+    # Process running the job, and until when (others may claim it after)
+    owner = Column(String)
+    lease_expires = Column(TIMESTAMP)
+
+    # Input of the job (only loaded to run it, and dropped once finished)
+    payload = deferred(Column(LargeBinary))
+
+    # Outcome: the result, or the error and its HTTP status code
+    result = Column(JSON)
+    error = Column(String)
+    status_code = Column(Integer)
+
+    __table_args__ = (Index("ix_jobs_status_ctime", status, ctime),)
+
+
+# On postgres, a partial index per role means that filtering users by
+# role only touches the rows of that role (sqlite uses role_ctime).
+for indexed_role in Role:
+    dialect_index(
+        Index(
+            f"ix_users_{indexed_role.name}_ctime",
+            UserEntry.ctime,
+            postgresql_where=UserEntry.role == indexed_role,
+        ),
+        "postgresql",
+    )
+
+
+# On sqlite, triggers record which users had their searchable columns
+# changed (by any process), so that the in-process search index of every
+# process can catch up with them; only the latest changes are kept.
+SEARCH_CHANGES_KEPT = 100000
+SQLITE_SEARCH_CHANGES_DDL = (
+    "CREATE TABLE IF NOT EXISTS user_search_changes "
+    '(seq INTEGER PRIMARY KEY AUTOINCREMENT, "user" CHAR(32) NOT NULL)',
+    "CREATE TRIGGER IF NOT EXISTS tr_users_search_insert AFTER INSERT ON users "
+    'BEGIN INSERT INTO user_search_changes ("user") VALUES (NEW.uuid); END',
+    "CREATE TRIGGER IF NOT EXISTS tr_users_search_update "
+    "AFTER UPDATE OF username, name, surname ON users "
+    'BEGIN INSERT INTO user_search_changes ("user") VALUES (NEW.uuid); END',
+    "CREATE TRIGGER IF NOT EXISTS tr_users_search_delete AFTER DELETE ON users "
+    'BEGIN INSERT INTO user_search_changes ("user") VALUES (OLD.uuid); END',
+    "CREATE TRIGGER IF NOT EXISTS tr_user_search_changes_prune "
+    "AFTER INSERT ON user_search_changes BEGIN DELETE FROM user_search_changes "
+    f"WHERE seq <= NEW.seq - {SEARCH_CHANGES_KEPT}; END",
+)
+for statement in SQLITE_SEARCH_CHANGES_DDL:
+    # Created along with the tables (and kept out of the models, as the
+    # other backends don't need them)
+    event.listen(
+        Base.metadata, "after_create", DDL(statement).execute_if(dialect="sqlite")
+    )
+
+
+class SchemaVersionEntry(Base):
+    __tablename__ = "schema_version"
+
+    # Fingerprint of the schema the tables were last created with
+    version = Column(String, primary_key=True)
+
+
+@lru_cache(maxsize=None)
+def schema_fingerprint() -> str:
+    """Hash of the definition of the tables, columns, indexes and triggers.
+
+    It changes whenever the models do, so the schema is only created
+    again (which reflects all the tables) after an upgrade. The models
+    don't change while running, so it is computed once.
+    """
+    definition = []
+    for table in Base.metadata.sorted_tables:
+        definition.append(f"table {table.name}")
+        for column in table.columns:
+            definition.append(
+                f"column {column.name} {column.type!r} "
+                f"nullable={column.nullable} primary_key={column.primary_key}"
+            )
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            expressions = ", ".join(str(expression) for expression in index.expressions)
+            definition.append(
+                f"index {index.name} unique={index.unique} ({expressions})"
+            )
+    definition.extend(SQLITE_SEARCH_CHANGES_DDL)
+    return hashlib.sha256("\n".join(definition).encode()).hexdigest()
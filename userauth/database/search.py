@@ -0,0 +1,219 @@
+"""
+Module with the helpers for searching users by name.
+
+Prefix searches are translated into predicates that can use the
+`lower(...)` expression indexes of the users table. Fuzzy searches use
+trigram similarity: on PostgreSQL through the `pg_trgm` extension, and
+on SQLite through an in-process trigram index that mirrors the `pg_trgm`
+similarity measure. Triggers record in the database which users changed
+(whichever process changed them), and before every search the index of
+each process catches up with the changes it hasn't seen yet.
+"""
+import asyncio
+from collections import Counter
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+from uuid import UUID
+
+from sqlalchemy import Integer, Uuid, and_, column, func, select, table
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import UserEntry
+
+SEARCHABLE_COLUMNS = ("username", "name", "surname")
+SIMILARITY_THRESHOLD = 0.3
+
+# Changes of the searchable columns of the users (see SQLITE_SEARCH_CHANGES_DDL)
+USER_SEARCH_CHANGES = table(
+    "user_search_changes",
+    column("seq", Integer),
+    column("user", Uuid),
+)
+
+# Trigram indexes only created if the search is configured to use pg_trgm
+POSTGRESQL_TRIGRAM_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    *[
+        f"CREATE INDEX IF NOT EXISTS ix_users_{column}_trgm "
+        f"ON users USING gin (lower({column}) gin_trgm_ops)"
+        for column in SEARCHABLE_COLUMNS
+    ],
+)
+
+
+def prefix_match(column, prefix: str, dialect_name: str):
+    """Return a case-insensitive prefix predicate for the column.
+
+    PostgreSQL can use a `text_pattern_ops` index for `LIKE 'abc%'`,
+    while SQLite only uses expression indexes for range comparisons.
+    """
+    lowered_column = func.lower(column)
+    prefix = prefix.lower()
+    if dialect_name == "postgresql":
+        return lowered_column.startswith(prefix, autoescape=True)
+
+    upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return and_(lowered_column >= prefix, lowered_column < upper_bound)
+
+
+def trigrams(text: str) -> FrozenSet[str]:
+    """Extract the set of trigrams of a text, the same way `pg_trgm` does.
+
+    Each word is lowercased and padded with two spaces in front and one
+    at the end before taking all substrings of length 3.
+    """
+    result: Set[str] = set()
+    for word in text.lower().split():
+        padded = f"  {word} "
+        for start in range(len(padded) - 2):
+            end = start + 3
+            result.add(padded[start:end])
+    return frozenset(result)
+
+
+def similarity(first: FrozenSet[str], second: FrozenSet[str]) -> float:
+    """Ratio of shared trigrams over the total (as in `pg_trgm.similarity`)."""
+    if not first or not second:
+        return 0.0
+    shared = len(first & second)
+    return shared / (len(first) + len(second) - shared)
+
+
+class TrigramIndex:
+    """In-process inverted index from trigrams to user uuids."""
+
+    def __init__(self):
+        """Initialize an empty index (it needs to be built before use)."""
+        self._postings: Dict[str, Set[UUID]] = {}
+        self._documents: Dict[UUID, Tuple[FrozenSet[str], ...]] = {}
+        self._sync_lock: Optional[asyncio.Lock] = None
+        # Latest change of the database already in the index
+        self._synced_seq = 0
+        self.is_built = False
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def add(self, uuid: UUID, *texts: str) -> None:
+        """Index the searchable texts of a user."""
+        self.remove(uuid)
+        documents = tuple(trigrams(text) for text in texts if text)
+        self._documents[uuid] = documents
+        for document in documents:
+            for trigram in document:
+                self._postings.setdefault(trigram, set()).add(uuid)
+
+    def remove(self, uuid: UUID) -> None:
+        """Remove a user from the index (if it was present)."""
+        documents = self._documents.pop(uuid, ())
+        for document in documents:
+            for trigram in document:
+                postings = self._postings.get(trigram)
+                if postings is not None:
+                    postings.discard(uuid)
+                    if not postings:
+                        del self._postings[trigram]
+
+    def search(
+        self,
+        query: str,
+        limit: int,
+        offset: int = 0,
+        threshold: float = SIMILARITY_THRESHOLD,
+    ) -> List[Tuple[UUID, float]]:
+        """Return the (uuid, score) of the best matches, best first.
+
+        The score of a user is the best similarity among its texts. Only
+        users sharing at least one trigram with the query are scored.
+        """
+        query_trigrams = trigrams(query)
+        candidates: Counter = Counter()
+        for trigram in query_trigrams:
+            candidates.update(self._postings.get(trigram, ()))
+
+        scored = []
+        for uuid in candidates:
+            score = max(
+                similarity(query_trigrams, document)
+                for document in self._documents[uuid]
+            )
+            if score >= threshold:
+                scored.append((uuid, score))
+
+        scored.sort(key=lambda item: (-item[1], str(item[0])))
+        end = offset + limit
+        return scored[offset:end]
+
+    async def sync(self, session: AsyncSession, batch_size: int = 10000):
+        """Build the index, or catch up with the changes of the database.
+
+        The index is built by streaming the users table the first time,
+        and again if the changes it hasn't seen were already pruned.
+        """
+        if self._sync_lock is None:
+            self._sync_lock = asyncio.Lock()
+
+        async with self._sync_lock:
+            querystr = select(
+                func.min(USER_SEARCH_CHANGES.c.seq),
+                func.max(USER_SEARCH_CHANGES.c.seq),
+            )
+            oldest_seq, latest_seq = (await session.execute(querystr)).one()
+            if latest_seq is None or latest_seq <= self._synced_seq:
+                if not self.is_built:
+                    await self._build(session, batch_size)
+                return
+
+            if self.is_built and oldest_seq <= self._synced_seq + 1:
+                await self._apply_changes(session, latest_seq, batch_size)
+            else:
+                await self._build(session, batch_size)
+            self._synced_seq = latest_seq
+
+    async def _build(self, session: AsyncSession, batch_size: int):
+        self._postings.clear()
+        self._documents.clear()
+        querystr = select(
+            UserEntry.uuid,
+            UserEntry.username,
+            UserEntry.name,
+            UserEntry.surname,
+        ).execution_options(yield_per=batch_size)
+        results = await session.stream(querystr)
+        async for uuid, username, name, surname in results:
+            self.add(uuid, username, name, surname)
+        self.is_built = True
+
+    async def _apply_changes(
+        self, session: AsyncSession, latest_seq: int, batch_size: int
+    ):
+        querystr = (
+            select(USER_SEARCH_CHANGES.c.user)
+            .where(USER_SEARCH_CHANGES.c.seq > self._synced_seq)
+            .where(USER_SEARCH_CHANGES.c.seq <= latest_seq)
+            .distinct()
+        )
+        changed = list((await session.execute(querystr)).scalars())
+        for start in range(0, len(changed), batch_size):
+            end = start + batch_size
+            uuids = changed[start:end]
+            querystr = select(
+                UserEntry.uuid,
+                UserEntry.username,
+                UserEntry.name,
+                UserEntry.surname,
+            ).where(UserEntry.uuid.in_(uuids))
+            users = {row[0]: row for row in await session.execute(querystr)}
+            for uuid in uuids:
+                self.remove(uuid)
+                if uuid in users:
+                    self.add(*users[uuid])
+
+    def reset(self) -> None:
+        """Drop all the indexed data."""
+        self._postings.clear()
+        self._documents.clear()
+        self._synced_seq = 0
+        self.is_built = False
+
+
+USER_SEARCH_INDEX = TrigramIndex()
@@ -1,30 +1,217 @@
 """
 Module to manage the scope of the session.
 """
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import logging
+import os
+import time
+from typing import Optional
 
-from userauth.common.config import SERVER_CONFIG
+from prometheus_client import Gauge, Histogram
+from sqlalchemy import delete, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 
+from userauth.common.config import get_server_config
+
+from .cache import UserCache, build_user_cache
 from .manager import DatabaseManager
-from .models import Base
+from .migrations import migrate_schema
+from .models import SchemaVersionEntry, schema_fingerprint
+from .search import POSTGRESQL_TRIGRAM_DDL
+from .singleflight import SingleFlight, build_single_flight
+
+POOL_CONNECTIONS = Gauge(
+    "userauth_database_pool_connections",
+    "Connections of the database pool, by state: checked out, in the pool "
+    "and overflow (opened beyond the size of the pool).",
+    labelnames=("state",),
+    multiprocess_mode="livesum",
+)
+POOL_CONNECT_SECONDS = Histogram(
+    "userauth_database_pool_connect_seconds",
+    "Time to get a connection from the pool (waiting for a free one, or "
+    "opening a new one).",
+)
+
+_engine: Optional[AsyncEngine] = None
+# Built on first use, like the engine (and possibly None: disabled)
+_user_cache: Optional[UserCache] = None
+_single_flight: Optional[SingleFlight] = None
+_built_shared = False
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Time the checkouts of connections from the pool of an engine.
+
+    The engine is wrapped instead of its pool, which is replaced when
+    the engine is disposed.
+    """
+    sync_engine = engine.sync_engine
+    raw_connection = sync_engine.raw_connection
+
+    def timed_raw_connection():
+        start_time = time.perf_counter()
+        try:
+            return raw_connection()
+        finally:
+            POOL_CONNECT_SECONDS.observe(time.perf_counter() - start_time)
+
+    sync_engine.raw_connection = timed_raw_connection
+
+
+def update_pool_metrics() -> None:
+    """Read the state of the pool into the metrics (before exporting them)."""
+    if _engine is None:
+        return
+    pool = _engine.sync_engine.pool
+    # Only queue pools keep these counts (not the static ones of sqlite)
+    for state, method_name in (
+        ("checked_out", "checkedout"),
+        ("pooled", "checkedin"),
+        ("overflow", "overflow"),
+    ):
+        method = getattr(pool, method_name, None)
+        if method is not None:
+            POOL_CONNECTIONS.labels(state=state).set(max(0, method()))
+
+
+def get_engine() -> AsyncEngine:
+    """The engine of the configured database (created on first use)."""
+    global _engine
+
+    if _engine is None:
+        server_config = get_server_config()
+        if server_config.DATABASE_ENGINE_ARGS is None:
+            _engine = create_async_engine(server_config.DATABASE_ENGINE_URL)
+        else:
+            _engine = create_async_engine(
+                server_config.DATABASE_ENGINE_URL,
+                connect_args=server_config.DATABASE_ENGINE_ARGS.model_dump(),
+            )
+        instrument_engine(_engine)
+    return _engine
+
+
+def _build_shared():
+    global _user_cache, _single_flight, _built_shared
+
+    if not _built_shared:
+        server_config = get_server_config()
+        _user_cache = build_user_cache(
+            server_config.CACHE_URL,
+            ttl=server_config.CACHE_TTL_SECONDS,
+            max_entries=server_config.CACHE_LOCAL_MAX_ENTRIES,
+            timeout=server_config.CACHE_TIMEOUT_SECONDS,
+            pool_size=server_config.CACHE_POOL_SIZE,
+        )
+        _single_flight = build_single_flight(server_config.SINGLE_FLIGHT_SCOPES)
+        _built_shared = True
+
+
+def get_user_cache() -> Optional[UserCache]:
+    """The cache of the users shared by the requests (None if disabled)."""
+    _build_shared()
+    return _user_cache
+
+
+def get_single_flight() -> Optional[SingleFlight]:
+    """The deduplication of the lookups of the requests (None if disabled)."""
+    _build_shared()
+    return _single_flight
 
-if SERVER_CONFIG.DATABASE_ENGINE_ARGS is None:
-    engine = create_async_engine(SERVER_CONFIG.DATABASE_ENGINE_URL)
-else:
-    engine = create_async_engine(
-        SERVER_CONFIG.DATABASE_ENGINE_URL,
-        connect_args=SERVER_CONFIG.DATABASE_ENGINE_ARGS.model_dump(),
-    )
+
+def __getattr__(name):
+    # `engine`, `user_cache` and `single_flight` are kept as attributes for
+    # the modules importing them
+    if name == "engine":
+        return get_engine()
+    if name == "user_cache":
+        return get_user_cache()
+    if name == "single_flight":
+        return get_single_flight()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _dispose_engine_in_child():
+    # Connections inherited from the parent process (if the workers are
+    # forked after using the engine) are left for the parent to close
+    if _engine is not None:
+        _engine.sync_engine.dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_dispose_engine_in_child)
+
+logger = logging.getLogger(__name__)
 
 
 async def get_database_manager():
-    session = AsyncSession(engine)
+    # Entries stay usable after commits, so the lookups memoized during
+    # the request don't need to be reloaded
+    session = AsyncSession(get_engine(), expire_on_commit=False)
     try:
-        yield DatabaseManager(session)
+        yield DatabaseManager(
+            session,
+            cache=get_user_cache(),
+            single_flight=get_single_flight(),
+        )
     finally:
         await session.close()
 
 
-async def safe_create_db():
+async def start_cache():
+    """Start receiving the cache invalidations from other replicas."""
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        await user_cache.cache.start()
+
+
+async def stop_cache():
+    """Stop receiving invalidations and release the cache connections."""
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        await user_cache.cache.stop()
+
+
+def stored_schema_version(connection) -> Optional[str]:
+    """Version of the schema stored in the database (if any)."""
+    if not inspect(connection).has_table(SchemaVersionEntry.__tablename__):
+        return None
+    return connection.execute(select(SchemaVersionEntry.version)).scalar()
+
+
+async def ensure_schema(engine: AsyncEngine) -> bool:
+    """Create and migrate the schema, unless it is up to date.
+
+    The columns and indexes added by newer versions to existing tables are
+    added too. The version of the schema is only stored once the database
+    matches the models (otherwise, a SchemaMigrationError is raised and
+    nothing is stored), so that later starts only check it instead of
+    reflecting all the tables. Returns whether the schema had to be
+    created or migrated.
+    """
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        search_trigram = get_server_config().SEARCH_TRIGRAM
+        trigram = conn.dialect.name == "postgresql" and search_trigram
+        version = schema_fingerprint() + ("+trigram" if trigram else "")
+        if await conn.run_sync(stored_schema_version) == version:
+            return False
+
+        added = await conn.run_sync(migrate_schema)
+        if added:
+            logger.info("added %s to the existing tables", ", ".join(added))
+        if trigram:
+            for statement in POSTGRESQL_TRIGRAM_DDL:
+                await conn.execute(text(statement))
+
+        await conn.execute(delete(SchemaVersionEntry))
+        await conn.execute(
+            SchemaVersionEntry.__table__.insert().values(version=version)
+        )
+    return True
+
+
+async def safe_create_db():
+    if await ensure_schema(get_engine()):
+        logger.info("database schema created")
+    else:
+        logger.info("database schema is up to date")
@@ -0,0 +1,132 @@
+"""
+Module with the single-flight coalescing of concurrent lookups.
+
+When many concurrent requests look up the same key (typically the user
+behind a popular token), only the first one runs the query and all the
+others wait for its result. Keys are tuples whose first element is the
+scope (for users, the field used for the lookup), and only the enabled
+scopes are coalesced.
+
+Results are shared between requests, so they must not be bound to the
+session that produced them (for example, plain row dicts).
+"""
+import asyncio
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from prometheus_client import Counter
+
+FlightKey = Tuple[str, Hashable]
+FlightFunction = Callable[[List[FlightKey]], Awaitable[Dict[FlightKey, Any]]]
+
+SINGLE_FLIGHT_LOOKUPS = Counter(
+    "userauth_singleflight_lookups_total",
+    "Keys looked up through the single-flight layer, by scope and outcome "
+    "(executed by the caller or coalesced into another in-flight query).",
+    labelnames=("scope", "outcome"),
+)
+
+
+class SingleFlight:
+    """Registry of the in-flight lookups shared between requests."""
+
+    def __init__(self, scopes: Iterable[str]):
+        """Initialize the registry for the given key scopes."""
+        self.scopes = frozenset(scopes)
+        self._flights: Dict[FlightKey, asyncio.Future] = {}
+
+    def covers(self, scope: str) -> bool:
+        """Check if the lookups of a scope are coalesced."""
+        return scope in self.scopes
+
+    async def do_many(
+        self,
+        keys: List[FlightKey],
+        function: FlightFunction,
+    ) -> Dict[FlightKey, Any]:
+        """Look up several keys, joining the flights already in progress.
+
+        The function is called (at most once) with the keys that nobody
+        else is looking up, and must return their results (missing keys
+        are taken as None).
+        """
+        joined = {key: self._flights[key] for key in keys if key in self._flights}
+        leading = [key for key in dict.fromkeys(keys) if key not in joined]
+
+        results: Dict[FlightKey, Any] = {}
+        if leading:
+            results = await self._lead(leading, function)
+
+        for key, flight in joined.items():
+            SINGLE_FLIGHT_LOOKUPS.labels(scope=key[0], outcome="coalesced").inc()
+            try:
+                results[key] = await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+                # The leader went away: look the key up again
+                results.update(await self.do_many([key], function))
+
+        return results
+
+    async def _lead(
+        self,
+        keys: List[FlightKey],
+        function: FlightFunction,
+    ) -> Dict[FlightKey, Any]:
+        loop = asyncio.get_running_loop()
+        flights = {key: loop.create_future() for key in keys}
+        self._flights.update(flights)
+        for key in keys:
+            SINGLE_FLIGHT_LOOKUPS.labels(scope=key[0], outcome="executed").inc()
+
+        try:
+            results = await function(keys)
+        except asyncio.CancelledError:
+            for flight in flights.values():
+                flight.cancel()
+            raise
+        except Exception as exception:
+            for flight in flights.values():
+                flight.set_exception(exception)
+                # Followers are optional, don't warn if nobody waits
+                flight.exception()
+            raise
+        else:
+            for key, flight in flights.items():
+                flight.set_result(results.get(key))
+        finally:
+            for key, flight in flights.items():
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+        return {key: results.get(key) for key in keys}
+
+    def forget(self, keys: Iterable[FlightKey]) -> None:
+        """Stop sharing the flights of the keys (after a write to them).
+
+        The flights in progress still finish, but later lookups start a
+        new query instead of joining a result that may predate the write.
+        """
+        for key in keys:
+            self._flights.pop(key, None)
+
+
+def build_single_flight(scopes: str) -> Optional[SingleFlight]:
+    """Build the single-flight layer from a comma separated list of scopes.
+
+    An empty list disables the coalescing (None is returned).
+    """
+    scope_names = [scope.strip() for scope in scopes.split(",") if scope.strip()]
+    if not scope_names:
+        return None
+    return SingleFlight(scope_names)
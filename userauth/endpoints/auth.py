@@ -1,27 +1,38 @@
 """
 Module with the functions and endpoints for authentication.
 """
+import time
 from datetime import datetime, timedelta
-from typing import Annotated
+from typing import Annotated, Optional
 
 from fastapi import APIRouter, Depends, Form
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
+from prometheus_client import Histogram
 from pydantic import BaseModel
 
-from userauth.common.config import SERVER_CONFIG
+from userauth.common.config import get_server_config
 from userauth.database import DatabaseManager, get_database_manager
-from userauth.endpoints.models import User
+from userauth.endpoints.models import Availability, User
 
 from .errors import (
     INCORRECT_CREDENTIALS_ERROR,
     INCORRECT_JSONWEBTOKEN_ERROR,
+    MISSING_AVAILABILITY_QUERY_ERROR,
     PREEXISTING_EMAIL_ERROR,
+    PREEXISTING_USER_ERROR,
     PREEXISTING_USERNAME_ERROR,
 )
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+JWT_SECONDS = Histogram(
+    "userauth_jwt_seconds",
+    "Time taken by the JSON web tokens, by operation (encode or decode).",
+    labelnames=("operation",),
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+
 
 class TokenPackage(BaseModel):
     access_token: str
@@ -36,11 +47,14 @@ def create_access_token(
     to_encode = data.copy()
     expiration_time = datetime.utcnow() + expires_delta
     to_encode.update({"exp": expiration_time})
+    server_config = get_server_config()
+    start_time = time.perf_counter()
     encoded_jwt = jwt.encode(
         to_encode,
-        SERVER_CONFIG.AUTH_SECRET_KEY,
-        algorithm=SERVER_CONFIG.AUTH_ALGORITHM,
+        server_config.AUTH_SECRET_KEY,
+        algorithm=server_config.AUTH_ALGORITHM,
     )
+    JWT_SECONDS.labels(operation="encode").observe(time.perf_counter() - start_time)
     return encoded_jwt
 
 
@@ -61,7 +75,7 @@ async def login_for_access_token(
 
     access_token = create_access_token(
         data={"sub": user.username},
-        expires_delta=timedelta(minutes=SERVER_CONFIG.AUTH_EXPIRATION_MINS),
+        expires_delta=timedelta(minutes=get_server_config().AUTH_EXPIRATION_MINS),
     )
 
     await db.record_login(user)
@@ -73,11 +87,13 @@ async def get_current_active_user(
     token: str = Depends(oauth2_scheme),
 ) -> User:
     """Return the current active user from authentication."""
+    server_config = get_server_config()
+    start_time = time.perf_counter()
     try:
         payload = jwt.decode(
             token,
-            SERVER_CONFIG.AUTH_SECRET_KEY,
-            algorithms=[SERVER_CONFIG.AUTH_ALGORITHM],
+            server_config.AUTH_SECRET_KEY,
+            algorithms=[server_config.AUTH_ALGORITHM],
         )
         username: str = payload.get("sub")
         if username is None:
@@ -85,6 +101,8 @@ async def get_current_active_user(
 
     except JWTError:
         raise INCORRECT_JSONWEBTOKEN_ERROR
+    finally:
+        JWT_SECONDS.labels(operation="decode").observe(time.perf_counter() - start_time)
 
     user = await db.get_user(username=username)
     if user is None:
@@ -105,12 +123,10 @@ async def post_users(
 ):
     """Register a new user."""
 
-    existing_user = await dbmanager.get_user(username=username)
-    if existing_user is not None:
+    if await dbmanager.is_registered("username", username):
         raise PREEXISTING_USERNAME_ERROR
 
-    existing_user = await dbmanager.get_user(email=email)
-    if existing_user is not None:
+    if await dbmanager.is_registered("email", email):
         raise PREEXISTING_EMAIL_ERROR
 
     created_user = await dbmanager.create_user(
@@ -120,5 +136,26 @@ async def post_users(
         name,
         surname,
     )
+    if created_user is None:
+        raise PREEXISTING_USER_ERROR
 
     return created_user
+
+
+@authentication.get("/users/availability", response_model=Availability)
+async def get_users_availability(
+    username: Optional[str] = None,
+    email: Optional[str] = None,
+    dbmanager: DatabaseManager = Depends(get_database_manager),
+):
+    """Check if a username and/or an email are still free to register."""
+    if username is None and email is None:
+        raise MISSING_AVAILABILITY_QUERY_ERROR
+
+    availability = Availability()
+    if username is not None:
+        availability.username = not await dbmanager.is_registered("username", username)
+    if email is not None:
+        availability.email = not await dbmanager.is_registered("email", email)
+
+    return availability
@@ -3,6 +3,9 @@ Module for all used error objects / messages.
 """
 from fastapi import HTTPException, status
 
+# Named HTTP_413_REQUEST_ENTITY_TOO_LARGE before RFC 9110 (Starlette < 0.37)
+HTTP_413_CONTENT_TOO_LARGE = getattr(status, "HTTP_413_CONTENT_TOO_LARGE", 413)
+
 # This is not optimal but black and flake8 are having a
 # stubborness contest about line limit and how to split
 # strings into line that I can't spend more than 10 min
@@ -41,12 +44,39 @@ PREEXISTING_EMAIL_ERROR = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},
 )
 
+PREEXISTING_USER_ERROR = HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail="Username or email already exist in the server.",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+CONCURRENT_UPDATE_ERROR = HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail="The user was modified concurrently, retry the request.",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+MISSING_AVAILABILITY_QUERY_ERROR = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="Provide a username and/or an email to check.",
+)
+
 UNMODIFIABLE_TRAIT_ERROR = HTTPException(
     status_code=status.HTTP_405_METHOD_NOT_ALLOWED,
     detail="Only username or role attributes may be modified.",
     headers={"WWW-Authenticate": "Bearer"},
 )
 
+UPLOAD_TOO_LARGE_ERROR = HTTPException(
+    status_code=HTTP_413_CONTENT_TOO_LARGE,
+    detail="The uploaded file is larger than allowed.",
+)
+
+INVALID_IMAGE_ERROR = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="The uploaded file is not a supported image (JPEG or PNG).",
+)
+
 UNRECOGNIZED_CELEBRITY_ERROR = HTTPException(
     status_code=status.HTTP_403_FORBIDDEN,
     detail="Recognition of photo provided does match user name.",
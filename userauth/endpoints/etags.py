@@ -0,0 +1,72 @@
+"""
+Module with the helpers for conditional requests (ETag / If-None-Match).
+
+Entity tags are derived from cheap version information (the row version
+of a user, the number and latest time of the logins of a user), so that
+a matching If-None-Match can be answered with a 304 before loading and
+serializing the full resource.
+"""
+import hashlib
+from datetime import datetime
+from typing import List, Optional
+from uuid import UUID
+
+from fastapi import Response, status
+
+
+def weak_etag(*parts) -> str:
+    """Build an opaque weak entity tag from the given parts."""
+    digest = hashlib.blake2s("|".join(str(part) for part in parts).encode())
+    return f'W/"{digest.hexdigest()[:20]}"'
+
+
+def user_etag(user_uuid: UUID, version: Optional[int]) -> str:
+    """Entity tag of a user, which changes with every update of the row."""
+    return weak_etag("user", user_uuid, version or 0)
+
+
+def logins_etag(
+    user_uuid: UUID,
+    login_count: int,
+    last_login: Optional[datetime],
+) -> str:
+    """Entity tag of the login list of a user.
+
+    Login records are never modified, only added (or deleted all at once
+    with the user), so the count and the latest time identify the list.
+    """
+    last_login_str = None if last_login is None else last_login.isoformat()
+    return weak_etag("logins", user_uuid, login_count, last_login_str)
+
+
+def logins_list_etag(user_uuid: UUID, login_entries: List) -> str:
+    """Entity tag of an already loaded list of login entries."""
+    last_login = max((entry.ctime for entry in login_entries), default=None)
+    return logins_etag(user_uuid, len(login_entries), last_login)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against an entity tag.
+
+    The comparison is weak (as required for If-None-Match), and the
+    header can contain several tags or `*`.
+    """
+    if if_none_match is None:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    opaque_tag = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        if candidate.strip().removeprefix("W/") == opaque_tag:
+            return True
+    return False
+
+
+def not_modified(etag: str) -> Response:
+    """Empty 304 response for a resource that has not changed."""
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag},
+    )
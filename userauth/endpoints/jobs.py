@@ -0,0 +1,209 @@
+"""
+Module with the background runner of the asynchronous jobs.
+
+Jobs are stored in the database together with their input (for example,
+the uploaded photo) before the request is answered, so the request
+doesn't hold a connection or a database session while the job runs.
+A bounded number of workers run the jobs, each one with its own session.
+
+Every server process (and replica) runs its own runner over the same
+table of jobs, so a job is claimed before running it: a conditional
+update marks it as running in that process, with a lease, and only one
+process can succeed. Runners look for claimable jobs when they start and
+then periodically: pending jobs, and running ones whose lease expired
+(their process stopped or crashed without finishing them). The lease
+must be longer than the jobs take to run.
+"""
+import asyncio
+import logging
+import os
+import socket
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from uuid import UUID
+
+from fastapi import HTTPException, status
+
+from userauth.common.config import get_server_config
+from userauth.common.jobs import JobStatus
+from userauth.database import DatabaseManager, JobEntry, get_database_manager
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[JobEntry, DatabaseManager], Awaitable[Any]]
+
+
+class JobRunner:
+    """Queue of the stored jobs, run by a bounded pool of workers."""
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        manager_factory=None,
+        lease_seconds: Optional[float] = None,
+        owner: Optional[str] = None,
+    ):
+        """Initialize a stopped runner.
+
+        The number of workers and the lease left unset are the configured
+        ones (read when the runner starts). The manager factory returns an
+        async context manager providing a database manager (by default,
+        the one of the requests). The owner identifies the process in the
+        claimed jobs (by default, its host and process id).
+        """
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._manager_factory = manager_factory or asynccontextmanager(
+            get_database_manager
+        )
+        self._handlers: Dict[str, JobHandler] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[UUID] = set()
+        self._tasks: List[asyncio.Task] = []
+        self._start_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def is_running(self) -> bool:
+        return bool(self._tasks)
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        """Set the function running the jobs of a kind.
+
+        The function receives the job (with its input) and a database
+        manager, and returns the result of the job (JSON serializable).
+        HTTP exceptions make the job fail with their detail and status.
+        """
+        self._handlers[kind] = handler
+
+    async def start(self) -> None:
+        """Start the workers and queue the unfinished jobs (if not running)."""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+
+        async with self._start_lock:
+            if self.is_running:
+                return
+
+            server_config = get_server_config()
+            if self.workers is None:
+                self.workers = server_config.JOB_WORKERS
+            if self.lease_seconds is None:
+                self.lease_seconds = server_config.JOB_LEASE_SECONDS
+            self.workers = max(1, self.workers)
+
+            self._queue = asyncio.Queue()
+            self._queued.clear()
+            claimable_jobs = await self._enqueue_claimable()
+            if claimable_jobs:
+                logger.info("resuming %d unfinished jobs", claimable_jobs)
+
+            self._tasks = [
+                asyncio.create_task(self._work()) for _ in range(self.workers)
+            ]
+            self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self) -> None:
+        """Stop the workers, releasing the interrupted jobs to be run again."""
+        if not self.is_running:
+            return
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        try:
+            async with self._manager_factory() as dbmanager:
+                released_jobs = await dbmanager.release_jobs(self.owner)
+        except Exception:
+            # Left to be claimed again once their lease expires
+            logger.exception("could not release the interrupted jobs")
+        else:
+            if released_jobs:
+                logger.info("released %d interrupted jobs", released_jobs)
+
+    async def join(self) -> None:
+        """Wait until all the queued jobs are finished."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def _enqueue(self, job_uuid: UUID) -> None:
+        if job_uuid not in self._queued:
+            self._queued.add(job_uuid)
+            self._queue.put_nowait(job_uuid)
+
+    async def _enqueue_claimable(self) -> int:
+        """Queue the jobs that can be claimed, returning how many."""
+        async with self._manager_factory() as dbmanager:
+            claimable_jobs = await dbmanager.get_claimable_jobs()
+        for job_uuid in claimable_jobs:
+            self._enqueue(job_uuid)
+        return len(claimable_jobs)
+
+    async def _sweep(self) -> None:
+        """Queue the jobs left by other processes, once per lease."""
+        while True:
+            await asyncio.sleep(self.lease_seconds)
+            try:
+                await self._enqueue_claimable()
+            except Exception:
+                logger.exception("could not look for unfinished jobs")
+
+    async def submit(self, job_uuid: UUID) -> None:
+        """Queue a stored job (starting the runner if needed)."""
+        if not self.is_running:
+            await self.start()
+        self._enqueue(job_uuid)
+
+    async def _work(self) -> None:
+        while True:
+            job_uuid = await self._queue.get()
+            try:
+                await self._run(job_uuid)
+            except Exception:
+                logger.exception("could not run job %s", job_uuid)
+            finally:
+                self._queued.discard(job_uuid)
+                self._queue.task_done()
+
+    async def _run(self, job_uuid: UUID) -> None:
+        """Run a job and store its outcome."""
+        async with self._manager_factory() as dbmanager:
+            job = await dbmanager.claim_job(job_uuid, self.owner, self.lease_seconds)
+            if job is None:
+                # Finished, or being run by another process
+                return
+
+            handler = self._handlers.get(job.kind)
+            if handler is None:
+                await dbmanager.update_job(
+                    job,
+                    JobStatus.failed,
+                    error=f"Unknown job kind `{job.kind}`.",
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+                return
+
+            try:
+                result = await handler(job, dbmanager)
+            except HTTPException as exception:
+                await dbmanager.update_job(
+                    job,
+                    JobStatus.failed,
+                    error=exception.detail,
+                    status_code=exception.status_code,
+                )
+            except Exception:
+                logger.exception("job %s failed", job_uuid)
+                await dbmanager.update_job(
+                    job,
+                    JobStatus.failed,
+                    error="Internal error while running the job.",
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+            else:
+                await dbmanager.update_job(job, JobStatus.succeeded, result=result)
+
+
+JOB_RUNNER = JobRunner()
@@ -2,11 +2,32 @@
 Module with the definition for objects returned by the REST API.
 """
 from datetime import datetime
+from enum import Enum
+from typing import List, Optional
 
-from pydantic import UUID4, BaseModel, ConfigDict
+from pydantic import UUID4, BaseModel, ConfigDict, Field
 
+from userauth.common.jobs import JobStatus
 from userauth.common.roles import Role
-from userauth.database import LoginEntry, UserEntry
+from userauth.database import JobEntry, LoginEntry, UserEntry
+
+BATCH_GET_MAX_IDS = 100
+
+
+class UserSortKey(str, Enum):
+    ctime = "ctime"
+    ctime_desc = "-ctime"
+    username = "username"
+    username_desc = "-username"
+    name = "name"
+    name_desc = "-name"
+    surname = "surname"
+    surname_desc = "-surname"
+
+
+class LoginSortKey(str, Enum):
+    ctime = "ctime"
+    ctime_desc = "-ctime"
 
 
 class UserData(BaseModel):
@@ -26,9 +47,10 @@ class User(UserData):
     def from_dbentry(cls, user_entry: UserEntry) -> "User":
         """Constructor from a database user entry.
 
-        Necessary to explicitly construct the User.
+        Necessary to explicitly construct the User. The data was validated
+        when it was written, so the entry is trusted and not validated again.
         """
-        new_object = cls(
+        new_object = cls.model_construct(
             uuid=user_entry.uuid,
             role=user_entry.role,
             username=user_entry.username,
@@ -48,11 +70,64 @@ class LoginRecord(BaseModel):
     def from_dbentry(cls, database_entry: LoginEntry) -> "LoginRecord":
         """Constructor from a database login entry.
 
-        Necessary to explicitly construct the Login record.
+        Necessary to explicitly construct the Login record. The data was
+        validated when it was written, so it is not validated again.
         """
-        new_object = cls(
+        new_object = cls.model_construct(
             uuid=database_entry.uuid,
             user_uuid=database_entry.user,
             login_time=database_entry.ctime,
         )
         return new_object
+
+
+class Availability(BaseModel):
+    username: Optional[bool] = None
+    email: Optional[bool] = None
+
+
+class ModelInfo(BaseModel):
+    path: str
+    loaded_at: datetime
+
+
+class Job(BaseModel):
+    uuid: UUID4
+    kind: str
+    status: JobStatus
+    created: datetime
+    updated: Optional[datetime] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+
+    @classmethod
+    def from_dbentry(cls, job_entry: JobEntry) -> "Job":
+        """Constructor from a database job entry (trusted, not validated)."""
+        new_object = cls.model_construct(
+            uuid=job_entry.uuid,
+            kind=job_entry.kind,
+            status=job_entry.status,
+            created=job_entry.ctime,
+            updated=job_entry.mtime,
+            result=job_entry.result,
+            error=job_entry.error,
+            status_code=job_entry.status_code,
+        )
+        return new_object
+
+
+class BatchGetRequest(BaseModel):
+    ids: List[UUID4] = Field(min_length=1, max_length=BATCH_GET_MAX_IDS)
+
+
+class UserBatchItem(BaseModel):
+    id: UUID4
+    found: bool
+    user: Optional[User] = None
+
+
+class LoginBatchItem(BaseModel):
+    id: UUID4
+    found: bool
+    login: Optional[LoginRecord] = None
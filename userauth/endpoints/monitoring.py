@@ -0,0 +1,107 @@
+"""
+Module with the monitoring of the server.
+
+Every request is counted and timed by route (the path template, like
+`/users/{user_id}`, so that the number of series stays bounded). The
+workers write their metrics to a shared directory (see
+`userauth.common.metrics`), and the parent process of the server exports
+them, added up, at `/metrics` of a separate port (in the text format of
+Prometheus), so that they are not served with the public API.
+"""
+import asyncio
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram
+
+from userauth.common.metrics import render_prometheus
+from userauth.database import update_pool_metrics
+
+logger = logging.getLogger(__name__)
+
+HTTP_REQUESTS = Counter(
+    "userauth_http_requests_total",
+    "Requests served, by method, route and status code.",
+    labelnames=("method", "route", "status"),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "userauth_http_request_seconds",
+    "Time taken to serve the requests, by method and route.",
+    labelnames=("method", "route"),
+)
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware counting and timing the requests by route."""
+
+    def __init__(self, app):
+        """Wrap an ASGI application."""
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            # The router leaves the matched route in the scope
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUESTS.labels(
+                method=method, route=route, status=str(status_code)
+            ).inc()
+            HTTP_REQUEST_SECONDS.labels(method=method, route=route).observe(
+                time.perf_counter() - start_time
+            )
+
+
+async def sample_pool_periodically(period: float) -> None:
+    """Read the state of the database pool into the metrics every period."""
+    while True:
+        update_pool_metrics()
+        await asyncio.sleep(period)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Handler exporting the metrics of all the workers at `/metrics`."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_prometheus(self.server.metrics_dir).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be logged
+        pass
+
+
+def start_metrics_server(host: str, port: int, directory: str) -> ThreadingHTTPServer:
+    """Serve the metrics written to a directory, from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.metrics_dir = directory
+    thread = threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    )
+    thread.start()
+    logger.info("exporting the metrics at %s:%d/metrics", host, server.server_port)
+    return server
@@ -1,55 +1,100 @@
 """
 Endpoints for the API.
 """
-import base64
-from pathlib import Path
-from typing import Annotated, List
+import asyncio
+from datetime import datetime, timezone
+from typing import Annotated, List, Optional
 
-from fastapi import APIRouter, Depends, File
+from fastapi import APIRouter, Depends, File, Header, Query, Response, UploadFile
 from pydantic import UUID4
 
 from userauth.common.policies import PolicyEnforcer
 from userauth.common.roles import Role
-from userauth.database import DatabaseManager, get_database_manager
-from userauth.endpoints.models import LoginRecord, User
-from userauth.picmodel import CelebDetector
+from userauth.database import DatabaseManager, JobEntry, get_database_manager
+from userauth.endpoints.models import (
+    BatchGetRequest,
+    Job,
+    LoginBatchItem,
+    LoginRecord,
+    LoginSortKey,
+    ModelInfo,
+    User,
+    UserBatchItem,
+    UserSortKey,
+)
+from userauth.picmodel import (
+    INFERENCE_SCHEDULER,
+    PHOTO_RESULT_CACHE,
+    InferenceScheduler,
+    InvalidImage,
+    PhotoResultCache,
+    get_inference_scheduler,
+    get_photo_result_cache,
+    perceptual_hash,
+)
 
 from .auth import get_current_active_user
 from .errors import (
+    CONCURRENT_UPDATE_ERROR,
+    INVALID_IMAGE_ERROR,
     PREEXISTING_USERNAME_ERROR,
     UNAUTHORIZED_RESOURCE_ERROR,
     UNMODIFIABLE_TRAIT_ERROR,
     UNRECOGNIZED_CELEBRITY_ERROR,
 )
+from .etags import etag_matches, logins_etag, logins_list_etag, not_modified, user_etag
+from .jobs import JOB_RUNNER
+from .serialization import RowsResponse, login_row, user_row
+from .uploads import read_photo
 
 resources = APIRouter(tags=["Resources"])
 
 
+def naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Convert a datetime with an offset to naive UTC, as stored in `ctime`."""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
 ###############################################################################
 # ACTIVE USER SHORTCUTS
 ###############################################################################
 
 
 @resources.get("/users/me", response_model=User)
-async def get_users_me(active_user: User = Depends(get_current_active_user)):
+async def get_users_me(
+    response: Response,
+    if_none_match: Annotated[Optional[str], Header()] = None,
+    active_user: User = Depends(get_current_active_user),
+):
     """Get the active user."""
+    etag = user_etag(active_user.uuid, active_user.version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    response.headers["ETag"] = etag
     return active_user
 
 
 @resources.get("/users/me/logins", response_model=List[LoginRecord])
 async def get_users_me_logins(
+    if_none_match: Annotated[Optional[str], Header()] = None,
     active_user: User = Depends(get_current_active_user),
     dbmanager: DatabaseManager = Depends(get_database_manager),
 ):
     """Get the loggins for the active user."""
-    login_entries = await dbmanager.get_logins(user_uuid=active_user.uuid)
+    if if_none_match is not None:
+        login_count, last_login = await dbmanager.get_logins_version(active_user.uuid)
+        etag = logins_etag(active_user.uuid, login_count, last_login)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
 
-    logins_list = list()
-    for login_entry in login_entries:
-        login = LoginRecord.from_dbentry(login_entry)
-        logins_list.append(login)
-
-    return logins_list
+    login_entries = await dbmanager.get_logins(user_uuid=active_user.uuid)
+    return RowsResponse(
+        [login_row(login_entry) for login_entry in login_entries],
+        headers={"ETag": logins_list_etag(active_user.uuid, login_entries)},
+    )
 
 
 @resources.get("/users/me/logins/{login_id}", response_model=LoginRecord)
@@ -74,62 +119,143 @@ async def get_users_me_logins_id(
 
 @resources.get("/users", response_model=List[User])
 async def get_users(
+    role: Optional[Role] = None,
+    ctime_from: Optional[datetime] = None,
+    ctime_to: Optional[datetime] = None,
+    sort: Optional[UserSortKey] = None,
     active_user: User = Depends(get_current_active_user),
     dbmanager: DatabaseManager = Depends(get_database_manager),
 ):
-    """Get user by ID."""
+    """Get all users, optionally filtered by role and creation time."""
+    active_user_rights = PolicyEnforcer(active_user)
+    if not active_user_rights.can_see_all():
+        raise UNAUTHORIZED_RESOURCE_ERROR
+    all_users = await dbmanager.get_users(
+        role=role,
+        ctime_from=naive_utc(ctime_from),
+        ctime_to=naive_utc(ctime_to),
+        sort=None if sort is None else sort.value,
+    )
+    return RowsResponse([user_row(user_entry) for user_entry in all_users])
+
+
+@resources.get("/users/search", response_model=List[User])
+async def get_users_search(
+    q: Annotated[str, Query(min_length=1, max_length=100)],
+    fuzzy: bool = False,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    active_user: User = Depends(get_current_active_user),
+    dbmanager: DatabaseManager = Depends(get_database_manager),
+):
+    """Search users by the start of their username, name or surname.
+
+    With `fuzzy` enabled, users are ranked by similarity instead (which
+    tolerates typos but does not require a common prefix).
+    """
     active_user_rights = PolicyEnforcer(active_user)
     if not active_user_rights.can_see_all():
         raise UNAUTHORIZED_RESOURCE_ERROR
-    all_users = await dbmanager.get_users()
-    return all_users
+    found_users = await dbmanager.search_users(
+        q,
+        limit=limit,
+        offset=offset,
+        fuzzy=fuzzy,
+    )
+    return RowsResponse([user_row(user_entry) for user_entry in found_users])
+
+
+@resources.post("/users:batchGet", response_model=List[UserBatchItem])
+async def post_users_batch_get(
+    batch_request: BatchGetRequest,
+    active_user: User = Depends(get_current_active_user),
+    dbmanager: DatabaseManager = Depends(get_database_manager),
+):
+    """Get several users by ID in a single request.
+
+    Results come in the order of the request. Users that do not exist
+    or that can't be accessed are both reported as not found.
+    """
+    active_user_rights = PolicyEnforcer(active_user)
+    user_entries = await dbmanager.get_users(
+        uuids=batch_request.ids,
+        scope=active_user_rights.visible_users(),
+    )
+    users_by_id = {entry.uuid: User.from_dbentry(entry) for entry in user_entries}
+
+    batch_items = list()
+    for user_id in batch_request.ids:
+        requested_user = users_by_id.get(user_id)
+        if requested_user is None:
+            batch_items.append(UserBatchItem(id=user_id, found=False))
+        else:
+            batch_items.append(
+                UserBatchItem(id=user_id, found=True, user=requested_user)
+            )
+
+    return batch_items
 
 
 @resources.get("/users/{user_id}", response_model=User)
 async def get_users_id(
     user_id: UUID4,
+    response: Response,
+    if_none_match: Annotated[Optional[str], Header()] = None,
     active_user: User = Depends(get_current_active_user),
     dbmanager: DatabaseManager = Depends(get_database_manager),
 ):
     """Get user by ID."""
-
-    requested_user = await dbmanager.get_user(uuid=user_id)
-    if requested_user is None:
+    active_user_rights = PolicyEnforcer(active_user)
+    if not active_user_rights.can_see_user_data(user_id):
         raise UNAUTHORIZED_RESOURCE_ERROR
-    requested_user = User.from_dbentry(requested_user)
 
-    active_user_rights = PolicyEnforcer(active_user)
-    if not active_user_rights.can_see_object(requested_user):
+    if if_none_match is not None:
+        version = await dbmanager.get_user_version(user_id)
+        if version is not None:
+            etag = user_etag(user_id, version)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+
+    requested_entry = await dbmanager.get_user(uuid=user_id)
+    if requested_entry is None:
         raise UNAUTHORIZED_RESOURCE_ERROR
+    requested_user = User.from_dbentry(requested_entry)
 
+    response.headers["ETag"] = user_etag(user_id, requested_entry.version)
     return requested_user
 
 
 @resources.get("/users/{user_id}/logins", response_model=List[LoginRecord])
 async def get_users_id_logins(
     user_id: UUID4,
+    if_none_match: Annotated[Optional[str], Header()] = None,
     active_user: User = Depends(get_current_active_user),
     dbmanager: DatabaseManager = Depends(get_database_manager),
 ):
     """Get all login records for a given user."""
-
-    requested_user = await dbmanager.get_user(uuid=user_id)
-    if requested_user is None:
-        raise UNAUTHORIZED_RESOURCE_ERROR
-    requested_user = User.from_dbentry(requested_user)
-
     active_user_rights = PolicyEnforcer(active_user)
-    if not active_user_rights.can_see_object(requested_user):
+    if not active_user_rights.can_see_user_data(user_id):
         raise UNAUTHORIZED_RESOURCE_ERROR
 
-    login_entries = await dbmanager.get_logins(user_uuid=user_id)
-
-    logins_list = list()
-    for login_entry in login_entries:
-        login = LoginRecord.from_dbentry(login_entry)
-        logins_list.append(login)
+    # No logins can also mean that the user does not exist, so only
+    # non-empty lists are answered with a 304 before the full lookup
+    if if_none_match is not None:
+        login_count, last_login = await dbmanager.get_logins_version(user_id)
+        etag = logins_etag(user_id, login_count, last_login)
+        if login_count > 0 and etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+    login_entries = await dbmanager.get_user_logins(
+        user_id,
+        scope=active_user_rights.visible_users(),
+    )
+    if login_entries is None:
+        raise UNAUTHORIZED_RESOURCE_ERROR
 
-    return logins_list
+    return RowsResponse(
+        [login_row(login_entry) for login_entry in login_entries],
+        headers={"ETag": logins_list_etag(user_id, login_entries)},
+    )
 
 
 @resources.get(
@@ -143,23 +269,19 @@ async def get_users_id_logins_id(
     dbmanager: DatabaseManager = Depends(get_database_manager),
 ):
     """Get login record from a user by ID."""
-
-    requested_user = await dbmanager.get_user(uuid=user_id)
-    if requested_user is None:
-        raise UNAUTHORIZED_RESOURCE_ERROR
-    requested_user = User.from_dbentry(requested_user)
-
     active_user_rights = PolicyEnforcer(active_user)
-    if not active_user_rights.can_see_object(requested_user):
+    if not active_user_rights.can_see_user_data(user_id):
         raise UNAUTHORIZED_RESOURCE_ERROR
 
-    logins_list = await get_logins_id(
-        login_id=login_id,
-        active_user=active_user,
-        dbmanager=dbmanager,
+    requested_resource = await dbmanager.get_login(
+        uuid=login_id,
+        user_uuid=user_id,
+        scope=active_user_rights.visible_logins(),
     )
+    if requested_resource is None:
+        raise UNAUTHORIZED_RESOURCE_ERROR
 
-    return logins_list
+    return LoginRecord.from_dbentry(requested_resource)
 
 
 ###############################################################################
@@ -167,24 +289,37 @@ async def get_users_id_logins_id(
 ###############################################################################
 
 
-@resources.post("/users/{user_id}/validate_photo", response_model=User)
-async def post_users_id_validate(
-    file: Annotated[bytes, File()],
-    active_user: User = Depends(get_current_active_user),
-    dbmanager: DatabaseManager = Depends(get_database_manager),
-):
-    """Action endpoint to auto-validate celebrity users."""
-    encoded_img = base64.b64encode(file)
-    model_data_path = Path(__file__).parent.parent / "picmodel" / "celebs.h5"
-    celeb_detector = CelebDetector(model_data_path)
+VALIDATE_PHOTO_JOB = "validate_photo"
+
+
+async def validate_photo(
+    photo,
+    active_user: User,
+    dbmanager: DatabaseManager,
+    inference_scheduler: InferenceScheduler,
+    photo_cache: PhotoResultCache,
+) -> User:
+    """Promote the user to celebrity if the photo is recognized as them."""
+    try:
+        photo_hash = await asyncio.to_thread(perceptual_hash, photo)
+    except InvalidImage:
+        raise INVALID_IMAGE_ERROR
 
     # Correct usage:
-    #(celebrity_name, prob) = celeb_detector.predicta(encoded_img)
+    # (celebrity_name, prob) = await inference_scheduler.predict(photo)
 
     # Temporary patch that always accepts celebrity
     celebrity_name = f"{active_user.name} {active_user.surname}"
     prob = 0.96
-    (celebrity_name, prob) = celeb_detector.predicta(encoded_img, celebrity_name, prob)
+
+    prediction = photo_cache.get(active_user.uuid, photo_hash)
+    if prediction is None:
+        try:
+            prediction = await inference_scheduler.predict(photo, celebrity_name, prob)
+        except InvalidImage:
+            raise INVALID_IMAGE_ERROR
+        photo_cache.put(active_user.uuid, photo_hash, prediction)
+    (celebrity_name, prob) = prediction
 
     active_user_rights = PolicyEnforcer(active_user)
     if not active_user_rights.can_claim_celebrity(celebrity_name, prob):
@@ -194,9 +329,75 @@ async def post_users_id_validate(
         uuid=active_user.uuid,
         new_role=Role.celebrity,
     )
+    if updated_user is None:
+        raise CONCURRENT_UPDATE_ERROR
     return updated_user
 
 
+async def run_validate_photo_job(job: JobEntry, dbmanager: DatabaseManager) -> dict:
+    """Run a photo validation stored as an asynchronous job."""
+    user = await dbmanager.get_user(uuid=job.user)
+    if user is None:
+        raise UNAUTHORIZED_RESOURCE_ERROR
+
+    updated_user = await validate_photo(
+        job.payload,
+        user,
+        dbmanager,
+        INFERENCE_SCHEDULER,
+        PHOTO_RESULT_CACHE,
+    )
+    return User.from_dbentry(updated_user).model_dump(mode="json")
+
+
+JOB_RUNNER.register(VALIDATE_PHOTO_JOB, run_validate_photo_job)
+
+
+@resources.post(
+    "/users/{user_id}/validate_photo",
+    response_model=User,
+    responses={202: {"model": Job}},
+)
+async def post_users_id_validate(
+    file: Annotated[UploadFile, File()],
+    active_user: User = Depends(get_current_active_user),
+    dbmanager: DatabaseManager = Depends(get_database_manager),
+    inference_scheduler: InferenceScheduler = Depends(get_inference_scheduler),
+    photo_cache: PhotoResultCache = Depends(get_photo_result_cache),
+    prefer: Optional[str] = Header(default=None),
+):
+    """Action endpoint to auto-validate celebrity users.
+
+    The photo is predicted in a batch with the ones of other concurrent
+    requests, outside of the server process. Photos larger than the
+    configured limit, or that are not valid images, are rejected before
+    reaching the detector, and retries of a photo (or of a near-duplicate
+    of it) reuse the previous prediction.
+
+    With a `Prefer: respond-async` header, the photo is stored and the
+    validation runs in the background: the response is a 202 with the
+    job, whose status and result are available at `/jobs/{job_id}`.
+    """
+    photo = await read_photo(file)
+
+    if prefer is not None and "respond-async" in prefer:
+        job = await dbmanager.create_job(active_user.uuid, VALIDATE_PHOTO_JOB, photo)
+        await JOB_RUNNER.submit(job.uuid)
+        return RowsResponse(
+            Job.from_dbentry(job).model_dump(mode="json"),
+            status_code=202,
+            headers={"Location": f"/jobs/{job.uuid}"},
+        )
+
+    return await validate_photo(
+        photo,
+        active_user,
+        dbmanager,
+        inference_scheduler,
+        photo_cache,
+    )
+
+
 @resources.patch("/users/{user_id}", response_model=User)
 async def update_users_id(
     user_id: UUID4,
@@ -239,6 +440,8 @@ async def update_users_id(
         new_role=updated_user.role,
         new_username=updated_user.username,
     )
+    if updated_user is None:
+        raise CONCURRENT_UPDATE_ERROR
     updated_user = User.from_dbentry(updated_user)
     return updated_user
 
@@ -270,21 +473,58 @@ async def delete_users_id(
 
 @resources.get("/logins", response_model=List[LoginRecord])
 async def get_logins(
+    user: Optional[UUID4] = None,
+    ctime_from: Optional[datetime] = None,
+    ctime_to: Optional[datetime] = None,
+    sort: Optional[LoginSortKey] = None,
     active_user: User = Depends(get_current_active_user),
     dbmanager: DatabaseManager = Depends(get_database_manager),
 ):
-    """Get all login records from the database."""
+    """Get all login records, optionally filtered by user and login time."""
     active_user_rights = PolicyEnforcer(active_user)
     if not active_user_rights.can_see_all():
         raise UNAUTHORIZED_RESOURCE_ERROR
 
-    login_entries = await dbmanager.get_logins(user_uuid=None)
-    logins_list = list()
-    for login_entry in login_entries:
-        login = LoginRecord.from_dbentry(login_entry)
-        logins_list.append(login)
+    login_entries = await dbmanager.get_logins(
+        user_uuid=user,
+        ctime_from=naive_utc(ctime_from),
+        ctime_to=naive_utc(ctime_to),
+        sort=None if sort is None else sort.value,
+    )
+    return RowsResponse([login_row(login_entry) for login_entry in login_entries])
+
+
+@resources.post("/logins:batchGet", response_model=List[LoginBatchItem])
+async def post_logins_batch_get(
+    batch_request: BatchGetRequest,
+    active_user: User = Depends(get_current_active_user),
+    dbmanager: DatabaseManager = Depends(get_database_manager),
+):
+    """Get several login records by ID in a single request.
+
+    Results come in the order of the request. Records that do not exist
+    or that can't be accessed are both reported as not found.
+    """
+    active_user_rights = PolicyEnforcer(active_user)
+    login_entries = await dbmanager.get_logins(
+        uuids=batch_request.ids,
+        scope=active_user_rights.visible_logins(),
+    )
+    logins_by_id = {
+        entry.uuid: LoginRecord.from_dbentry(entry) for entry in login_entries
+    }
 
-    return logins_list
+    batch_items = list()
+    for login_id in batch_request.ids:
+        requested_login = logins_by_id.get(login_id)
+        if requested_login is None:
+            batch_items.append(LoginBatchItem(id=login_id, found=False))
+        else:
+            batch_items.append(
+                LoginBatchItem(id=login_id, found=True, login=requested_login)
+            )
+
+    return batch_items
 
 
 @resources.get("/logins/{login_id}", response_model=LoginRecord)
@@ -294,15 +534,60 @@ async def get_logins_id(
     dbmanager: DatabaseManager = Depends(get_database_manager),
 ):
     """Get a single login record by ID."""
-
-    requested_resource = await dbmanager.get_login(uuid=login_id)
+    active_user_rights = PolicyEnforcer(active_user)
+    requested_resource = await dbmanager.get_login(
+        uuid=login_id,
+        scope=active_user_rights.visible_logins(),
+    )
     if requested_resource is None:
         raise UNAUTHORIZED_RESOURCE_ERROR
 
-    requested_resource = LoginRecord.from_dbentry(requested_resource)
+    return LoginRecord.from_dbentry(requested_resource)
+
+
+###############################################################################
+# MODEL ENDPOINTS
+###############################################################################
+
 
+@resources.post("/models/celeb_detector:reload", response_model=ModelInfo)
+async def post_models_celeb_detector_reload(
+    active_user: User = Depends(get_current_active_user),
+):
+    """Reload the celebrity detector from its model file without a restart.
+
+    Requests keep being served by the previous model until the new one
+    is loaded and warmed up. The cached photo predictions are dropped.
+    Only the server process receiving the request reloads its model
+    (from the configured path, which can't be changed here), so with
+    several workers or replicas the others keep the previous one.
+    """
     active_user_rights = PolicyEnforcer(active_user)
-    if not active_user_rights.can_see_object(requested_resource):
+    if not active_user_rights.can_manage_models():
         raise UNAUTHORIZED_RESOURCE_ERROR
 
-    return requested_resource
+    await INFERENCE_SCHEDULER.reload()
+    PHOTO_RESULT_CACHE.clear()
+    return ModelInfo(
+        path=str(INFERENCE_SCHEDULER.model_path),
+        loaded_at=INFERENCE_SCHEDULER.loaded_at,
+    )
+
+
+###############################################################################
+# JOB ENDPOINTS
+###############################################################################
+
+
+@resources.get("/jobs/{job_id}", response_model=Job)
+async def get_jobs_id(
+    job_id: UUID4,
+    active_user: User = Depends(get_current_active_user),
+    dbmanager: DatabaseManager = Depends(get_database_manager),
+):
+    """Get the status (and the result, once finished) of a job."""
+    active_user_rights = PolicyEnforcer(active_user)
+    job = await dbmanager.get_job(job_id, scope=active_user_rights.visible_jobs())
+    if job is None:
+        raise UNAUTHORIZED_RESOURCE_ERROR
+    return Job.from_dbentry(job)
@@ -0,0 +1,81 @@
+"""
+Module with the fast serialization path for lists of database rows.
+
+Rows coming from the database were already validated when written, so
+the list endpoints skip the pydantic models altogether: each row is
+converted into a plain dict with the same fields as the response model
+and the whole list is encoded into JSON bytes at once. The `orjson`
+library is used when available (it natively encodes UUIDs, datetimes
+and enums), falling back to the standard library encoder otherwise.
+"""
+import json
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict
+from uuid import UUID
+
+from fastapi import Response
+
+from userauth.database import LoginEntry, UserEntry
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def user_row(user_entry: UserEntry) -> Dict[str, Any]:
+    """Plain dict with the fields of the `User` response model."""
+    return {
+        "username": user_entry.username,
+        "surname": user_entry.surname,
+        "name": user_entry.name,
+        "email": user_entry.email,
+        "uuid": user_entry.uuid,
+        "role": user_entry.role,
+    }
+
+
+def login_row(login_entry: LoginEntry) -> Dict[str, Any]:
+    """Plain dict with the fields of the `LoginRecord` response model."""
+    return {
+        "uuid": login_entry.uuid,
+        "user_uuid": login_entry.user,
+        "login_time": login_entry.ctime,
+    }
+
+
+def encode_default(value: Any) -> Any:
+    """Encode the types that the standard library json does not know."""
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json(content: Any) -> bytes:
+    """Encode the content into compact JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content,
+        default=encode_default,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class RowsResponse(Response):
+    """JSON response for content made of already trusted rows.
+
+    Returning it from an endpoint bypasses the validation against the
+    `response_model`, which is then only used for the documentation.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return encode_json(content)
@@ -0,0 +1,170 @@
+"""
+Module with the reading of uploaded files.
+
+Request bodies are counted as they are received, and the ones over the
+size limit are rejected before the server spools them: right away when
+their declared length is over it, or as soon as the limit is passed
+otherwise, without receiving the rest. Uploads are spooled by the server
+into a temporary file (in memory while small, on disk beyond that). They
+are read from there straight into a single buffer, chunk by chunk, so
+that the file is held only once in memory.
+"""
+import asyncio
+from typing import BinaryIO, Optional
+
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+
+from userauth.common.config import get_server_config
+from userauth.picmodel import ImageTooLarge, InvalidImage, check_image
+
+from .errors import INVALID_IMAGE_ERROR, UPLOAD_TOO_LARGE_ERROR
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Allowance for the form around the file (boundaries, headers and fields)
+UPLOAD_FORM_OVERHEAD = 16 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """The file is larger than the maximum allowed size."""
+
+
+class UploadLimitMiddleware:
+    """ASGI middleware rejecting request bodies over the upload limit.
+
+    The limit is the maximum upload size plus an allowance for the form
+    around the file. Bodies longer than that are answered with a 413
+    before the application reads them.
+    """
+
+    def __init__(self, app, max_bytes: Optional[int] = None):
+        """Wrap an ASGI application (by default, with the configured limit)."""
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def reject(self, scope, receive, send):
+        response = JSONResponse(
+            {"detail": UPLOAD_TOO_LARGE_ERROR.detail},
+            status_code=UPLOAD_TOO_LARGE_ERROR.status_code,
+            headers={"Connection": "close"},
+        )
+        await response(scope, receive, send)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = self.max_bytes
+        if max_bytes is None:
+            max_bytes = get_server_config().MAX_UPLOAD_BYTES
+        max_body = max_bytes + UPLOAD_FORM_OVERHEAD
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > max_body:
+            await self.reject(scope, receive, send)
+            return
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def receive_within_limit():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_body:
+                    # The application sees a disconnect and stops reading
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def send_unless_exceeded(message):
+            nonlocal response_started
+            if exceeded and not response_started:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_within_limit, send_unless_exceeded)
+        except Exception:
+            if not exceeded or response_started:
+                raise
+        if exceeded and not response_started:
+            await self.reject(scope, receive, send)
+
+
+def read_into_buffer(
+    file: BinaryIO,
+    max_bytes: int,
+    size_hint: Optional[int] = None,
+    chunk_size: int = UPLOAD_CHUNK_SIZE,
+) -> bytearray:
+    """Read a file into one buffer, failing once it passes the size limit.
+
+    With the size of the file as hint, the buffer is allocated once and
+    the chunks are read directly into it.
+    """
+    # One byte over the limit is enough to know that the file is too large
+    capacity = max_bytes + 1
+    buffer = bytearray(min(capacity, (size_hint or chunk_size) + 1))
+    total = 0
+    while True:
+        if total == len(buffer):
+            if total == capacity:
+                raise UploadTooLarge(f"file larger than {max_bytes} bytes")
+            buffer.extend(bytes(min(capacity, 2 * total + chunk_size) - total))
+
+        with memoryview(buffer) as view:
+            end = total + chunk_size
+            with view[total:end] as chunk:
+                read = file.readinto(chunk)
+        if not read:
+            break
+        total += read
+
+    del buffer[total:]
+    return buffer
+
+
+async def read_upload(
+    upload: UploadFile,
+    max_bytes: Optional[int] = None,
+) -> bytearray:
+    """Read an uploaded file into memory, enforcing the maximum size."""
+    if max_bytes is None:
+        max_bytes = get_server_config().MAX_UPLOAD_BYTES
+
+    if upload.size is not None and upload.size > max_bytes:
+        raise UPLOAD_TOO_LARGE_ERROR
+
+    await upload.seek(0)
+    try:
+        return await asyncio.to_thread(
+            read_into_buffer,
+            upload.file,
+            max_bytes,
+            upload.size,
+        )
+    except UploadTooLarge:
+        raise UPLOAD_TOO_LARGE_ERROR
+
+
+async def read_photo(upload: UploadFile) -> bytearray:
+    """Read an uploaded photo, rejecting it if it can't be preprocessed.
+
+    Only the header of the image is checked here (the decoding is left
+    to the inference workers).
+    """
+    photo = await read_upload(upload)
+    try:
+        check_image(photo)
+    except ImageTooLarge:
+        raise UPLOAD_TOO_LARGE_ERROR
+    except InvalidImage:
+        raise INVALID_IMAGE_ERROR
+    return photo
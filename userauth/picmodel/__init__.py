@@ -2,6 +2,36 @@
 Module containing the celebrity detection model.
 """
 
-from .celeb_detector import CelebDetector
+from .celeb_detector import CelebDetector, MissingEmbedder
+from .gallery import EmbeddingGallery
+from .photocache import (
+    PHOTO_RESULT_CACHE,
+    PhotoResultCache,
+    get_photo_result_cache,
+    perceptual_hash,
+)
+from .preprocessing import ImagePreprocessor, ImageTooLarge, InvalidImage, check_image
+from .registry import MODEL_REGISTRY, ModelRegistry, get_celeb_detector
+from .scheduler import INFERENCE_SCHEDULER, InferenceScheduler, get_inference_scheduler
+from .weights import MappedWeights
 
-__all__ = "CelebDetector"
+__all__ = (
+    "CelebDetector",
+    "EmbeddingGallery",
+    "INFERENCE_SCHEDULER",
+    "ImagePreprocessor",
+    "ImageTooLarge",
+    "InferenceScheduler",
+    "InvalidImage",
+    "MODEL_REGISTRY",
+    "MappedWeights",
+    "MissingEmbedder",
+    "ModelRegistry",
+    "PHOTO_RESULT_CACHE",
+    "PhotoResultCache",
+    "check_image",
+    "get_celeb_detector",
+    "get_inference_scheduler",
+    "get_photo_result_cache",
+    "perceptual_hash",
+)
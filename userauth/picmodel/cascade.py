@@ -0,0 +1,221 @@
+"""
+Module with the cascade of stages in front of the celebrity detector.
+
+Most of the submitted photos can't promote their user: they have no face
+at all, or the user claims a name that isn't in the gallery of known
+celebrities. Cheap stages estimate an upper bound of the probability
+the detector could give to each photo, and the photos whose bound can't
+reach the minimum probability of the celebrity policy are rejected
+before running the (expensive) detector on the rest.
+
+The name stage is exact, but the face stage is a heuristic: it lets the
+photos it can't check through (for example, black and white ones), yet
+it rejects color photos with hardly any skin tones, which can still show
+a face (under colored lighting or filters). So the cascade is opt-in
+(see `CELEB_CASCADE`).
+"""
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+from PIL import Image
+from prometheus_client import Counter, Histogram
+
+from userauth.common.roles import CELEBRITY_MIN_PROBABILITY
+
+from .celeb_detector import CelebDetector
+from .gallery import EmbeddingGallery
+from .preprocessing import InvalidImage, open_image
+
+# Prediction of the photos rejected by a stage (no celebrity recognized)
+REJECTED_PREDICTION = ("", 0.0)
+
+# Ranges of the skin tones in the chroma channels (YCbCr)
+SKIN_CB_RANGE = (77, 127)
+SKIN_CR_RANGE = (133, 173)
+
+CASCADE_STAGE_IMAGES = Counter(
+    "userauth_cascade_stage_images_total",
+    "Images reaching each stage of the detector cascade, by outcome "
+    "(passed to the next stage or rejected).",
+    labelnames=("stage", "outcome"),
+)
+CASCADE_STAGE_SECONDS = Histogram(
+    "userauth_cascade_stage_seconds",
+    "Time taken by each stage of the detector cascade on a batch.",
+    labelnames=("stage",),
+)
+
+UpperBound = Union[float, InvalidImage]
+
+
+@dataclass
+class StageStats:
+    """Outcome of a stage of the cascade on a batch."""
+
+    stage: str
+    images: int
+    passed: int
+    seconds: float
+
+
+def record_stage_stats(stats: Sequence[StageStats]) -> None:
+    """Add the outcomes of the stages on a batch to the metrics."""
+    for stage_stats in stats:
+        rejected = stage_stats.images - stage_stats.passed
+        stage = stage_stats.stage
+        CASCADE_STAGE_IMAGES.labels(stage=stage, outcome="passed").inc(
+            stage_stats.passed
+        )
+        CASCADE_STAGE_IMAGES.labels(stage=stage, outcome="rejected").inc(rejected)
+        CASCADE_STAGE_SECONDS.labels(stage=stage).observe(stage_stats.seconds)
+
+
+class NamePriorStage:
+    """Rejects the claims of names that aren't in the gallery."""
+
+    name = "name"
+
+    def __init__(self, gallery: Optional[EmbeddingGallery]):
+        """Initialize the stage (without a gallery, every name passes)."""
+        self.gallery = gallery
+
+    def upper_bounds(self, images, claimed_names) -> List[UpperBound]:
+        if self.gallery is None:
+            return [1.0] * len(images)
+        return [float(self.gallery.has_name(name)) for name in claimed_names]
+
+
+class FacePresenceStage:
+    """Rejects the photos without skin tones (which can't show a face).
+
+    The check runs on a small thumbnail, which JPEGs decode directly at a
+    fraction of the cost of the full image.
+    """
+
+    name = "face"
+
+    def __init__(self, min_skin_fraction: float = 0.01, size: int = 32):
+        """Initialize the stage with the fraction of skin pixels required."""
+        self.min_skin_fraction = min_skin_fraction
+        self.size = size
+
+    def skin_fraction(self, data) -> Optional[float]:
+        """Fraction of skin toned pixels (None for black and white images)."""
+        image = open_image(data)
+        try:
+            image.draft("YCbCr", (4 * self.size, 4 * self.size))
+            if image.mode in ("1", "L", "LA", "I", "I;16", "F"):
+                return None
+            if image.mode != "YCbCr":
+                image = image.convert("RGB").convert("YCbCr")
+            image = image.resize((self.size, self.size), Image.Resampling.BOX)
+        except (OSError, ValueError, Image.DecompressionBombError) as exception:
+            raise InvalidImage("the image can't be decoded") from exception
+
+        pixels = np.asarray(image, dtype=np.int16)
+        cb, cr = pixels[..., 1], pixels[..., 2]
+        if np.all(np.abs(cb - 128) < 4) and np.all(np.abs(cr - 128) < 4):
+            return None
+        skin = (
+            (cb >= SKIN_CB_RANGE[0])
+            & (cb <= SKIN_CB_RANGE[1])
+            & (cr >= SKIN_CR_RANGE[0])
+            & (cr <= SKIN_CR_RANGE[1])
+        )
+        return float(skin.mean())
+
+    def upper_bounds(self, images, claimed_names) -> List[UpperBound]:
+        bounds: List[UpperBound] = []
+        for data in images:
+            try:
+                fraction = self.skin_fraction(data)
+            except InvalidImage as exception:
+                bounds.append(exception)
+                continue
+            if fraction is None or fraction >= self.min_skin_fraction:
+                bounds.append(1.0)
+            else:
+                bounds.append(0.0)
+        return bounds
+
+
+class CascadedDetector:
+    """Celebrity detector running only on the photos the cheap stages pass.
+
+    It has the interface of the detector, so it can be loaded in its place.
+    """
+
+    def __init__(
+        self,
+        filepath: Path,
+        threshold: float = CELEBRITY_MIN_PROBABILITY,
+    ):
+        """Initialize the detector of the model and the stages in front of it."""
+        self.detector = CelebDetector(filepath)
+        self.threshold = threshold
+        # Cheapest first: the name lookup doesn't even decode the photo
+        self.stages = [NamePriorStage(self.detector.gallery), FacePresenceStage()]
+        self.last_stats: List[StageStats] = []
+
+    @property
+    def path_to_model(self) -> Path:
+        return self.detector.path_to_model
+
+    def predict(self, image, output_name, output_percent):
+        """Predict if the image (raw bytes or a buffer) is a celebrity."""
+        prediction = self.predict_batch([image], [output_name], [output_percent])[0]
+        if isinstance(prediction, Exception):
+            raise prediction
+        return prediction
+
+    def predict_batch(self, images, output_names, output_percents):
+        """Predict a batch, running each stage on the photos passing the previous.
+
+        The names are the ones claimed by the users (the only ones that can
+        promote them). The outcome of each stage is kept in `last_stats`.
+        """
+        predictions = [REJECTED_PREDICTION] * len(images)
+        pending = list(range(len(images)))
+        stats = []
+        for stage in self.stages:
+            if not pending:
+                break
+            start_time = time.perf_counter()
+            bounds = stage.upper_bounds(
+                [images[idx] for idx in pending],
+                [output_names[idx] for idx in pending],
+            )
+            passed = []
+            for idx, bound in zip(pending, bounds):
+                if isinstance(bound, Exception):
+                    predictions[idx] = bound
+                elif bound > self.threshold:
+                    passed.append(idx)
+            seconds = time.perf_counter() - start_time
+            stats.append(StageStats(stage.name, len(pending), len(passed), seconds))
+            pending = passed
+
+        if pending:
+            start_time = time.perf_counter()
+            detector_predictions = self.detector.predict_batch(
+                [images[idx] for idx in pending],
+                [output_names[idx] for idx in pending],
+                [output_percents[idx] for idx in pending],
+            )
+            accepted = 0
+            for idx, prediction in zip(pending, detector_predictions):
+                predictions[idx] = prediction
+                if not isinstance(prediction, Exception):
+                    accepted += int(prediction[1] > self.threshold)
+            seconds = time.perf_counter() - start_time
+            stats.append(StageStats("detector", len(pending), accepted, seconds))
+
+        self.last_stats = stats
+        return predictions
+
+    def warmup(self, iterations: int = 1):
+        """Warm up the detector (the stages have nothing to set up)."""
+        self.detector.warmup(iterations)
@@ -9,19 +9,129 @@ as indicated by the caller.
 
 If it becomes relevant, at some point I may implement my own model for
 image recognition here.
+
+Matching photos against a gallery needs their embeddings, which the
+placeholder can't compute: they come from a projection stored with the
+converted weights of the model (`embedding/kernel`, with one row per
+value of the preprocessed image and one column per dimension of the
+gallery). A gallery set for a model without it fails when the model is
+loaded, instead of on every prediction.
 """
 
 from pathlib import Path
 
+import numpy as np
+
+from .gallery import configured_gallery
+from .preprocessing import ImagePreprocessor, synthetic_image
+from .weights import MappedWeights, is_weights_dir
+
+# Weights projecting the preprocessed images into the gallery embeddings
+EMBEDDING_WEIGHTS = "embedding/kernel"
+# Rows of a quantized kernel converted to float32 at a time
+EMBEDDING_CHUNK_ROWS = 4096
+
+
+class MissingEmbedder(ValueError):
+    """The model can't compute the embeddings of the configured gallery."""
+
+
+def best_match(matches):
+    """Name and similarity of the closest celebrity (if there is any)."""
+    if not matches:
+        return ("", 0.0)
+    name, similarity = matches[0]
+    return (name, max(0.0, similarity))
+
 class CelebDetector:
     """A placeholder for the celebrity detector."""
 
     def __init__(self, filepath: Path):
-        """Initialize celebrity detector with the path to the ai-model."""
+        """Initialize celebrity detector with the path to the ai-model.
+
+        Weights converted with `userauth model convert` are memory-mapped
+        (and shared with the other processes mapping them).
+        """
         self.path_to_model = filepath
+        self.weights = MappedWeights(filepath) if is_weights_dir(filepath) else None
+        self.preprocessor = ImagePreprocessor()
+        self.gallery = configured_gallery()
+        if self.gallery is not None:
+            self.check_embedder(self.gallery.dimension)
+
+    @property
+    def can_embed(self) -> bool:
+        """Whether the model computes embeddings (to match a gallery)."""
+        return self.weights is not None and EMBEDDING_WEIGHTS in self.weights
+
+    def check_embedder(self, dimension: int) -> None:
+        """Fail unless the model computes embeddings of a dimension."""
+        if not self.can_embed:
+            raise MissingEmbedder(
+                f"model {self.path_to_model} has no `{EMBEDDING_WEIGHTS}` "
+                "weights to compute the embeddings the gallery is matched with"
+            )
+        features, embedding_dimension = self.weights[EMBEDDING_WEIGHTS].shape
+        input_features = self.preprocessor.size**2 * 3
+        if (features, embedding_dimension) != (input_features, dimension):
+            raise MissingEmbedder(
+                f"the embeddings of model {self.path_to_model} are "
+                f"{features}x{embedding_dimension}, but images have "
+                f"{input_features} values and the gallery {dimension} dimensions"
+            )
+
+    def embed(self, batch):
+        """Compute the embeddings of a preprocessed batch (one row per image).
+
+        Quantized kernels are multiplied as float32 a block of rows at a
+        time (and scaled per output column at the end), instead of being
+        dequantized whole on every batch.
+        """
+        flat = batch.reshape(len(batch), -1)
+        kernel = self.weights[EMBEDDING_WEIGHTS]
+        scale = self.weights.scale(EMBEDDING_WEIGHTS)
+        if scale is None:
+            return flat @ kernel
+
+        embeddings = np.zeros((len(flat), kernel.shape[1]), dtype=np.float32)
+        for start in range(0, len(kernel), EMBEDDING_CHUNK_ROWS):
+            end = start + EMBEDDING_CHUNK_ROWS
+            embeddings += flat[:, start:end] @ kernel[start:end].astype(np.float32)
+        return embeddings * scale
+
+    def predict(self, image, output_name, output_percent):
+        """Predict if the image (raw bytes or a buffer) is a celebrity."""
+        prediction = self.predict_batch([image], [output_name], [output_percent])[0]
+        if isinstance(prediction, Exception):
+            raise prediction
+        return prediction
 
-    def predict(self, base64_image, output_name, output_percent):
-        """Predict if the image corresponds to a celebrity."""
-        return (output_name, force_percent)
+    def predict_batch(self, images, output_names, output_percents):
+        """Predict a batch of images in one pass.
 
+        With a gallery, the prediction is the closest celebrity to the
+        embedding of each image (and its cosine similarity). Images that
+        can't be preprocessed get their error (an InvalidImage) instead.
+        """
+        batch, errors = self.preprocessor.preprocess_batch(images)
+        try:
+            if self.gallery is None:
+                # Placeholder: the names and percentages given by the caller
+                predictions = list(zip(output_names, output_percents))
+            else:
+                matches = iter(self.gallery.search(self.embed(batch), k=1))
+                predictions = [
+                    None if idx in errors else best_match(next(matches))
+                    for idx in range(len(images))
+                ]
+            return [
+                errors.get(idx, prediction) for idx, prediction in enumerate(predictions)
+            ]
+        finally:
+            self.preprocessor.release(batch)
 
+    def warmup(self, iterations: int = 1):
+        """Run some inferences so that requests don't pay for lazy setups."""
+        image = synthetic_image()
+        for _ in range(iterations):
+            self.predict(image, "", 0.0)
@@ -0,0 +1,384 @@
+"""
+Module with the gallery of known celebrity embeddings.
+
+The gallery is a directory with a float32 matrix of L2-normalized
+embeddings (one row per photo of a celebrity) and the table of their
+names. The matrix is memory-mapped, so opening a gallery costs nothing
+whatever its size, the pages are shared by all the worker processes and
+only the rows visited by the searches are read.
+
+Searches return the top-k rows by cosine similarity (a dot product, as
+the rows are normalized), computed as one matrix product per chunk of
+rows for the whole batch of queries. Galleries with millions of rows
+can be given an IVF index: the rows are partitioned around centroids
+and the searches only visit the partitions closest to each query. Rows
+appended after the index was built are searched exhaustively until the
+index is rebuilt.
+
+The names are also indexed by a 64-bit hash (sorted, without repeats),
+so checking whether a celebrity is in the gallery is a binary search on
+a memory map instead of a scan of the names. A collision can only make
+a missing name pass for one in the gallery.
+
+Files of a gallery:
+
+    gallery.json         dimension, number of rows and IVF parameters
+    embeddings.f32       rows x dimension embeddings
+    names.bin            UTF-8 names, concatenated
+    name_offsets.i64     rows + 1 offsets of the names in names.bin
+    name_hashes.u64      sorted hashes of the distinct names
+    ivf_centroids.f32    lists x dimension centroids (IVF only)
+    ivf_rows.i64         indexed rows, sorted by list (IVF only)
+    ivf_offsets.i64      lists + 1 offsets of the lists in ivf_rows.i64
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from userauth.common.config import get_server_config
+
+METADATA_FILE = "gallery.json"
+EMBEDDINGS_FILE = "embeddings.f32"
+NAMES_FILE = "names.bin"
+NAME_OFFSETS_FILE = "name_offsets.i64"
+NAME_HASHES_FILE = "name_hashes.u64"
+CENTROIDS_FILE = "ivf_centroids.f32"
+IVF_ROWS_FILE = "ivf_rows.i64"
+IVF_OFFSETS_FILE = "ivf_offsets.i64"
+
+# Rows scored per matrix product (bounds the memory of the score matrix)
+CHUNK_ROWS = 65536
+
+# Size from which an IVF index pays off over the exhaustive search
+IVF_MIN_ROWS = 1_000_000
+
+Match = Tuple[str, float]
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize the rows of a matrix (as contiguous float32)."""
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2, order="C")
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.maximum(norms, np.finfo(np.float32).tiny, out=norms)
+    vectors /= norms
+    return vectors
+
+
+def merge_top_k(
+    scores: np.ndarray,
+    rows: np.ndarray,
+    k: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k best scores (and their rows) of each query, sorted."""
+    if scores.shape[1] > k:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, best, axis=1)
+        rows = np.take_along_axis(rows, best, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    return (
+        np.take_along_axis(scores, order, axis=1),
+        np.take_along_axis(rows, order, axis=1),
+    )
+
+
+def name_hash(name: str) -> int:
+    """Hash of a name in the name index (the same in every process)."""
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def name_hashes(names: Sequence[str]) -> np.ndarray:
+    """Sorted hashes of the distinct names."""
+    return np.unique(np.fromiter(map(name_hash, names), np.uint64, len(names)))
+
+
+def _write_atomically(path: Path, content: Union[str, bytes]) -> None:
+    temporary_path = path.with_suffix(path.suffix + ".tmp")
+    if isinstance(content, bytes):
+        temporary_path.write_bytes(content)
+    else:
+        temporary_path.write_text(content)
+    os.replace(temporary_path, path)
+
+
+class EmbeddingGallery:
+    """Memory-mapped gallery of celebrity embeddings, searchable by cosine."""
+
+    def __init__(self, path: Union[str, Path]):
+        """Open an existing gallery (see `create` for new ones)."""
+        self.path = Path(path)
+        metadata = json.loads((self.path / METADATA_FILE).read_text())
+        self.dimension: int = metadata["dimension"]
+        self.count: int = metadata["count"]
+        self.ivf_lists: int = metadata.get("ivf_lists", 0)
+        self.indexed_count: int = metadata.get("indexed_count", 0)
+
+        self._embeddings = self._map(EMBEDDINGS_FILE, np.float32, self.dimension)
+        self._names = self._map(NAMES_FILE, np.uint8)
+        self._name_offsets = self._map(NAME_OFFSETS_FILE, np.int64)
+        if (self.path / NAME_HASHES_FILE).exists():
+            self._name_hashes = self._map(NAME_HASHES_FILE, np.uint64)
+        else:
+            # Galleries created before the name index: hashed when opened
+            names = [self.name(row) for row in range(self.count)]
+            self._name_hashes = name_hashes(names)
+        if self.ivf_lists:
+            self._centroids = self._map(CENTROIDS_FILE, np.float32, self.dimension)
+            self._ivf_rows = self._map(IVF_ROWS_FILE, np.int64)
+            self._ivf_offsets = self._map(IVF_OFFSETS_FILE, np.int64)
+
+    def _map(self, filename: str, dtype, dimension: Optional[int] = None):
+        """Read-only memory map of a file of the gallery."""
+        file_path = self.path / filename
+        item_size = np.dtype(dtype).itemsize * (dimension or 1)
+        rows = file_path.stat().st_size // item_size
+        if rows == 0:
+            # Empty files can't be mapped
+            shape = (0,) if dimension is None else (0, dimension)
+            return np.empty(shape, dtype=dtype)
+        shape = (rows,) if dimension is None else (rows, dimension)
+        return np.memmap(file_path, dtype=dtype, mode="r", shape=shape)
+
+    @classmethod
+    def create(cls, path: Union[str, Path], dimension: int) -> "EmbeddingGallery":
+        """Create an empty gallery for embeddings of the given dimension."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        if (path / METADATA_FILE).exists():
+            raise FileExistsError(f"there is already a gallery in {path}")
+
+        for filename in (EMBEDDINGS_FILE, NAMES_FILE, NAME_HASHES_FILE):
+            (path / filename).write_bytes(b"")
+        (path / NAME_OFFSETS_FILE).write_bytes(np.zeros(1, np.int64).tobytes())
+        metadata = {"dimension": dimension, "count": 0}
+        _write_atomically(path / METADATA_FILE, json.dumps(metadata))
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def name(self, row: int) -> str:
+        """Name of the celebrity of a row."""
+        start, end = self._name_offsets[row], self._name_offsets[row + 1]
+        return bytes(self._names[start:end]).decode()
+
+    def has_name(self, name: str) -> bool:
+        """Whether the celebrity has any row in the gallery."""
+        hashed = np.uint64(name_hash(name))
+        position = int(np.searchsorted(self._name_hashes, hashed))
+        if position == len(self._name_hashes):
+            return False
+        return bool(self._name_hashes[position] == hashed)
+
+    def append(self, embeddings: np.ndarray, names: Sequence[str]) -> None:
+        """Add rows to the gallery (normalizing the embeddings).
+
+        The rows are visible to the searches of this object at once, and
+        to the other processes once they open the gallery again.
+        """
+        embeddings = normalize_rows(embeddings)
+        if embeddings.shape[1] != self.dimension:
+            raise ValueError(f"embeddings must have dimension {self.dimension}")
+        if len(embeddings) != len(names):
+            raise ValueError("there must be one name per embedding")
+
+        encoded_names = [name.encode() for name in names]
+        name_lengths = np.array([len(name) for name in encoded_names], np.int64)
+        names_end = int(self._name_offsets[self.count])
+        name_offsets = names_end + np.cumsum(name_lengths)
+
+        # Drop what an interrupted append may have left beyond the count
+        self._embeddings = self._names = self._name_offsets = None
+        os.truncate(self.path / EMBEDDINGS_FILE, self.count * self.dimension * 4)
+        os.truncate(self.path / NAMES_FILE, names_end)
+        os.truncate(self.path / NAME_OFFSETS_FILE, (self.count + 1) * 8)
+
+        with open(self.path / EMBEDDINGS_FILE, "ab") as embeddings_file:
+            embeddings_file.write(embeddings.tobytes())
+        with open(self.path / NAMES_FILE, "ab") as names_file:
+            names_file.write(b"".join(encoded_names))
+        with open(self.path / NAME_OFFSETS_FILE, "ab") as offsets_file:
+            offsets_file.write(name_offsets.tobytes())
+        # Names of rows beyond the count would only pass the name checks
+        hashes = np.union1d(self._name_hashes, name_hashes(names))
+        _write_atomically(self.path / NAME_HASHES_FILE, hashes.tobytes())
+
+        # The metadata goes last: rows beyond the count are ignored
+        self.count += len(embeddings)
+        self._write_metadata()
+        self._name_hashes = self._map(NAME_HASHES_FILE, np.uint64)
+        self._embeddings = self._map(EMBEDDINGS_FILE, np.float32, self.dimension)
+        self._names = self._map(NAMES_FILE, np.uint8)
+        self._name_offsets = self._map(NAME_OFFSETS_FILE, np.int64)
+
+    def _write_metadata(self) -> None:
+        metadata = {"dimension": self.dimension, "count": self.count}
+        if self.ivf_lists:
+            metadata["ivf_lists"] = self.ivf_lists
+            metadata["indexed_count"] = self.indexed_count
+        _write_atomically(self.path / METADATA_FILE, json.dumps(metadata))
+
+    def _nearest_centroids(self, centroids: np.ndarray) -> np.ndarray:
+        """List of each row (the centroid with the highest similarity)."""
+        assignments = np.empty(self.count, dtype=np.int64)
+        for start in range(0, self.count, CHUNK_ROWS):
+            block = self._embeddings[start : start + CHUNK_ROWS]
+            assignments[start : start + len(block)] = np.argmax(
+                block @ centroids.T, axis=1
+            )
+        return assignments
+
+    def build_index(
+        self,
+        lists: int,
+        iterations: int = 10,
+        sample_size: int = 256,
+        seed: int = 0,
+    ) -> None:
+        """Partition the rows in lists with spherical k-means (IVF index).
+
+        The centroids are trained on a sample of `sample_size` rows per list.
+        """
+        if not 0 < lists <= self.count:
+            raise ValueError("the number of lists must be in [1, rows]")
+
+        generator = np.random.default_rng(seed)
+        sample_rows = min(self.count, lists * sample_size)
+        sample = self._embeddings[
+            np.sort(generator.choice(self.count, sample_rows, replace=False))
+        ]
+        centroids = sample[generator.choice(sample_rows, lists, replace=False)]
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            # Lists left empty keep their previous centroid
+            empty_lists = np.bincount(assignments, minlength=lists) == 0
+            sums[empty_lists] = centroids[empty_lists]
+            centroids = normalize_rows(sums)
+
+        assignments = self._nearest_centroids(centroids)
+        ivf_rows = np.argsort(assignments, kind="stable")
+        ivf_offsets = np.zeros(lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=lists), out=ivf_offsets[1:])
+
+        (self.path / CENTROIDS_FILE).write_bytes(centroids.tobytes())
+        (self.path / IVF_ROWS_FILE).write_bytes(ivf_rows.tobytes())
+        (self.path / IVF_OFFSETS_FILE).write_bytes(ivf_offsets.tobytes())
+        self.ivf_lists = lists
+        self.indexed_count = self.count
+        self._write_metadata()
+
+        self._centroids = self._map(CENTROIDS_FILE, np.float32, self.dimension)
+        self._ivf_rows = self._map(IVF_ROWS_FILE, np.int64)
+        self._ivf_offsets = self._map(IVF_OFFSETS_FILE, np.int64)
+
+    def _search_rows(
+        self,
+        queries: np.ndarray,
+        start: int,
+        end: int,
+        k: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Exhaustive top-k over a range of rows, chunk by chunk."""
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for chunk_start in range(start, end, CHUNK_ROWS):
+            block = self._embeddings[chunk_start : min(end, chunk_start + CHUNK_ROWS)]
+            scores = queries @ block.T
+            rows = np.broadcast_to(
+                np.arange(chunk_start, chunk_start + len(block)),
+                scores.shape,
+            )
+            best_scores, best_rows = merge_top_k(
+                np.concatenate([best_scores, scores], axis=1),
+                np.concatenate([best_rows, rows], axis=1),
+                k,
+            )
+        return best_scores, best_rows
+
+    def _search_index(
+        self,
+        queries: np.ndarray,
+        k: int,
+        probes: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k over the indexed rows, visiting the closest lists only."""
+        probes = min(probes, self.ivf_lists)
+        list_scores = queries @ self._centroids.T
+        probed_lists = np.argpartition(-list_scores, probes - 1, axis=1)[:, :probes]
+
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for idx, query in enumerate(queries):
+            candidates = np.concatenate(
+                [
+                    self._ivf_rows[
+                        self._ivf_offsets[list_idx] : self._ivf_offsets[list_idx + 1]
+                    ]
+                    for list_idx in probed_lists[idx]
+                ]
+            )
+            if len(candidates) == 0:
+                continue
+            # Sorted rows make the gather from the memory map sequential
+            candidates.sort()
+            scores = self._embeddings[candidates] @ query
+            query_scores, query_rows = merge_top_k(
+                scores[np.newaxis],
+                candidates[np.newaxis],
+                k,
+            )
+            found = query_scores.shape[1]
+            best_scores[idx, :found] = query_scores[0]
+            best_rows[idx, :found] = query_rows[0]
+        return best_scores, best_rows
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 1,
+        probes: int = 8,
+    ) -> List[List[Match]]:
+        """Top-k (name, cosine similarity) of each query embedding.
+
+        With an IVF index, `probes` lists are visited per query (more
+        probes trade speed for recall).
+        """
+        queries = normalize_rows(queries)
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f"queries must have dimension {self.dimension}")
+
+        if self.ivf_lists:
+            index_scores, index_rows = self._search_index(queries, k, probes)
+            tail_scores, tail_rows = self._search_rows(
+                queries, self.indexed_count, self.count, k
+            )
+            scores, rows = merge_top_k(
+                np.concatenate([index_scores, tail_scores], axis=1),
+                np.concatenate([index_rows, tail_rows], axis=1),
+                k,
+            )
+        else:
+            scores, rows = self._search_rows(queries, 0, self.count, k)
+
+        return [
+            [
+                (self.name(row), float(score))
+                for score, row in zip(query_scores, query_rows)
+                if row >= 0
+            ]
+            for query_scores, query_rows in zip(scores, rows)
+        ]
+
+
+def configured_gallery() -> Optional[EmbeddingGallery]:
+    """Gallery set in the server configuration (None if there is none)."""
+    gallery_path = get_server_config().CELEB_GALLERY_PATH
+    if gallery_path is None:
+        return None
+    return EmbeddingGallery(gallery_path)
@@ -0,0 +1,171 @@
+"""
+Module with the cache of the predictions of submitted photos.
+
+When a promotion fails, users tend to retry with the same photo (or the
+same one re-encoded, resized or slightly edited). Photos are identified
+by a perceptual hash (dHash) of the decoded image, which barely changes
+with those edits, and the predictions are cached per user and hash.
+Photos whose hash is within a small Hamming distance of a cached one
+reuse its prediction instead of running the model again.
+
+Entries expire after a TTL and the least recently used ones are evicted
+beyond a maximum number of entries. The cache is cleared when the model
+is reloaded, since its predictions may change.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+from PIL import Image, ImageOps
+from prometheus_client import Counter
+
+from userauth.common.config import get_server_config
+
+from .preprocessing import InvalidImage, open_image
+
+HASH_SIZE = 8
+
+Prediction = Tuple[str, float]
+CacheKey = Tuple[UUID, int]
+
+PHOTO_CACHE_LOOKUPS = Counter(
+    "userauth_photo_cache_lookups_total",
+    "Lookups of photo predictions in the cache, by outcome: hit (same "
+    "hash), near hit (similar hash) or miss.",
+    labelnames=("outcome",),
+)
+
+
+def perceptual_hash(data, hash_size: int = HASH_SIZE) -> int:
+    """Difference hash (dHash) of an encoded image, as an integer.
+
+    The image is reduced to a grayscale grid of (hash_size + 1) x hash_size
+    and each bit tells whether a pixel is brighter than its right neighbour.
+    """
+    image = open_image(data)
+    try:
+        # The hash only needs a thumbnail, so JPEGs are decoded scaled down
+        image.draft("L", (8 * hash_size, 8 * hash_size))
+        image = ImageOps.exif_transpose(image).convert("L")
+        image = image.resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    except (OSError, ValueError, Image.DecompressionBombError) as exception:
+        raise InvalidImage("the image can't be decoded") from exception
+
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(first_hash: int, second_hash: int) -> int:
+    return bin(first_hash ^ second_hash).count("1")
+
+
+class PhotoResultCache:
+    """LRU cache with expiration of the predictions, by user and photo hash."""
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        max_distance: Optional[int] = None,
+    ):
+        """Initialize an empty cache.
+
+        Photos with hashes up to `max_distance` bits away from a cached one
+        are taken as the same photo (0 only reuses identical hashes). The
+        settings left unset are the configured ones (read on first use).
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._entries: OrderedDict = OrderedDict()
+        # Hashes cached for each user, for the near-duplicate lookups
+        self._user_hashes: Dict[UUID, set] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _configure(self) -> None:
+        if None not in (self.max_entries, self.ttl, self.max_distance):
+            return
+        server_config = get_server_config()
+        if self.max_entries is None:
+            self.max_entries = server_config.PHOTO_CACHE_MAX_ENTRIES
+        if self.ttl is None:
+            self.ttl = server_config.PHOTO_CACHE_TTL_SECONDS
+        if self.max_distance is None:
+            self.max_distance = server_config.PHOTO_CACHE_MAX_DISTANCE
+
+    def _remove(self, key: CacheKey) -> None:
+        del self._entries[key]
+        user_uuid, photo_hash = key
+        user_hashes = self._user_hashes[user_uuid]
+        user_hashes.discard(photo_hash)
+        if not user_hashes:
+            del self._user_hashes[user_uuid]
+
+    def _lookup(self, key: CacheKey) -> Optional[Prediction]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        prediction, expiration = entry
+        if expiration < time.monotonic():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return prediction
+
+    def get(self, user_uuid: UUID, photo_hash: int) -> Optional[Prediction]:
+        """Cached prediction of the photo (or of a near-duplicate), if any."""
+        self._configure()
+        prediction = self._lookup((user_uuid, photo_hash))
+        if prediction is not None:
+            PHOTO_CACHE_LOOKUPS.labels(outcome="hit").inc()
+            return prediction
+
+        if self.max_distance > 0:
+            # Users only have a handful of photos cached, so a scan is enough
+            near_hashes = sorted(
+                (hamming_distance(photo_hash, cached_hash), cached_hash)
+                for cached_hash in self._user_hashes.get(user_uuid, ())
+            )
+            for distance, cached_hash in near_hashes:
+                if distance > self.max_distance:
+                    break
+                prediction = self._lookup((user_uuid, cached_hash))
+                if prediction is not None:
+                    PHOTO_CACHE_LOOKUPS.labels(outcome="near_hit").inc()
+                    return prediction
+
+        PHOTO_CACHE_LOOKUPS.labels(outcome="miss").inc()
+        return None
+
+    def put(self, user_uuid: UUID, photo_hash: int, prediction: Prediction) -> None:
+        """Cache the prediction of a photo."""
+        self._configure()
+        if self.max_entries <= 0:
+            return
+
+        key = (user_uuid, photo_hash)
+        self._entries[key] = (prediction, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        self._user_hashes.setdefault(user_uuid, set()).add(photo_hash)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Drop all the entries (for example, after a model reload)."""
+        self._entries.clear()
+        self._user_hashes.clear()
+
+
+PHOTO_RESULT_CACHE = PhotoResultCache()
+
+
+async def get_photo_result_cache() -> PhotoResultCache:
+    """Dependency providing the shared cache of photo predictions."""
+    return PHOTO_RESULT_CACHE
@@ -0,0 +1,212 @@
+"""
+Module with the preprocessing of the images for the detector.
+
+Photos are decoded (JPEG or PNG), oriented according to their EXIF tags,
+center-cropped to a square, resized to the input size of the model and
+normalized into a contiguous float32 batch (NHWC, RGB).
+
+The normalization runs once per batch, vectorized over all the images,
+and the batch arrays come from a pool so that they are allocated once
+per worker instead of once per image. Images that can't be decoded, or
+whose size is unreasonable, are rejected from their header alone, before
+any decoding or model work.
+"""
+import io
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+INPUT_SIZE = 224
+SUPPORTED_FORMATS = ("JPEG", "PNG")
+MAX_IMAGE_PIXELS = 40_000_000
+
+# Per channel (RGB) statistics of the images the models are trained on
+CHANNEL_MEAN = (0.485, 0.456, 0.406)
+CHANNEL_STD = (0.229, 0.224, 0.225)
+
+
+class InvalidImage(ValueError):
+    """The image can't be decoded or is not a supported format."""
+
+
+class ImageTooLarge(InvalidImage):
+    """The image has more pixels than the maximum allowed."""
+
+
+class BufferFile(io.RawIOBase):
+    """Read-only file over a buffer, which (unlike BytesIO) doesn't copy it."""
+
+    def __init__(self, data):
+        """Initialize the file at the start of the buffer."""
+        self._view = memoryview(data).cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        start = min(self._position, len(self._view))
+        count = min(len(buffer), len(self._view) - start)
+        buffer[:count] = self._view[start : start + count]
+        self._position = start + count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def open_image(data, max_pixels: int = MAX_IMAGE_PIXELS) -> Image.Image:
+    """Open an image checking its header only (the pixels aren't decoded)."""
+    try:
+        image = Image.open(BufferFile(data), formats=SUPPORTED_FORMATS)
+    except (UnidentifiedImageError, OSError, ValueError) as exception:
+        raise InvalidImage("not a supported image") from exception
+
+    width, height = image.size
+    if width < 1 or height < 1:
+        raise InvalidImage("image without pixels")
+    if width * height > max_pixels:
+        raise ImageTooLarge(f"image with more than {max_pixels} pixels")
+    return image
+
+
+def check_image(data, max_pixels: int = MAX_IMAGE_PIXELS) -> None:
+    """Reject the images that can't be preprocessed (from their header)."""
+    open_image(data, max_pixels).close()
+
+
+def synthetic_image(width: int = 640, height: int = 480, seed: int = 0) -> bytes:
+    """A random JPEG image (for warm-ups and benchmarks)."""
+    generator = np.random.default_rng(seed)
+    pixels = generator.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+class BufferPool:
+    """Pool of reusable arrays of a given item shape and type.
+
+    Arrays are handed out with room for at least the requested number of
+    items (sizes are rounded up to powers of two so that they can be
+    reused by batches of similar size).
+    """
+
+    def __init__(self, item_shape: Tuple[int, ...], dtype, max_buffers: int = 4):
+        """Initialize an empty pool."""
+        self.item_shape = tuple(item_shape)
+        self.dtype = np.dtype(dtype)
+        self.max_buffers = max_buffers
+        self.allocations = 0
+        self._free: List[np.ndarray] = []
+        self._lock = threading.Lock()
+
+    def acquire(self, count: int) -> np.ndarray:
+        """Get an array with room for (at least) the given number of items."""
+        with self._lock:
+            for idx, buffer in enumerate(self._free):
+                if len(buffer) >= count:
+                    return self._free.pop(idx)
+
+        self.allocations += 1
+        capacity = 1 << max(0, count - 1).bit_length()
+        return np.empty((capacity,) + self.item_shape, dtype=self.dtype)
+
+    def release(self, buffer: np.ndarray) -> None:
+        """Return an array to the pool (once it's no longer used)."""
+        while buffer.base is not None:
+            buffer = buffer.base
+        with self._lock:
+            if len(self._free) < self.max_buffers:
+                self._free.append(buffer)
+
+
+class ImagePreprocessor:
+    """Turns encoded images into normalized batches for the detector."""
+
+    def __init__(
+        self,
+        size: int = INPUT_SIZE,
+        mean: Sequence[float] = CHANNEL_MEAN,
+        std: Sequence[float] = CHANNEL_STD,
+        max_pixels: int = MAX_IMAGE_PIXELS,
+    ):
+        """Initialize the preprocessor for a model input size."""
+        self.size = size
+        self.max_pixels = max_pixels
+        # (pixel / 255 - mean) / std, as a single multiply and add
+        std_array = np.asarray(std, dtype=np.float32)
+        self._scale = 1 / (255 * std_array)
+        self._offset = -np.asarray(mean, dtype=np.float32) / std_array
+        self._pixels_pool = BufferPool((size, size, 3), np.uint8)
+        self._batch_pool = BufferPool((size, size, 3), np.float32)
+
+    def decode(self, data) -> Image.Image:
+        """Decode an image into an oriented RGB square of the input size."""
+        image = open_image(data, self.max_pixels)
+        try:
+            # JPEGs can be decoded directly at a reduced scale
+            image.draft("RGB", (self.size, self.size))
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGB")
+            # Center-crop and resize in a single resampling pass
+            width, height = image.size
+            side = min(width, height)
+            left, top = (width - side) // 2, (height - side) // 2
+            image = image.resize(
+                (self.size, self.size),
+                Image.Resampling.BILINEAR,
+                box=(left, top, left + side, top + side),
+                reducing_gap=2.0,
+            )
+        except (OSError, ValueError, Image.DecompressionBombError) as exception:
+            raise InvalidImage("the image can't be decoded") from exception
+        return image
+
+    def preprocess_batch(
+        self,
+        images: Sequence,
+    ) -> Tuple[np.ndarray, Dict[int, InvalidImage]]:
+        """Preprocess a batch of encoded images.
+
+        Returns the normalized batch of the valid images (in order) and
+        the errors of the invalid ones, by position. The batch comes from
+        the pool, and should be given back with `release` when done.
+        """
+        pixels = self._pixels_pool.acquire(len(images))
+        errors: Dict[int, InvalidImage] = {}
+        count = 0
+        try:
+            for idx, data in enumerate(images):
+                try:
+                    image = self.decode(data)
+                except InvalidImage as exception:
+                    errors[idx] = exception
+                    continue
+                pixels[count] = np.asarray(image)
+                count += 1
+
+            batch = self._batch_pool.acquire(count)[:count]
+            np.multiply(pixels[:count], self._scale, out=batch)
+            batch += self._offset
+        finally:
+            self._pixels_pool.release(pixels)
+        return batch, errors
+
+    def release(self, batch: Optional[np.ndarray]) -> None:
+        """Give a batch back to the pool."""
+        if batch is not None:
+            self._batch_pool.release(batch)
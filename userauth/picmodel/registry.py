@@ -0,0 +1,121 @@
+"""
+Module with the registry of the loaded celebrity detector.
+
+Loading a real model takes seconds, so it is done once (when the server
+starts) and the same detector is shared by all requests. The model can
+be reloaded while the server runs: the new detector is loaded and warmed
+up in a worker thread, and only then replaces the previous one.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from userauth.common.config import get_server_config
+
+from .cascade import CascadedDetector
+from .celeb_detector import CelebDetector
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_PATH = Path(__file__).parent / "celebs.h5"
+
+
+def configured_model_path() -> Path:
+    """Path of the model file set in the server configuration."""
+    model_path = get_server_config().CELEB_MODEL_PATH
+    if model_path is None:
+        return DEFAULT_MODEL_PATH
+    return Path(model_path)
+
+
+def configured_model_class():
+    """Detector class set in the server configuration (cascaded or not)."""
+    if get_server_config().CELEB_CASCADE:
+        return CascadedDetector
+    return CelebDetector
+
+
+class ModelRegistry:
+    """Holder of the celebrity detector shared by all requests."""
+
+    def __init__(self, model_class=None):
+        """Initialize an empty registry for a detector class.
+
+        Without a class, the configured one is used (read on first use).
+        """
+        self._model_class = model_class
+        self._detector: Optional[CelebDetector] = None
+        self._load_lock: Optional[asyncio.Lock] = None
+        self.model_path: Optional[Path] = None
+        self.loaded_at: Optional[datetime] = None
+
+    @property
+    def model_class(self):
+        if self._model_class is None:
+            self._model_class = configured_model_class()
+        return self._model_class
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._detector is not None
+
+    def _create_detector(self, model_path: Path, warmup: int) -> CelebDetector:
+        detector = self.model_class(model_path)
+        detector.warmup(warmup)
+        return detector
+
+    async def load(
+        self,
+        model_path: Optional[Path] = None,
+        warmup: Optional[int] = None,
+    ) -> CelebDetector:
+        """Load (or reload) the detector and swap it in once warmed up.
+
+        Without a path, the current model file is reloaded (or the
+        configured one, the first time).
+        """
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+
+        if warmup is None:
+            warmup = get_server_config().CELEB_MODEL_WARMUP
+
+        async with self._load_lock:
+            if model_path is None:
+                model_path = self.model_path or configured_model_path()
+
+            start_time = datetime.now()
+            detector = await asyncio.to_thread(
+                self._create_detector,
+                Path(model_path),
+                warmup,
+            )
+            self._detector = detector
+            self.model_path = Path(model_path)
+            self.loaded_at = datetime.now()
+
+        load_seconds = (self.loaded_at - start_time).total_seconds()
+        logger.info("loaded model %s in %.2fs", self.model_path, load_seconds)
+        return detector
+
+    async def get(self) -> CelebDetector:
+        """The current detector (loaded on first use if it wasn't yet)."""
+        if self._detector is None:
+            await self.load()
+        return self._detector
+
+    def unload(self) -> None:
+        """Drop the current detector."""
+        self._detector = None
+        self.model_path = None
+        self.loaded_at = None
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+async def get_celeb_detector() -> CelebDetector:
+    """Dependency providing the shared celebrity detector."""
+    return await MODEL_REGISTRY.get()
@@ -0,0 +1,472 @@
+"""
+Module with the micro-batching scheduler of the detector inferences.
+
+Models are several times more efficient on batches than on single
+images, so the photo validations are queued and sent to the detector in
+batches: a batch leaves when it is full or when its first image has
+waited long enough, which bounds the latency added under low load.
+
+The batches run in worker processes, each with its own detector, so the
+inferences never hold the event loop or the GIL of the server process.
+If a worker crashes, the batches it was running fail and a new pool of
+workers replaces the broken one. With no workers they run in a thread,
+with the detector of the model registry (useful for development and
+tests).
+"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from userauth.common.config import get_server_config
+
+from .cascade import StageStats, record_stage_stats
+from .celeb_detector import CelebDetector
+from .registry import MODEL_REGISTRY, ModelRegistry, configured_model_path
+from .weights import memory_usage
+
+logger = logging.getLogger(__name__)
+
+Prediction = Tuple[str, float]
+Image = Union[bytes, bytearray, memoryview]
+
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "userauth_inference_queue_depth",
+    "Images waiting to be put in an inference batch.",
+    multiprocess_mode="livesum",
+)
+INFERENCE_BATCH_SIZE = Histogram(
+    "userauth_inference_batch_size",
+    "Number of images in the inference batches.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+INFERENCE_STAGE_SECONDS = Histogram(
+    "userauth_inference_stage_seconds",
+    "Latency of the photo predictions, by stage: waiting in the queue, "
+    "running the batch in the detector and the total seen by the request.",
+    labelnames=("stage",),
+)
+INFERENCE_WORKER_RESTARTS = Counter(
+    "userauth_inference_worker_restarts_total",
+    "Pools of inference workers started again after a worker crashed.",
+)
+
+
+###############################################################################
+# WORKER PROCESSES
+###############################################################################
+
+# Detector of the worker process (loaded by the pool initializer)
+_worker_detector: Optional[CelebDetector] = None
+# Load time and memory usage of the worker process after loading
+_worker_stats: Dict[str, float] = {}
+# Error loading the detector (raised to the server by the first task)
+_worker_error: Optional[Exception] = None
+
+
+def _init_worker(model_class, model_path: Path, warmup: int) -> None:
+    global _worker_detector, _worker_error
+    start_time = time.perf_counter()
+    try:
+        _worker_detector = model_class(model_path)
+        _worker_detector.warmup(warmup)
+    except Exception as exception:
+        # Raising here would only break the pool, without the reason
+        _worker_error = exception
+        return
+    _worker_stats["load_seconds"] = time.perf_counter() - start_time
+    _worker_stats.update(memory_usage())
+
+
+def _worker_ready() -> Optional[Dict[str, float]]:
+    """Task used to wait for the workers to be initialized (and their stats)."""
+    if _worker_error is not None:
+        raise _worker_error
+    if _worker_detector is None:
+        return None
+    return dict(_worker_stats)
+
+
+def _run_batch(
+    detector: CelebDetector,
+    images: Sequence,
+    output_names: Sequence[str],
+    output_percents: Sequence[float],
+) -> Tuple[List[Prediction], float, List[StageStats]]:
+    """Run a batch in the detector, timing the inference.
+
+    The stage outcomes of cascaded detectors are returned with it, so
+    that they are recorded in the metrics of the server process.
+    """
+    start_time = time.perf_counter()
+    predictions = detector.predict_batch(images, output_names, output_percents)
+    seconds = time.perf_counter() - start_time
+    return predictions, seconds, getattr(detector, "last_stats", [])
+
+
+def _run_batch_in_worker(images, output_names, output_percents):
+    return _run_batch(_worker_detector, images, output_names, output_percents)
+
+
+def _worker_memory(delay: float) -> Dict[str, int]:
+    # The delay keeps the worker busy, so that the next task goes to another
+    time.sleep(delay)
+    return memory_usage()
+
+
+###############################################################################
+# SCHEDULER
+###############################################################################
+
+
+@dataclass
+class InferenceRequest:
+    """An image waiting for its prediction."""
+
+    image: Image
+    output_name: str
+    output_percent: float
+    future: asyncio.Future
+    queued_at: float = field(default_factory=time.perf_counter)
+
+
+class InferenceScheduler:
+    """Queue of the photo predictions, run by the detector in batches."""
+
+    def __init__(
+        self,
+        registry: ModelRegistry = MODEL_REGISTRY,
+        max_batch_size: Optional[int] = None,
+        max_wait: Optional[float] = None,
+        workers: Optional[int] = None,
+    ):
+        """Initialize a stopped scheduler.
+
+        The maximum wait is in seconds. With no workers, the batches run
+        in a thread with the detector of the registry. The settings left
+        unset are the configured ones (read when the scheduler starts).
+        """
+        self.registry = registry
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self.batches = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._arrived: Optional[asyncio.Event] = None
+        self._collector: Optional[asyncio.Task] = None
+        self._running: set = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._model_path: Optional[Path] = None
+        self._loaded_at: Optional[datetime] = None
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._restart_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._collector is not None
+
+    @property
+    def model_path(self) -> Optional[Path]:
+        if self.workers == 0:
+            return self.registry.model_path
+        return self._model_path
+
+    @property
+    def loaded_at(self) -> Optional[datetime]:
+        if self.workers == 0:
+            return self.registry.loaded_at
+        return self._loaded_at
+
+    async def _load_model(self, model_path: Optional[Path] = None) -> None:
+        """Load the model (in the registry or in a new pool of workers)."""
+        if self.workers == 0:
+            await self.registry.load(model_path)
+            return
+
+        if model_path is None:
+            model_path = self._model_path or configured_model_path()
+        model_path = Path(model_path)
+
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                self.registry.model_class,
+                model_path,
+                get_server_config().CELEB_MODEL_WARMUP,
+            ),
+        )
+        try:
+            # One task per worker, so that all of them start and load
+            loop = asyncio.get_running_loop()
+            ready = [
+                loop.run_in_executor(executor, _worker_ready)
+                for _ in range(self.workers)
+            ]
+            worker_stats = await asyncio.gather(*ready)
+            if not all(worker_stats):
+                raise RuntimeError(f"workers could not load model {model_path}")
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        previous_executor = self._executor
+        self._executor = executor
+        self._model_path = model_path
+        self._loaded_at = datetime.now()
+        logger.info("loaded model %s in %d workers", model_path, self.workers)
+        for stats in worker_stats:
+            logger.info(
+                "worker loaded in %.2fs, rss %.1f MiB (%.1f MiB shared)",
+                stats["load_seconds"],
+                stats["rss"] / 2**20,
+                stats.get("shared", 0) / 2**20,
+            )
+        if previous_executor is not None:
+            # The batches already submitted finish in the previous workers
+            previous_executor.shutdown(wait=False)
+
+    def _configure(self) -> None:
+        server_config = get_server_config()
+        if self.max_batch_size is None:
+            self.max_batch_size = server_config.INFERENCE_MAX_BATCH_SIZE
+        if self.max_wait is None:
+            self.max_wait = server_config.INFERENCE_MAX_WAIT_MS / 1000
+        if self.workers is None:
+            self.workers = server_config.INFERENCE_WORKERS
+        self.max_batch_size = max(1, self.max_batch_size)
+        self.workers = max(0, self.workers)
+
+    async def start(self, model_path: Optional[Path] = None) -> None:
+        """Load the model and start forming batches (if not running yet)."""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+
+        async with self._start_lock:
+            if self.is_running:
+                return
+            self._configure()
+            await self._load_model(model_path)
+            self._queue = asyncio.Queue()
+            self._arrived = asyncio.Event()
+            self._slots = asyncio.Semaphore(max(1, self.workers))
+            self._collector = asyncio.create_task(self._collect())
+
+    async def reload(self, model_path: Optional[Path] = None) -> None:
+        """Reload the model, swapping it in once loaded and warmed up."""
+        if not self.is_running:
+            await self.start(model_path)
+        else:
+            await self._load_model(model_path)
+
+    async def stop(self) -> None:
+        """Stop forming batches, failing the predictions still queued."""
+        if self._collector is not None:
+            self._collector.cancel()
+            await asyncio.gather(self._collector, return_exceptions=True)
+            self._collector = None
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+        while self._queue is not None and not self._queue.empty():
+            request = self._queue.get_nowait()
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("inference stopped"))
+        INFERENCE_QUEUE_DEPTH.set(0)
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._model_path = None
+            self._loaded_at = None
+
+    async def worker_memory(self, delay: float = 0.05) -> List[Dict[str, int]]:
+        """Memory usage of the processes running the inferences.
+
+        One sample per worker (with no workers, the one of this process).
+        Idle workers are expected to take one sample each, but a worker
+        may be sampled twice if another one is busy.
+        """
+        if self._executor is None:
+            return [memory_usage()]
+        loop = asyncio.get_running_loop()
+        samples = [
+            loop.run_in_executor(self._executor, _worker_memory, delay)
+            for _ in range(self.workers)
+        ]
+        return list(await asyncio.gather(*samples))
+
+    async def predict(
+        self,
+        image: Image,
+        output_name: str,
+        output_percent: float,
+    ) -> Prediction:
+        """Queue an image (raw bytes or a buffer) and wait for its prediction."""
+        if not self.is_running:
+            await self.start()
+
+        request = InferenceRequest(
+            image=image,
+            output_name=output_name,
+            output_percent=output_percent,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self._queue.put_nowait(request)
+        self._arrived.set()
+        INFERENCE_QUEUE_DEPTH.inc()
+        prediction = await request.future
+        INFERENCE_STAGE_SECONDS.labels(stage="total").observe(
+            time.perf_counter() - request.queued_at
+        )
+        return prediction
+
+    async def _next_request(self) -> InferenceRequest:
+        request = await self._queue.get()
+        INFERENCE_QUEUE_DEPTH.dec()
+        return request
+
+    def _take_request(self) -> InferenceRequest:
+        request = self._queue.get_nowait()
+        INFERENCE_QUEUE_DEPTH.dec()
+        return request
+
+    async def _collect(self) -> None:
+        """Form the batches and send them to the detector.
+
+        Once a batch has its first request, the rest are taken with
+        `get_nowait` as they arrive until the deadline: waiting on the
+        queue itself under a timeout may take a request and then drop it
+        when the wait is cancelled. If the collector is stopped, the
+        requests of the batch being formed fail.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a free worker first, so batches keep growing meanwhile
+            await self._slots.acquire()
+            batch = [await self._next_request()]
+            try:
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    if not self._queue.empty():
+                        batch.append(self._take_request())
+                        continue
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    self._arrived.clear()
+                    try:
+                        await asyncio.wait_for(self._arrived.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(RuntimeError("inference stopped"))
+                raise
+
+            task = asyncio.create_task(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _current_executor(self) -> Optional[ProcessPoolExecutor]:
+        """The pool of workers (waiting for the replacement of a broken one)."""
+        if self._restart_lock is not None:
+            async with self._restart_lock:
+                pass
+        return self._executor
+
+    async def _replace_executor(self, broken: ProcessPoolExecutor) -> None:
+        """Start a new pool of workers in place of a broken one (only once)."""
+        if self._restart_lock is None:
+            self._restart_lock = asyncio.Lock()
+
+        async with self._restart_lock:
+            # Already replaced (by another batch of the broken pool) or stopped
+            if self._executor is not broken:
+                return
+            logger.error("an inference worker crashed, starting new workers")
+            INFERENCE_WORKER_RESTARTS.inc()
+            try:
+                await self._load_model(self._model_path)
+            except Exception:
+                logger.exception("could not start new inference workers")
+
+    async def _run(self, batch: List[InferenceRequest]) -> None:
+        """Run a batch and resolve the futures of its requests."""
+        try:
+            # Requests cancelled while queued are not worth the inference
+            batch = [request for request in batch if not request.future.done()]
+            if not batch:
+                return
+
+            sent_at = time.perf_counter()
+            for request in batch:
+                INFERENCE_STAGE_SECONDS.labels(stage="queue").observe(
+                    sent_at - request.queued_at
+                )
+            INFERENCE_BATCH_SIZE.observe(len(batch))
+
+            images = [request.image for request in batch]
+            output_names = [request.output_name for request in batch]
+            output_percents = [request.output_percent for request in batch]
+            executor = await self._current_executor()
+            try:
+                if executor is None:
+                    detector = await self.registry.get()
+                    predictions, seconds, stage_stats = await asyncio.to_thread(
+                        _run_batch, detector, images, output_names, output_percents
+                    )
+                else:
+                    # Memory views can't be pickled (buffers are sent as is)
+                    images = [
+                        bytes(image) if isinstance(image, memoryview) else image
+                        for image in images
+                    ]
+                    loop = asyncio.get_running_loop()
+                    predictions, seconds, stage_stats = await loop.run_in_executor(
+                        executor,
+                        _run_batch_in_worker,
+                        images,
+                        output_names,
+                        output_percents,
+                    )
+            except Exception as exception:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(exception)
+                if isinstance(exception, BrokenProcessPool):
+                    await self._replace_executor(executor)
+                return
+
+            self.batches += 1
+            INFERENCE_STAGE_SECONDS.labels(stage="inference").observe(seconds)
+            record_stage_stats(stage_stats)
+            for request, prediction in zip(batch, predictions):
+                if request.future.done():
+                    continue
+                # Images rejected by the detector get their error instead
+                if isinstance(prediction, Exception):
+                    request.future.set_exception(prediction)
+                else:
+                    request.future.set_result(prediction)
+        finally:
+            self._slots.release()
+
+
+INFERENCE_SCHEDULER = InferenceScheduler()
+
+
+async def get_inference_scheduler() -> InferenceScheduler:
+    """Dependency providing the shared inference scheduler."""
+    return INFERENCE_SCHEDULER
@@ -0,0 +1,216 @@
+"""
+Module with the memory-mapped weights of the models.
+
+Loading the weights of a model (a Keras `.h5` file) into every worker
+process multiplies the memory used by the number of workers, and makes
+each one of them pay for reading and decoding the whole file. Instead,
+the weights are converted once into a flat file of raw arrays (aligned,
+in native byte order) and an index with the name, type, shape and offset
+of each array. Workers map the file read-only, so all of them share the
+same pages of the page cache and only touch the ones they use.
+
+Weights can also be stored quantized to int8 (symmetric, with a float32
+scale per output channel), which divides their size by four for the CPU
+path at a small cost in precision.
+"""
+import json
+import mmap
+import resource
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:  # pragma: no cover
+    h5py = None
+
+INDEX_FILE = "index.json"
+WEIGHTS_FILE = "weights.bin"
+WEIGHTS_FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def is_weights_dir(path: Union[str, Path]) -> bool:
+    """Whether the path is a directory of converted weights."""
+    return (Path(path) / INDEX_FILE).is_file()
+
+
+def quantize_int8(array: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetric int8 quantization, with a scale per output channel.
+
+    The output channels are the last axis (as in the Keras kernels).
+    """
+    array = np.asarray(array, dtype=np.float32)
+    channels = array.reshape(-1, array.shape[-1])
+    scale = np.abs(channels).max(axis=0) / 127
+    scale[scale == 0] = 1
+    quantized = np.rint(channels / scale).clip(-127, 127).astype(np.int8)
+    return quantized.reshape(array.shape), scale.astype(np.float32)
+
+
+def read_h5_weights(h5_path: Union[str, Path]) -> Dict[str, np.ndarray]:
+    """Read all the arrays of an HDF5 file, by their path in the file."""
+    if h5py is None:
+        raise RuntimeError("reading .h5 files requires h5py (pip install h5py)")
+
+    arrays: Dict[str, np.ndarray] = {}
+
+    def read_dataset(name, item):
+        if isinstance(item, h5py.Dataset) and item.dtype.kind in "fiub":
+            arrays[name] = item[()]
+
+    with h5py.File(h5_path, "r") as h5_file:
+        h5_file.visititems(read_dataset)
+    return arrays
+
+
+def save_weights(
+    arrays: Dict[str, np.ndarray],
+    path: Union[str, Path],
+    quantize: bool = False,
+) -> Path:
+    """Write arrays as a directory of memory-mappable weights.
+
+    With `quantize`, the float arrays of two or more dimensions (the
+    kernels, not the biases or normalization parameters) are stored as
+    int8 with their scales.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    index = {}
+    offset = 0
+
+    def write_array(weights_file, array):
+        nonlocal offset
+        padding = -offset % ALIGNMENT
+        weights_file.write(bytes(padding))
+        offset += padding
+        start = offset
+        weights_file.write(np.ascontiguousarray(array).tobytes())
+        offset += array.nbytes
+        return start
+
+    with open(path / WEIGHTS_FILE, "wb") as weights_file:
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            entry = {"shape": list(array.shape)}
+            if quantize and array.dtype.kind == "f" and array.ndim >= 2:
+                quantized, scale = quantize_int8(array)
+                entry["dtype"] = "int8"
+                entry["offset"] = write_array(weights_file, quantized)
+                entry["scale_offset"] = write_array(weights_file, scale)
+            else:
+                array = array.astype(array.dtype.newbyteorder("="), copy=False)
+                entry["dtype"] = array.dtype.str
+                entry["offset"] = write_array(weights_file, array)
+            index[name] = entry
+
+    # The index goes last, so an interrupted conversion isn't loadable
+    content = {"version": WEIGHTS_FORMAT_VERSION, "arrays": index}
+    (path / INDEX_FILE).write_text(json.dumps(content, indent=1))
+    return path
+
+
+def convert_h5(
+    h5_path: Union[str, Path],
+    path: Union[str, Path],
+    quantize: bool = False,
+) -> Path:
+    """Convert the weights of an HDF5 model into memory-mappable weights."""
+    return save_weights(read_h5_weights(h5_path), path, quantize)
+
+
+class MappedWeights:
+    """Read-only weights mapped from a converted directory.
+
+    The arrays are views of the mapped file: nothing is read until they
+    are used, and the pages are shared by all the processes mapping it.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Map the weights of a directory created by `save_weights`."""
+        self.path = Path(path)
+        content = json.loads((self.path / INDEX_FILE).read_text())
+        if content.get("version") != WEIGHTS_FORMAT_VERSION:
+            raise ValueError(f"unsupported weights format in {self.path}")
+        self._index: Dict[str, dict] = content["arrays"]
+
+        weights_path = self.path / WEIGHTS_FILE
+        if weights_path.stat().st_size == 0:
+            self._buffer = np.empty(0, dtype=np.uint8)
+        else:
+            self._buffer = np.memmap(weights_path, dtype=np.uint8, mode="r")
+
+    def _view(self, dtype, shape, offset: int) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        data = self._buffer[offset : offset + count * dtype.itemsize]
+        return data.view(dtype).reshape(shape)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._buffer)
+
+    def preload(self) -> None:
+        """Read every page of the file (into the shared page cache)."""
+        if len(self._buffer):
+            int(self._buffer[:: mmap.PAGESIZE].sum())
+
+    def is_quantized(self, name: str) -> bool:
+        return "scale_offset" in self._index[name]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """The stored array (int8 for the quantized ones), without copying."""
+        entry = self._index[name]
+        return self._view(entry["dtype"], entry["shape"], entry["offset"])
+
+    def scale(self, name: str) -> Optional[np.ndarray]:
+        """Scales of a quantized array (per output channel)."""
+        entry = self._index[name]
+        if "scale_offset" not in entry:
+            return None
+        channels = entry["shape"][-1]
+        return self._view(np.float32, (channels,), entry["scale_offset"])
+
+    def dequantized(self, name: str) -> np.ndarray:
+        """The array as float32 (a copy, for the quantized ones)."""
+        array = self[name]
+        scale = self.scale(name)
+        if scale is None:
+            return array
+        return array.astype(np.float32) * scale
+
+
+def memory_usage() -> Dict[str, int]:
+    """Resident memory of the current process, in bytes.
+
+    On Linux, `shared` is the part backed by files (like mapped weights,
+    shared with other processes) and `private` the anonymous one.
+    """
+    usage = {}
+    try:
+        with open("/proc/self/status") as status_file:
+            fields = dict(line.split(":", 1) for line in status_file)
+        usage["rss"] = int(fields["VmRSS"].split()[0]) * 1024
+        usage["private"] = int(fields["RssAnon"].split()[0]) * 1024
+        usage["shared"] = int(fields["RssFile"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        pass
+
+    # Peak RSS (in kilobytes on Linux, but in bytes on macOS)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage["peak_rss"] = peak_rss if sys.platform == "darwin" else peak_rss * 1024
+    usage.setdefault("rss", usage["peak_rss"])
+    return usage